@@ -0,0 +1,80 @@
+"""Log probability and gradient benchmarks of the reference models, run with asv.
+
+The functions are built by :func:`pymc4.inference.benchmark.benchmark_functions`, the
+same ones that ``pm.benchmark_model`` times, and are called once in ``setup`` so that the
+timings exclude tracing and compilation.
+"""
+import numpy as np
+import tensorflow as tf
+
+from pymc4.inference.benchmark import benchmark_functions
+
+from .models import MANUALLY_BATCHED, MODELS
+
+
+def call(fn, args):
+    # converting the results to numpy waits for the computation to finish
+    return tf.nest.map_structure(np.asarray, fn(*args))
+
+
+class Executor:
+    """The Python overhead of a forward pass of the model through the executor."""
+
+    params = list(MODELS)
+    param_names = ["model"]
+
+    def setup(self, model):
+        self.fn, self.args = benchmark_functions(MODELS[model](), modes=[])["executor"]
+
+    def time_evaluate_model(self, model):
+        call(self.fn, self.args)
+
+
+class LogProb:
+    """The log probability of a single chain and its value and gradient."""
+
+    params = (list(MODELS), ["eager", "graph", "xla"])
+    param_names = ["model", "mode"]
+
+    def setup(self, model, mode):
+        functions = benchmark_functions(MODELS[model](), modes=[mode], batching=[])
+        self.logp = functions["logp/{}".format(mode)]
+        self.logp_and_gradient = functions["logp_and_gradient/{}".format(mode)]
+        call(*self.logp)
+        call(*self.logp_and_gradient)
+
+    def time_collect_log_prob(self, model, mode):
+        call(*self.logp)
+
+    def time_value_and_gradient(self, model, mode):
+        call(*self.logp_and_gradient)
+
+    def track_retraces(self, model, mode):
+        fn, args = self.logp_and_gradient
+        if mode == "eager":
+            raise NotImplementedError
+        for _ in range(3):
+            call(fn, args)
+        return fn.experimental_get_tracing_count() - 1
+
+    track_retraces.unit = "traces"
+
+
+class Chains:
+    """The value and gradient of the log probability of a batch of chains."""
+
+    params = (list(MODELS), ["auto", "manual"], ["graph", "xla"], [1, 10, 100])
+    param_names = ["model", "batching", "mode", "num_chains"]
+
+    def setup(self, model, batching, mode, num_chains):
+        if batching == "manual" and model not in MANUALLY_BATCHED:
+            # asv skips the benchmarks whose setup raises NotImplementedError
+            raise NotImplementedError
+        functions = benchmark_functions(
+            MODELS[model](), num_chains=num_chains, modes=[mode], batching=[batching]
+        )
+        self.fn, self.args = functions["chains/{}/{}".format(batching, mode)]
+        call(self.fn, self.args)
+
+    def time_value_and_gradient(self, model, batching, mode, num_chains):
+        call(self.fn, self.args)
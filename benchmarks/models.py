@@ -0,0 +1,128 @@
+"""The reference models of the benchmarks.
+
+The models are written with a leading chains axis in mind (``conditionally_independent``
+hyperpriors and explicit event dimensions), so that the ones in ``MANUALLY_BATCHED`` can
+also be sampled with ``use_auto_batching=False``.
+"""
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+import pymc4 as pm
+
+
+def eight_schools():
+    y = np.array([28, 8, -3, 7, -1, 1, 18, 12], dtype="float32")
+    sigma = np.array([15, 10, 16, 11, 9, 11, 10, 18], dtype="float32")
+
+    @pm.model
+    def model():
+        eta = yield pm.Normal("eta", tf.zeros(8), 1, reinterpreted_batch_ndims=1)
+        mu = yield pm.Normal("mu", 1, 10, conditionally_independent=True)
+        tau = yield pm.HalfNormal("tau", 2.0, conditionally_independent=True)
+        theta = mu[..., None] + tau[..., None] * eta
+        yield pm.Normal("obs", theta, sigma, observed=y, reinterpreted_batch_ndims=1)
+
+    return model()
+
+
+def radon():
+    data = pd.read_csv(pm.utils.get_data("radon.csv"))
+    county_idx = data["county_code"].values.astype("int32")
+    floor = data["floor"].values.astype("float32")
+    log_radon = data["log_radon"].values.astype("float32")
+    num_counties = len(data["county"].unique())
+
+    @pm.model
+    def model():
+        mu_a = yield pm.Normal("mu_alpha", 0.0, 1.0, conditionally_independent=True)
+        sigma_a = yield pm.HalfCauchy("sigma_alpha", 1.0, conditionally_independent=True)
+        mu_b = yield pm.Normal("mu_beta", 0.0, 1.0, conditionally_independent=True)
+        sigma_b = yield pm.HalfCauchy("sigma_beta", 1.0, conditionally_independent=True)
+        a = yield pm.Normal(
+            "alpha",
+            mu_a[..., None] * tf.ones(num_counties),
+            sigma_a[..., None],
+            reinterpreted_batch_ndims=1,
+        )
+        b = yield pm.Normal(
+            "beta",
+            mu_b[..., None] * tf.ones(num_counties),
+            sigma_b[..., None],
+            reinterpreted_batch_ndims=1,
+        )
+        eps = yield pm.HalfCauchy("eps", 1.0, conditionally_independent=True)
+        radon_est = tf.gather(a, county_idx, axis=-1) + tf.gather(b, county_idx, axis=-1) * floor
+        yield pm.Normal(
+            "y_like", radon_est, eps[..., None], observed=log_radon, reinterpreted_batch_ndims=1
+        )
+
+    return model()
+
+
+def rugby():
+    data = pd.read_csv(pm.utils.get_data("rugby.csv"), index_col=0)
+    teams = pd.Index(sorted(data["home_team"].unique()))
+    home_team = teams.get_indexer(data["home_team"]).astype("int32")
+    away_team = teams.get_indexer(data["away_team"]).astype("int32")
+    home_score = data["home_score"].values.astype("float32")
+    away_score = data["away_score"].values.astype("float32")
+    num_teams = len(teams)
+
+    @pm.model
+    def model():
+        home = yield pm.Normal("home", 0.0, 1.0, conditionally_independent=True)
+        sd_att = yield pm.HalfStudentT("sd_att", df=3.0, scale=2.5, conditionally_independent=True)
+        sd_def = yield pm.HalfStudentT("sd_def", df=3.0, scale=2.5, conditionally_independent=True)
+        intercept = yield pm.Normal("intercept", 0.0, 1.0, conditionally_independent=True)
+        atts_star = yield pm.Normal(
+            "atts_star", tf.zeros(num_teams), sd_att[..., None], reinterpreted_batch_ndims=1
+        )
+        defs_star = yield pm.Normal(
+            "defs_star", tf.zeros(num_teams), sd_def[..., None], reinterpreted_batch_ndims=1
+        )
+        atts = atts_star - tf.reduce_mean(atts_star, axis=-1, keepdims=True)
+        defs = defs_star - tf.reduce_mean(defs_star, axis=-1, keepdims=True)
+        home_theta = tf.exp(
+            intercept[..., None]
+            + home[..., None]
+            + tf.gather(atts, home_team, axis=-1)
+            + tf.gather(defs, away_team, axis=-1)
+        )
+        away_theta = tf.exp(
+            intercept[..., None]
+            + tf.gather(atts, away_team, axis=-1)
+            + tf.gather(defs, home_team, axis=-1)
+        )
+        yield pm.Poisson(
+            "home_points", home_theta, observed=home_score, reinterpreted_batch_ndims=1
+        )
+        yield pm.Poisson(
+            "away_points", away_theta, observed=away_score, reinterpreted_batch_ndims=1
+        )
+
+    return model()
+
+
+def gaussian_process():
+    rng = np.random.RandomState(0)
+    X = np.sort(rng.uniform(0, 10, (50, 1)), axis=0).astype("float32")
+    y = (np.sin(X[:, 0]) + 0.1 * rng.randn(50)).astype("float32")
+
+    @pm.model
+    def model():
+        length_scale = yield pm.HalfCauchy("length_scale", 5.0)
+        cov_fn = pm.gp.cov.ExpQuad(length_scale=length_scale, amplitude=1.0, feature_ndims=1)
+        f = yield pm.gp.LatentGP(cov_fn=cov_fn).prior("f", X=X)
+        yield pm.Normal("y", f, 0.1, observed=y)
+
+    return model()
+
+
+MODELS = {
+    "eight_schools": eight_schools,
+    "radon": radon,
+    "rugby": rugby,
+    "gaussian_process": gaussian_process,
+}
+MANUALLY_BATCHED = {"eight_schools", "radon", "rugby"}
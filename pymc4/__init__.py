@@ -13,10 +13,18 @@ from .flow import (
     evaluate_meta_posterior_predictive_model,
 )
 from .coroutine_model import Model, model
+from . import data
+from .data import Minibatch
 from . import inference
 from .distributions import *
 from .forward_sampling import sample_prior_predictive, sample_posterior_predictive
 from .inference.sampling import sample
+from .inference.smc import sample_smc
+from .inference.batched import sample_many
+from .inference.benchmark import benchmark_model
+from .inference.incremental import IncrementalLogProb
+from . import variational
+from .variational import fit, find_MAP
 from . import gp
 
 __version__ = "4.0a2"
@@ -7,8 +7,14 @@ from pymc4.scopes import name_scope
 from pymc4.utils import biwrap, NameParts
 
 
+class _NoNameProvided:
+    # unpickling must give back the same object, since it is compared by identity
+    def __reduce__(self):
+        return "_no_name_provided"
+
+
 # we need that indicator to distinguish between explicit None and no value provided case
-_no_name_provided = object()
+_no_name_provided = _NoNameProvided()
 
 
 @biwrap
@@ -0,0 +1,395 @@
+"""Data containers for observed values.
+
+:class:`Minibatch` holds arrays that are too tall to be used whole in every evaluation of a
+model's log probability. Each evaluation sees a random batch of their rows instead, and
+the log probability of the variables observed on a batch is rescaled by
+``total_size / batch_size``, so that it is an unbiased estimate of the log probability of
+the whole data. The batches are produced by a ``tf.data`` pipeline that shuffles the rows
+and prefetches the next batch while the current one is used.
+
+:class:`ShardedData` holds observed data that does not fit in memory, stored in NumPy
+``.npy`` or Parquet shards. Its log probability is accumulated chunk by chunk, with its
+gradient, by a ``tf.data`` pipeline that streams the memory-mapped shards, so that the
+memory used by an evaluation does not depend on the size of the data.
+"""
+import contextlib
+import glob
+import os
+from typing import Any, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import composite_tensor
+
+
+__all__ = ["Minibatch", "MinibatchData", "ShardedData"]
+
+
+class Minibatch:
+    """Random batches of the rows of one or more arrays.
+
+    The arrays must have the same number of rows, and the rows of the same index are kept
+    together in the batches, e.g. the covariates and the observations of a regression.
+    Iterating over a ``Minibatch`` gives a :class:`MinibatchData` per array, to be used as
+    observed values or as tensors in the model.
+
+    Parameters
+    ----------
+    *arrays : array_like
+        The arrays to draw the batches from.
+    batch_size : int
+        The number of rows of a batch.
+    shuffle : bool
+        Draw the rows in a random order, reshuffled at every pass over the data. If
+        ``False``, the batches are contiguous slices of the rows.
+    seed : Optional[int]
+        The seed of the shuffling.
+    prefetch : Optional[int]
+        The number of batches prepared in the background. Defaults to ``tf.data.AUTOTUNE``.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> x = np.linspace(-1, 1, 1000).astype("float32")
+    >>> y = (2 * x + np.random.randn(1000)).astype("float32")
+    >>> x_batch, y_batch = pm.Minibatch(x, y, batch_size=100)
+    >>> @pm.model
+    ... def regression():
+    ...     slope = yield pm.Normal("slope", 0, 10)
+    ...     yield pm.Normal("y", slope * x_batch.value, 1, observed=y_batch)
+    >>> approximation, losses = pm.fit(regression(), num_steps=1000)
+    """
+
+    def __init__(
+        self,
+        *arrays: Any,
+        batch_size: int = 128,
+        shuffle: bool = True,
+        seed: Optional[int] = None,
+        prefetch: Optional[int] = None,
+    ):
+        if not arrays:
+            raise ValueError("At least one array is needed to draw batches from")
+        arrays = tuple(tf.convert_to_tensor(array) for array in arrays)
+        sizes = {int(array.shape[0]) for array in arrays}
+        if len(sizes) != 1:
+            raise ValueError("The arrays have different numbers of rows: {}".format(sizes))
+        self.total_size = sizes.pop()
+        if not 0 < batch_size <= self.total_size:
+            raise ValueError(
+                "`batch_size` must be between 1 and the number of rows {}, got {}".format(
+                    self.total_size, batch_size
+                )
+            )
+        self.batch_size = batch_size
+        self.arrays = arrays
+        dataset = tf.data.Dataset.from_tensor_slices(arrays)
+        if shuffle:
+            dataset = dataset.shuffle(self.total_size, seed=seed, reshuffle_each_iteration=True)
+        # dropping the last partial batch keeps the shapes, and the rescaling, constant
+        dataset = dataset.repeat().batch(batch_size, drop_remainder=True)
+        self.dataset = dataset.prefetch(tf.data.AUTOTUNE if prefetch is None else prefetch)
+        self._iterator = iter(self.dataset)
+        self._batch: Optional[Tuple[tf.Tensor, ...]] = None
+        self._fed: Optional[Tuple[tf.Tensor, ...]] = None
+
+    @property
+    def scale(self) -> float:
+        """The factor that rescales the log probability of a batch to the whole data."""
+        return self.total_size / self.batch_size
+
+    def next_batch(self) -> Tuple[tf.Tensor, ...]:
+        """Draw the next batch from the pipeline.
+
+        Inside a ``tf.function``, the batch is drawn every time the function runs.
+        """
+        return next(self._iterator)
+
+    @property
+    def batch(self) -> Tuple[tf.Tensor, ...]:
+        """The batch seen by the model.
+
+        This is the batch given to :meth:`feed` while it is active, otherwise the batch
+        drawn by the last call of :meth:`advance`.
+        """
+        if self._fed is not None:
+            return self._fed
+        if self._batch is None:
+            self.advance()
+        return self._batch
+
+    def advance(self) -> None:
+        """Draw the next batch, outside of any ``tf.function``, as the current batch."""
+        with tf.init_scope():
+            self._batch = self.next_batch()
+
+    @contextlib.contextmanager
+    def feed(self, batch: Tuple[tf.Tensor, ...]):
+        """Let the model see ``batch``, e.g. symbolic tensors drawn in a ``tf.function``."""
+        previous, self._fed = self._fed, tuple(batch)
+        try:
+            yield self
+        finally:
+            self._fed = previous
+
+    def __getitem__(self, index: int) -> "MinibatchData":
+        self.arrays[index]  # raise an IndexError for unknown indices
+        return MinibatchData(self, index)
+
+    def __len__(self) -> int:
+        return len(self.arrays)
+
+    def __iter__(self) -> Iterator["MinibatchData"]:
+        return (self[index] for index in range(len(self)))
+
+    def __repr__(self):
+        return "{}(num_arrays={}, total_size={}, batch_size={})".format(
+            self.__class__.__name__, len(self), self.total_size, self.batch_size
+        )
+
+
+class MinibatchData:
+    """The batches of one of the arrays of a :class:`Minibatch`.
+
+    Use it as the observed value of a distribution to get the rescaled log probability of
+    the batches, or use its :attr:`value` as a tensor in the model.
+    """
+
+    def __init__(self, minibatch: Minibatch, index: int):
+        self.minibatch = minibatch
+        self.index = index
+
+    @property
+    def value(self) -> tf.Tensor:
+        """The current batch of the array."""
+        return self.minibatch.batch[self.index]
+
+    @property
+    def scale(self) -> float:
+        return self.minibatch.scale
+
+    @property
+    def data(self) -> np.ndarray:
+        """The whole array."""
+        return self.minibatch.arrays[self.index].numpy()
+
+    def __repr__(self):
+        return "{}(index={}, {!r})".format(self.__class__.__name__, self.index, self.minibatch)
+
+
+tf.register_tensor_conversion_function(
+    MinibatchData,
+    lambda data, dtype=None, name=None, as_ref=False: tf.convert_to_tensor(
+        data.value, dtype=dtype, name=name
+    ),
+)
+
+
+class ShardedData:
+    """Observed data streamed from NumPy or Parquet shards.
+
+    The shards are concatenated along their first axis. ``.npy`` shards are memory-mapped,
+    and Parquet shards, which need ``pyarrow``, are read by batches of rows. Use it as the
+    observed value of a distribution whose parameters are shared by all the rows, i.e. that
+    broadcast against a single row. Its log probability, summed over all the rows, is
+    computed chunk by chunk with ``chunk_size`` rows at a time and only the chunks being
+    processed are in memory. Every evaluation of the log probability reads all the shards,
+    so larger chunks amortize the cost of reading them.
+
+    Parameters
+    ----------
+    paths : Union[str, Sequence[str]]
+        The paths of the shards, or a glob pattern matching them.
+    chunk_size : int
+        The number of rows of a chunk.
+    column : Optional[str]
+        The column of the Parquet shards to read. Can be omitted for shards with a single
+        column.
+    prefetch : Optional[int]
+        The number of chunks read in the background. Defaults to ``tf.data.AUTOTUNE``.
+
+    Examples
+    --------
+    >>> import os, tempfile
+    >>> import pymc4 as pm
+    >>> directory = tempfile.mkdtemp()
+    >>> for i in range(3):
+    ...     np.save(os.path.join(directory, "y{}.npy".format(i)), np.random.randn(1000) + 1)
+    >>> y = pm.data.ShardedData(os.path.join(directory, "y*.npy"), chunk_size=512)
+    >>> y.shape
+    (3000,)
+    >>> @pm.model
+    ... def model():
+    ...     mu = yield pm.Normal("mu", 0, 10)
+    ...     yield pm.Normal("y", mu, 1, observed=y)
+    >>> result = pm.find_MAP(model())
+    """
+
+    def __init__(
+        self,
+        paths: Union[str, Sequence[str]],
+        chunk_size: int = 65536,
+        column: Optional[str] = None,
+        prefetch: Optional[int] = None,
+    ):
+        self.paths: List[str] = sorted(glob.glob(paths)) if isinstance(paths, str) else list(paths)
+        if not self.paths:
+            raise ValueError("No shards found in {!r}".format(paths))
+        if chunk_size < 1:
+            raise ValueError("`chunk_size` must be positive, got {}".format(chunk_size))
+        self.chunk_size = chunk_size
+        self.column = column
+        self.prefetch = prefetch
+        num_rows = []
+        row_shapes = set()
+        dtypes = set()
+        for path in self.paths:
+            rows, row_shape, dtype = self._shard_info(path)
+            num_rows.append(rows)
+            row_shapes.add(row_shape)
+            dtypes.add(dtype)
+        if len(row_shapes) != 1 or len(dtypes) != 1:
+            raise ValueError(
+                "The shards must have the same row shape and dtype, got row shapes {} and "
+                "dtypes {}".format(sorted(row_shapes), sorted(map(str, dtypes)))
+            )
+        self.num_rows = num_rows
+        self.row_shape = row_shapes.pop()
+        self.dtype = dtypes.pop()
+        self._dataset: Optional[tf.data.Dataset] = None
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (sum(self.num_rows),) + self.row_shape
+
+    def _is_parquet(self, path: str) -> bool:
+        return os.path.splitext(path)[1] in (".parquet", ".pq")
+
+    def _parquet_file(self, path: str):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("`pyarrow` is required to read Parquet shards") from error
+        parquet_file = pq.ParquetFile(path)
+        names = parquet_file.schema_arrow.names
+        if self.column is None and len(names) != 1:
+            raise ValueError(
+                "The Parquet shard {!r} has the columns {}, select one with `column`".format(
+                    path, names
+                )
+            )
+        return parquet_file, self.column if self.column is not None else names[0]
+
+    def _shard_info(self, path: str) -> Tuple[int, Tuple[int, ...], np.dtype]:
+        if self._is_parquet(path):
+            parquet_file, column = self._parquet_file(path)
+            field = parquet_file.schema_arrow.field(column)
+            return parquet_file.metadata.num_rows, (), np.dtype(field.type.to_pandas_dtype())
+        # only the header of a memory-mapped array is read
+        array = np.load(path, mmap_mode="r")
+        return array.shape[0], array.shape[1:], array.dtype
+
+    def chunks(self) -> Iterator[np.ndarray]:
+        """Read the chunks of the shards, one at a time."""
+        for path in self.paths:
+            if self._is_parquet(path):
+                parquet_file, column = self._parquet_file(path)
+                for batch in parquet_file.iter_batches(
+                    batch_size=self.chunk_size, columns=[column]
+                ):
+                    yield batch.column(0).to_numpy()
+            else:
+                array = np.load(path, mmap_mode="r")
+                for start in range(0, array.shape[0], self.chunk_size):
+                    yield np.asarray(array[start : start + self.chunk_size])
+
+    @property
+    def dataset(self) -> tf.data.Dataset:
+        """The ``tf.data`` pipeline of the chunks."""
+        if self._dataset is None:
+            # built eagerly to be shared by all the functions that stream the data
+            with tf.init_scope():
+                self._dataset = self._build_dataset()
+        return self._dataset
+
+    def _build_dataset(self) -> tf.data.Dataset:
+        dataset = tf.data.Dataset.from_generator(
+            self.chunks,
+            output_signature=tf.TensorSpec((None,) + self.row_shape, self.dtype),
+        )
+        return dataset.prefetch(tf.data.AUTOTUNE if self.prefetch is None else self.prefetch)
+
+    def reduce_log_prob(self, dist: Any) -> tf.Tensor:
+        """Sum the log probability of all the rows under ``dist``, chunk by chunk.
+
+        The gradient with respect to the parameters of the distribution is accumulated
+        along with the log probability, so that backpropagation does not need to keep the
+        chunks either.
+
+        Parameters
+        ----------
+        dist : pymc4.distributions.Distribution
+            A distribution whose parameters broadcast against a single row.
+        """
+        distribution = dist._distribution
+        if (dist.batch_shape + dist.event_shape).rank > len(self.row_shape):
+            raise ValueError(
+                "The parameters of the distribution of sharded data must broadcast against "
+                "a single row of shape {}, but the distribution has the shape {}".format(
+                    self.row_shape, dist.batch_shape + dist.event_shape
+                )
+            )
+        if not isinstance(distribution, composite_tensor.CompositeTensor):
+            raise TypeError(
+                "The log probability of sharded data can not be accumulated over the "
+                "distribution {}".format(type(distribution).__name__)
+            )
+        components = tf.nest.flatten(distribution, expand_composites=True)
+        differentiable = [i for i, part in enumerate(components) if part.dtype.is_floating]
+
+        def rebuild(parameters):
+            parts = list(components)
+            for i, parameter in zip(differentiable, parameters):
+                parts[i] = parameter
+            return tf.nest.pack_sequence_as(distribution, parts, expand_composites=True)
+
+        parameters = [tf.stop_gradient(components[i]) for i in differentiable]
+
+        def accumulate(total, chunk):
+            value, gradients = total
+            with tf.GradientTape() as tape:
+                tape.watch(parameters)
+                chunk_value = tf.reduce_sum(
+                    rebuild(parameters).log_prob(tf.cast(chunk, dist.dtype))
+                )
+            chunk_gradients = tape.gradient(
+                chunk_value, parameters, unconnected_gradients=tf.UnconnectedGradients.ZERO
+            )
+            return (
+                value + chunk_value,
+                tuple(gradient + chunk for gradient, chunk in zip(gradients, chunk_gradients)),
+            )
+
+        dtype = parameters[0].dtype if parameters else tf.float32
+        value, gradients = self.dataset.reduce(
+            # the structures of tf.data treat lists as tensors, hence the tuples
+            (tf.zeros([], dtype), tuple(tf.zeros_like(parameter) for parameter in parameters)),
+            accumulate,
+        )
+        # a surrogate whose value is the log probability and whose gradient with respect to
+        # the parameters is the accumulated one. Unlike a custom gradient, it survives the
+        # vectorization of the log probability over the chains.
+        for i, parameter, gradient in zip(differentiable, parameters, gradients):
+            value += tf.reduce_sum((components[i] - parameter) * tf.stop_gradient(gradient))
+        return value
+
+    def __getstate__(self):
+        # the pipeline is rebuilt from the paths, e.g. in worker processes
+        state = self.__dict__.copy()
+        state["_dataset"] = None
+        return state
+
+    def __repr__(self):
+        return "{}(num_shards={}, shape={}, dtype={})".format(
+            self.__class__.__name__, len(self.paths), self.shape, self.dtype
+        )
@@ -215,6 +215,12 @@ class Potential:
         return self.value.numpy()
 
 
+class JacobianPotential(Potential):
+    """The log Jacobian determinant of the automatic transformation of a free variable."""
+
+    __slots__ = ()
+
+
 class Deterministic(Model):
     """An object that can be sampled, but has no log probability."""
 
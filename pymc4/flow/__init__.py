@@ -1,15 +1,24 @@
 """Functions for evaluating log probabilities."""
-from .executor import SamplingExecutor, SamplingState
+from .executor import SamplingExecutor, SamplingState, StateLayout
 from .transformed_executor import TransformedSamplingExecutor
 from .posterior_predictive_executor import PosteriorPredictiveSamplingExecutor
 from .meta_executor import MetaSamplingExecutor, MetaPosteriorPredictiveSamplingExecutor
+from .dependencies import DependencyGraph, model_dependencies
+from .ir import ModelIR, VariableNode, build_model_ir, collect_deterministics
 
 __all__ = [
     "SamplingExecutor",
+    "StateLayout",
     "TransformedSamplingExecutor",
     "PosteriorPredictiveSamplingExecutor",
     "MetaSamplingExecutor",
     "MetaPosteriorPredictiveSamplingExecutor",
+    "DependencyGraph",
+    "model_dependencies",
+    "ModelIR",
+    "VariableNode",
+    "build_model_ir",
+    "collect_deterministics",
     "evaluate_model",
     "evaluate_model_transformed",
     "evaluate_model_posterior_predictive",
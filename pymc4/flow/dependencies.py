@@ -0,0 +1,160 @@
+"""Find which random variables the distributions of a model depend on.
+
+When a model is evaluated in a graph, e.g. inside a ``tf.function``, from a state created
+with ``record_dependencies=True``, the executor records the parents of every distribution
+in :attr:`pymc4.flow.SamplingState.dependencies`: the variables whose values the
+parameters of the distribution are computed from. They are found by walking the graph
+back from the parameters of the distribution until the values of the variables in the
+state. Tensors have no such provenance in eager mode, where :func:`model_dependencies`
+evaluates the model in a graph to record them.
+
+A :class:`DependencyGraph` answers the common questions asked to this DAG, like the
+variables needed to compute others, or the variables whose log probability changes when
+the value of a variable changes.
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple
+
+import tensorflow as tf
+
+
+__all__ = ["DependencyGraph", "tensor_parents", "model_dependencies"]
+
+
+class DependencyGraph:
+    """The DAG of the random variables of a model.
+
+    Parameters
+    ----------
+    parents : Mapping[str, Sequence[str]]
+        The parents of every variable, in the order the variables were evaluated.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def model():
+    ...     mu = yield pm.Normal("mu", 0, 1)
+    ...     sigma = yield pm.HalfNormal("sigma", 1)
+    ...     x = yield pm.Normal("x", mu, sigma)
+    ...     yield pm.Normal("y", x, 1, observed=0.0)
+    >>> graph = pm.flow.model_dependencies(model())
+    >>> graph.parents["model/x"]
+    ('model/mu', 'model/sigma')
+    >>> sorted(graph.markov_blanket("model/mu"))
+    ['model/sigma', 'model/x']
+    >>> graph.ancestors(["model/y"])
+    ['model/mu', 'model/sigma', 'model/x']
+    """
+
+    def __init__(self, parents: Mapping[str, Sequence[str]]):
+        self.parents: Dict[str, Tuple[str, ...]] = {
+            name: tuple(names) for name, names in parents.items()
+        }
+        self.children: Dict[str, Tuple[str, ...]] = {name: () for name in self.parents}
+        for name, names in self.parents.items():
+            for parent in names:
+                self.children[parent] = self.children.get(parent, ()) + (name,)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.parents)
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    def __contains__(self, name: Any) -> bool:
+        return name in self.parents
+
+    def _closure(self, names: Iterable[str], edges: Dict[str, Tuple[str, ...]]) -> Set[str]:
+        found: Set[str] = set()
+        stack = [name for name in names]
+        while stack:
+            for other in edges.get(stack.pop(), ()):
+                if other not in found:
+                    found.add(other)
+                    stack.append(other)
+        return found
+
+    def ancestors(self, names: Iterable[str]) -> List[str]:
+        """Return the variables that ``names`` depend on, in evaluation order.
+
+        These are the only variables needed to compute ``names``, e.g. to draw them from
+        the posterior predictive.
+        """
+        found = self._closure(names, self.parents)
+        return [name for name in self.parents if name in found]
+
+    def descendants(self, names: Iterable[str]) -> List[str]:
+        """Return the variables that depend on ``names``, in evaluation order."""
+        found = self._closure(names, self.children)
+        return [name for name in self.parents if name in found]
+
+    def markov_blanket(self, name: str) -> Set[str]:
+        """Return the parents, the children and the parents of the children of a variable.
+
+        Given its Markov blanket, a variable is independent of the other variables, so
+        only the blanket is needed to update the variable in a Gibbs step.
+        """
+        blanket = set(self.parents[name]) | set(self.children[name])
+        for child in self.children[name]:
+            blanket.update(self.parents[child])
+        blanket.discard(name)
+        return blanket
+
+    def log_prob_terms(self, names: Iterable[str]) -> List[str]:
+        """Return the variables whose log probability changes with the values of ``names``.
+
+        These are ``names`` and their children, in evaluation order.
+        """
+        names = set(names)
+        affected = set(names)
+        for name in names:
+            affected.update(self.children.get(name, ()))
+        return [name for name in self.parents if name in affected]
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.parents)
+
+
+def tensor_parents(tensors: Sequence[Any], names: Mapping[Any, str]) -> Tuple[str, ...]:
+    """Find the named tensors that ``tensors`` are computed from.
+
+    ``names`` maps the references (see ``tf.Tensor.ref``) of the named tensors to their
+    names. The graph is walked back from ``tensors``, up to the named tensors, so eager
+    tensors are only found if they are named themselves.
+    """
+    found = set()
+    seen = set()
+    stack = [tensor for tensor in tensors if tf.is_tensor(tensor)]
+    while stack:
+        tensor = stack.pop()
+        name = names.get(tensor.ref())
+        if name is not None:
+            found.add(name)
+        elif not isinstance(tensor, tf.Variable):
+            # eager tensors have no op
+            op = getattr(tensor, "op", None)
+            if op is not None and op not in seen:
+                seen.add(op)
+                stack.extend(op.inputs)
+    return tuple(sorted(found))
+
+
+def model_dependencies(model: Any, observed: Optional[Dict[str, Any]] = None) -> DependencyGraph:
+    """Evaluate a model in a graph and return its :class:`DependencyGraph`.
+
+    The free variables are sampled, so the model should not depend on their values
+    through Python control flow.
+    """
+    # imported here since the executors are created in `pymc4.flow`
+    from pymc4.flow import SamplingState, evaluate_model
+
+    parents: Dict[str, Tuple[str, ...]] = dict()
+
+    def evaluate():
+        state = SamplingState(observed_values=observed, record_dependencies=True)
+        _, state = evaluate_model(model, state=state)
+        parents.update(state.dependencies)
+        return []
+
+    tf.function(evaluate, autograph=False).get_concrete_function()
+    return DependencyGraph(parents)
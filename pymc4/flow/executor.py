@@ -1,15 +1,19 @@
 import types
-from typing import Any, Tuple, Dict, Union, List, Optional, Set, Mapping
+from typing import Any, Tuple, Dict, Union, List, Optional, Set, Mapping, Sequence
 from collections import ChainMap
 import itertools
 
 import tensorflow as tf
+import tensorflow_probability as tfp
 
 import pymc4 as pm
 from pymc4 import coroutine_model
 from pymc4 import scopes
 from pymc4 import utils
+from pymc4.data import MinibatchData, ShardedData
 from pymc4.distributions import distribution
+from pymc4.flow.dependencies import DependencyGraph, tensor_parents
+from pymc4.flow.fusion import fused_log_prob
 
 
 ModelType = Union[types.GeneratorType, coroutine_model.Model]
@@ -104,6 +108,9 @@ class SamplingState:
         "distributions",
         "potentials",
         "deterministics",
+        "minibatches",
+        "dependencies",
+        "record_dependencies",
     )
 
     def __init__(
@@ -115,19 +122,24 @@ class SamplingState:
         potentials: List[distribution.Potential] = None,
         deterministics: Dict[str, Any] = None,
         posterior_predictives: Optional[Set[str]] = None,
+        minibatches: Dict[str, Any] = None,
+        dependencies: Dict[str, Tuple[str, ...]] = None,
+        *,
+        copy: bool = True,
+        record_dependencies: bool = False,
     ) -> None:
         # verbose __init__
         if transformed_values is None:
             transformed_values = dict()
-        else:
+        elif copy:
             transformed_values = transformed_values.copy()
         if untransformed_values is None:
             untransformed_values = dict()
-        else:
+        elif copy:
             untransformed_values = untransformed_values.copy()
         if observed_values is None:
             observed_values = dict()
-        else:
+        elif copy:
             observed_values = observed_values.copy()
         if distributions is None:
             distributions = dict()
@@ -145,6 +157,14 @@ class SamplingState:
             posterior_predictives = set()
         else:
             posterior_predictives = posterior_predictives.copy()
+        if minibatches is None:
+            minibatches = dict()
+        else:
+            minibatches = minibatches.copy()
+        if dependencies is None:
+            dependencies = dict()
+        else:
+            dependencies = dependencies.copy()
         self.transformed_values = transformed_values
         self.untransformed_values = untransformed_values
         self.observed_values = observed_values
@@ -156,16 +176,70 @@ class SamplingState:
         self.potentials = potentials
         self.deterministics = deterministics
         self.posterior_predictives = posterior_predictives
+        # the minibatch data of the variables observed on batches, see `pymc4.Minibatch`
+        self.minibatches = minibatches
+        # the parents of the distributions evaluated in a graph, see `pymc4.flow.dependencies`
+        self.dependencies = dependencies
+        self.record_dependencies = record_dependencies
+
+    def dependency_graph(self) -> DependencyGraph:
+        """Return the DAG of the distributions of the state.
+
+        It is only recorded when the model is evaluated in a graph from a state created with
+        ``record_dependencies=True``, see :func:`pymc4.flow.model_dependencies`.
+        """
+        return DependencyGraph(self.dependencies)
 
     def collect_log_prob_elemwise(self):
+        # the distributions of the same family share a single `log_prob` call
+        log_probs = fused_log_prob(
+            [
+                (name, dist, self.all_values[name])
+                for name, dist in self.distributions.items()
+                if name not in self.minibatches
+                and not isinstance(self.all_values[name], ShardedData)
+            ]
+        )
         return itertools.chain(
-            (dist.log_prob(self.all_values[name]) for name, dist in self.distributions.items()),
+            (
+                log_probs[name] if name in log_probs else self.scaled_log_prob(name, dist)
+                for name, dist in self.distributions.items()
+            ),
             (p.value for p in self.potentials),
         )
 
+    def scaled_log_prob(self, name: str, dist: distribution.Distribution):
+        value = self.all_values[name]
+        if isinstance(value, ShardedData):
+            # out-of-core data, accumulated chunk by chunk
+            log_prob = value.reduce_log_prob(dist)
+        else:
+            log_prob = dist.log_prob(value)
+        if name in self.minibatches:
+            # rescale the log probability of a batch to the one of the whole data
+            log_prob = log_prob * self.minibatches[name].scale
+        return log_prob
+
     def collect_log_prob(self):
         return sum(map(tf.reduce_sum, self.collect_log_prob_elemwise()))
 
+    def collect_log_prob_parts(self):
+        """Split the log probability into the prior and the likelihood.
+
+        The prior is the log probability of the free variables, including the log Jacobian
+        determinants of their transformations, and the likelihood is the log probability of
+        the observed variables and of the potentials.
+        """
+        prior = []
+        likelihood = []
+        for name, dist in self.distributions.items():
+            part = likelihood if name in self.observed_values else prior
+            part.append(tf.reduce_sum(self.scaled_log_prob(name, dist)))
+        for potential in self.potentials:
+            part = prior if isinstance(potential, distribution.JacobianPotential) else likelihood
+            part.append(tf.reduce_sum(potential.value))
+        return sum(prior), sum(likelihood)
+
     def collect_unreduced_log_prob(self):
         return sum(self.collect_log_prob_elemwise())
 
@@ -212,7 +286,11 @@ class SamplingState:
 
     @classmethod
     def from_values(
-        cls, values: Dict[str, Any] = None, observed_values: Dict[str, Any] = None
+        cls,
+        values: Dict[str, Any] = None,
+        observed_values: Dict[str, Any] = None,
+        *,
+        record_dependencies: bool = False,
     ) -> "SamplingState":
         if values is None:
             return cls(observed_values=observed_values)
@@ -225,7 +303,12 @@ class SamplingState:
                 transformed_values[fullname] = values[fullname]
             else:
                 untransformed_values[fullname] = values[fullname]
-        return cls(transformed_values, untransformed_values, observed_values)
+        return cls(
+            transformed_values,
+            untransformed_values,
+            observed_values,
+            record_dependencies=record_dependencies,
+        )
 
     def clone(self) -> "SamplingState":
         return self.__class__(
@@ -236,6 +319,9 @@ class SamplingState:
             potentials=self.potentials,
             deterministics=self.deterministics,
             posterior_predictives=self.posterior_predictives,
+            minibatches=self.minibatches,
+            dependencies=self.dependencies,
+            record_dependencies=self.record_dependencies,
         )
 
     def as_sampling_state(self) -> "Tuple[SamplingState, List[str]]":
@@ -291,11 +377,73 @@ class SamplingState:
                 transformed_values=transformed_values,
                 untransformed_values=untransformed_values,
                 observed_values=observed_values,
+                minibatches={
+                    name: data for name, data in self.minibatches.items() if name in observed_values
+                },
             ),
             need_to_transform_after,
         )
 
 
+class StateLayout:
+    """The names of the free variables of a model, parsed once to build its sampling states.
+
+    :meth:`SamplingState.from_values` parses every name to split the transformed and the
+    untransformed values, and the state copies the dictionaries it is built from. The
+    functions that evaluate a model at many values build the states from a layout instead,
+    which splits a list of values by precomputed indices into dictionaries owned by the new
+    state.
+
+    Parameters
+    ----------
+    names : Sequence[str]
+        The names of the values, in the order they are passed to :meth:`state`.
+    """
+
+    __slots__ = ("names", "transformed", "untransformed", "untransformed_names")
+
+    def __init__(self, names: Sequence[str]):
+        self.names = tuple(names)
+        self.transformed: List[Tuple[int, str]] = []
+        self.untransformed: List[Tuple[int, str]] = []
+        # the untransformed names of the transformed values
+        self.untransformed_names: List[str] = []
+        for index, name in enumerate(self.names):
+            namespec = utils.NameParts.from_name(name)
+            if namespec.is_transformed:
+                self.transformed.append((index, name))
+                self.untransformed_names.append(namespec.full_untransformed_name)
+            else:
+                self.untransformed.append((index, name))
+
+    def state(
+        self,
+        values: Sequence[Any],
+        observed_values: Dict[str, Any],
+        *,
+        record_dependencies: bool = False,
+    ) -> SamplingState:
+        """Create the sampling state of ``values``, given in the order of :attr:`names`."""
+        return SamplingState(
+            transformed_values={name: values[index] for index, name in self.transformed},
+            untransformed_values={name: values[index] for index, name in self.untransformed},
+            # the executor removes the observed values of the variables that are not observed
+            observed_values=dict(observed_values),
+            copy=False,
+            record_dependencies=record_dependencies,
+        )
+
+    def deterministics(self, state: SamplingState) -> List[Any]:
+        """Return the deterministics of an evaluated state.
+
+        These are the deterministics of the model followed by the untransformed values of
+        the transformed variables.
+        """
+        deterministics = list(state.deterministics.values())
+        deterministics.extend(state.untransformed_values[name] for name in self.untransformed_names)
+        return deterministics
+
+
 # when we make changes in a subclass we usually call super() that will require self to be present in signature
 # therefore it is convenient to disable inspection about static methods
 
@@ -332,6 +480,7 @@ class SamplingExecutor:
         values: Dict[str, Any] = None,
         observed: Dict[str, Any] = None,
         sample_shape: Union[int, Tuple[int], tf.TensorShape] = (),
+        seed: Any = None,
     ) -> Tuple[Any, SamplingState]:
         # this will be dense with comments as all interesting stuff is composed in here
 
@@ -484,14 +633,19 @@ class SamplingExecutor:
                     elif isinstance(dist, distribution.Distribution):
                         try:
                             return_value, state = self.proceed_distribution(
-                                dist, state, sample_shape=sample_shape
+                                dist, state, sample_shape=sample_shape, seed=seed
                             )
+                            self.record_dependencies(dist, state)
                         except EvaluationError as error:
                             control_flow.throw(error)
                             raise StopExecution(StopExecution.NOT_HELD_ERROR_MESSAGE) from error
                     elif isinstance(dist, MODEL_TYPES):
                         return_value, state = self.evaluate_model(
-                            dist, state=state, _validate_state=False, sample_shape=sample_shape
+                            dist,
+                            state=state,
+                            _validate_state=False,
+                            sample_shape=sample_shape,
+                            seed=seed,
                         )
                     else:
                         err = EvaluationError(
@@ -529,6 +683,25 @@ class SamplingExecutor:
 
     __call__ = evaluate_model
 
+    def record_dependencies(self, dist: distribution.Distribution, state: SamplingState):
+        """Record the variables the parameters of a distribution are computed from.
+
+        This walks the graph back from every parameter, so it is only done for the states
+        created with ``record_dependencies=True``. Tensors only know what they are computed
+        from in a graph, so nothing is recorded in eager mode.
+        """
+        if not state.record_dependencies or tf.executing_eagerly():
+            return
+        scoped_name = scopes.variable_name(dist.name)
+        names = {
+            value.ref(): name
+            for name, value in itertools.chain(
+                state.untransformed_values.items(), state.observed_values.items()
+            )
+            if tf.is_tensor(value) and name != scoped_name
+        }
+        state.dependencies[scoped_name] = tensor_parents(tf.nest.flatten(dist.conditions), names)
+
     def new_state(
         self, values: Dict[str, Any] = None, observed: Dict[str, Any] = None
     ) -> SamplingState:
@@ -551,6 +724,7 @@ class SamplingExecutor:
         dist: distribution.Distribution,
         state: SamplingState,
         sample_shape: Union[int, Tuple[int], tf.TensorShape] = None,
+        seed: Any = None,
     ) -> Tuple[Any, SamplingState]:
         # TODO: docs
         if dist.is_anonymous:
@@ -558,6 +732,7 @@ class SamplingExecutor:
         scoped_name = scopes.variable_name(dist.name)
         if scoped_name is None:
             raise EvaluationError("Attempting to create an anonymous Distribution")
+        seed = variable_seed(seed, scoped_name)
 
         if scoped_name in state.distributions or scoped_name in state.deterministics:
             raise EvaluationError(
@@ -578,10 +753,12 @@ class SamplingExecutor:
                     # posterior predictive
                     if dist.is_root:
                         return_value = state.untransformed_values[scoped_name] = dist.sample(
-                            sample_shape=sample_shape
+                            sample_shape=sample_shape, seed=seed
                         )
                     else:
-                        return_value = state.untransformed_values[scoped_name] = dist.sample()
+                        return_value = state.untransformed_values[scoped_name] = dist.sample(
+                            seed=seed
+                        )
                 else:
                     # replace observed variable with a custom one
                     return_value = state.untransformed_values[scoped_name]
@@ -603,10 +780,10 @@ class SamplingExecutor:
         else:
             if dist.is_root:
                 return_value = state.untransformed_values[scoped_name] = dist.sample(
-                    sample_shape=sample_shape
+                    sample_shape=sample_shape, seed=seed
                 )
             else:
-                return_value = state.untransformed_values[scoped_name] = dist.sample()
+                return_value = state.untransformed_values[scoped_name] = dist.sample(seed=seed)
         state.distributions[scoped_name] = dist
         return return_value, state
 
@@ -667,10 +844,40 @@ class SamplingExecutor:
         return return_value, state
 
 
+def variable_seed(seed: Any, scoped_name: str) -> Optional[tf.Tensor]:
+    """Derive the stateless seed of a single variable from the seed of a model evaluation.
+
+    The variable seed only depends on ``seed`` and on the scoped name of the variable, so a
+    variable gets the same draws whatever the other variables of the model are, and in
+    whatever order they are evaluated.
+
+    Parameters
+    ----------
+    seed : Any
+        The stateless seed of the evaluation, a shape ``[2]`` integer tensor, or ``None``.
+    scoped_name : str
+        The full name of the variable.
+
+    Returns
+    -------
+    Optional[tf.Tensor]
+        The stateless seed of the variable, or ``None`` if ``seed`` is ``None``.
+    """
+    if seed is None:
+        return None
+    return tfp.random.sanitize_seed(seed, salt=scoped_name)
+
+
 def observed_value_in_evaluation(
     scoped_name: str, dist: distribution.Distribution, state: SamplingState
 ):
-    return state.observed_values.get(scoped_name, dist.model_info["observed"])
+    value = state.observed_values.get(scoped_name, dist.model_info["observed"])
+    if isinstance(value, MinibatchData):
+        # the variable is observed on the current batch, keep track of its minibatch data to
+        # rescale its log probability and to evaluate the model again on other batches
+        state.minibatches[scoped_name] = value
+        value = value.value
+    return value
 
 
 def assert_values_compatible_with_distribution(
@@ -795,4 +1002,7 @@ def get_observed_tensor_shape(arr: Any) -> tf.TensorShape:
     TypeError
         When ``arr`` does not have a ``shape`` attribute.
     """
+    if isinstance(arr, ShardedData):
+        # do not read the whole data
+        return tf.TensorShape(arr.shape)
     return tf.convert_to_tensor(arr).shape
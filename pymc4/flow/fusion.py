@@ -0,0 +1,140 @@
+"""Evaluate the log probability of distributions of the same family in a single call.
+
+A model with many small variables of the same family, e.g. hundreds of scalar Normal
+variables, creates a handful of tiny operations for every one of them when its log
+probability is collected. :func:`fused_log_prob` groups the distributions that can share
+a single call of ``log_prob``: distributions of the same TFP class and dtype, with scalar
+events, the same parametrization and the same options. The parameters of every
+distribution of a group are broadcast to the shape of its value and flattened, the
+parameters and values of the group are concatenated, and the log probability of the
+concatenated distribution is split back into the log probabilities of the variables.
+
+The distributions created with ``batch_stack`` are fused through the distribution they
+stack, while those with ``event_stack`` or ``reinterpreted_batch_ndims``, events of a
+higher rank, shapes that are not static or a custom ``log_prob`` are evaluated on their
+own.
+"""
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import tensorflow as tf
+from tensorflow_probability import distributions as tfd
+
+from pymc4.distributions import distribution
+from pymc4.distributions.batchstack import BatchStacker
+
+
+__all__ = ["fused_log_prob", "fusion_key"]
+
+
+def base_distribution(dist: distribution.Distribution) -> tfd.Distribution:
+    base = dist._distribution
+    if isinstance(base, BatchStacker):
+        # the stacked distribution broadcasts against the value
+        base = base.distribution
+    return base
+
+
+def tensor_parameters(base: tfd.Distribution) -> Optional[Dict[str, tf.Tensor]]:
+    """Return the tensor parameters of a distribution, ``None`` if some are not scalar."""
+    parameters = dict()
+    for name, properties in type(base).parameter_properties().items():
+        if base.parameters.get(name) is None:
+            continue
+        if properties.event_ndims != 0 or not hasattr(base, name):
+            return None
+        parameters[name] = tf.convert_to_tensor(getattr(base, name))
+    return parameters
+
+
+def flatten(value: tf.Tensor, shape: tf.TensorShape) -> tf.Tensor:
+    """Broadcast ``value`` to ``shape`` and flatten it."""
+    if value.shape != shape:
+        value = tf.broadcast_to(value, shape)
+    return value if shape.rank == 1 else tf.reshape(value, [-1])
+
+
+def fusion_key(dist: distribution.Distribution, value: Any) -> Optional[Hashable]:
+    """Return the key of the group of distributions ``dist`` can be fused with.
+
+    ``None`` means that the distribution can not be fused.
+    """
+    if type(dist).log_prob is not distribution.Distribution.log_prob:
+        return None
+    base = base_distribution(dist)
+    if isinstance(base, (tfd.Independent, tfd.Sample)) or base.event_shape != []:
+        return None
+    if not (base.batch_shape.is_fully_defined() and value.shape.is_fully_defined()):
+        return None
+    try:
+        properties = type(base).parameter_properties()
+    except NotImplementedError:
+        return None
+    options = []
+    for name, option in sorted(base.parameters.items()):
+        if name == "name" or name in properties:
+            continue
+        if tf.is_tensor(option) or not isinstance(option, Hashable):
+            return None
+        options.append((name, option))
+    parametrization = tuple(
+        sorted(name for name in properties if base.parameters.get(name) is not None)
+    )
+    return type(base), base.dtype, parametrization, tuple(options)
+
+
+def fused_log_prob(
+    items: Sequence[Tuple[str, distribution.Distribution, Any]]
+) -> Dict[str, tf.Tensor]:
+    """Compute the log probabilities of the values of distributions, fusing compatible ones.
+
+    Parameters
+    ----------
+    items : Sequence[Tuple[str, Distribution, Any]]
+        The name, the distribution and the value of every variable.
+
+    Returns
+    -------
+    Dict[str, tf.Tensor]
+        The log probability of the value of every variable, as ``dist.log_prob(value)``.
+    """
+    groups: Dict[Hashable, List[Tuple[str, distribution.Distribution, tf.Tensor]]] = dict()
+    log_probs = dict()
+    for name, dist, value in items:
+        value = tf.convert_to_tensor(value, dtype=dist.dtype)
+        key = fusion_key(dist, value)
+        if key is None:
+            log_probs[name] = dist.log_prob(value)
+        else:
+            groups.setdefault(key, []).append((name, dist, value))
+    for (cls, _, _, options), group in groups.items():
+        parameters = [tensor_parameters(base_distribution(dist)) for _, dist, _ in group]
+        if len(group) == 1 or any(part is None for part in parameters):
+            log_probs.update((name, dist.log_prob(value)) for name, dist, value in group)
+            continue
+        shapes = [
+            tf.broadcast_static_shape(value.shape, base_distribution(dist).batch_shape)
+            for _, dist, value in group
+        ]
+        # the scalar variables are stacked and unstacked by single operations
+        scalars = [i for i, shape in enumerate(shapes) if shape.rank == 0]
+        tensors = [i for i, shape in enumerate(shapes) if shape.rank != 0]
+
+        def concat(parts):
+            pieces = [tf.stack([parts[i] for i in scalars])] if scalars else []
+            pieces.extend(flatten(parts[i], shapes[i]) for i in tensors)
+            return tf.concat(pieces, axis=0) if len(pieces) > 1 else pieces[0]
+
+        fused = cls(
+            **{name: concat([part[name] for part in parameters]) for name in parameters[0]},
+            **dict(options),
+        )
+        log_prob = fused.log_prob(concat([value for _, _, value in group]))
+        sizes = [len(scalars)] if scalars else []
+        sizes.extend(shapes[i].num_elements() for i in tensors)
+        pieces = tf.split(log_prob, sizes) if len(sizes) > 1 else [log_prob]
+        if scalars:
+            scalar_log_probs = tf.unstack(pieces.pop(0))
+            log_probs.update((group[i][0], part) for i, part in zip(scalars, scalar_log_probs))
+        for i, part in zip(tensors, pieces):
+            log_probs[group[i][0]] = part if shapes[i].rank == 1 else tf.reshape(part, shapes[i])
+    return log_probs
@@ -0,0 +1,282 @@
+"""Compile a model to a static intermediate representation.
+
+Every evaluation of a model drives its coroutines through the executor: generators are
+resumed, distributions are modified, transformed and checked, and names are scoped. A
+log probability function pays this Python overhead every time it is traced, e.g. once
+for the value and once more for its vectorized and compiled variants.
+
+:func:`build_model_ir` evaluates a model once with :func:`pymc4.flow.evaluate_meta_model`
+to find its variables, their shapes and transforms, and traces the evaluation of the
+model once more into graphs that take the values of the free variables and the observed
+values as inputs. A :class:`ModelIR` calls these graphs directly, so evaluating the log
+probability or the deterministics from it does not run the model again. Only the log
+probability is traced up front: the deterministics and the :class:`VariableNode` metadata,
+whose parents are found by walking the graph, are traced the first time they are needed.
+
+Models whose structure depends on the values of their variables, e.g. through Python
+control flow on the values, can not be traced with symbolic inputs: in that case, as well
+as for minibatches and sharded data, :func:`build_model_ir` returns ``None`` and the model
+should be evaluated by the executor.
+"""
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+import numpy as np
+import tensorflow as tf
+
+from pymc4 import utils
+from pymc4.coroutine_model import Model
+from pymc4.data import MinibatchData, ShardedData
+from pymc4.distributions import distribution
+from pymc4.flow.executor import SamplingState, StateLayout
+
+
+__all__ = ["VariableNode", "ModelIR", "build_model_ir", "collect_deterministics"]
+
+
+class VariableNode(NamedTuple):
+    """A random variable of a :class:`ModelIR`.
+
+    ``name`` is the full name of the variable and ``transformed_name`` the name of its
+    value in the unconstrained space, ``None`` if it is not transformed. ``parents`` are
+    the names of the variables the parameters of its distribution are computed from.
+    """
+
+    name: str
+    distribution: Type[distribution.Distribution]
+    transformed_name: Optional[str]
+    shape: tf.TensorShape
+    dtype: tf.DType
+    observed: bool
+    parents: Tuple[str, ...]
+
+
+class ModelIR:
+    """The variables of a model and its compiled log probability and deterministics.
+
+    Build it with :func:`build_model_ir`. The values of the free variables are passed in
+    the order of ``value_names`` and the observed values in the order of
+    ``observed_names``. ``trace_variables`` and ``trace_deterministics`` trace the model
+    again, the first time :attr:`variables` and the deterministics are accessed.
+    """
+
+    def __init__(
+        self,
+        value_names: List[str],
+        observed_names: List[str],
+        log_prob_function: Any,
+        trace_variables: Callable[[], Dict[str, VariableNode]],
+        trace_deterministics: Callable[[], Tuple[List[str], Any]],
+    ):
+        self.value_names = value_names
+        self.observed_names = observed_names
+        self.log_prob_function = log_prob_function
+        self._trace_variables = trace_variables
+        self._trace_deterministics = trace_deterministics
+        self._variables: Optional[Dict[str, VariableNode]] = None
+        self._deterministics: Optional[Tuple[List[str], Any]] = None
+
+    @property
+    def variables(self) -> Dict[str, VariableNode]:
+        if self._variables is None:
+            self._variables = self._trace_variables()
+        return self._variables
+
+    @property
+    def deterministic_names(self) -> List[str]:
+        return self._traced_deterministics()[0]
+
+    @property
+    def deterministics_function(self) -> Any:
+        return self._traced_deterministics()[1]
+
+    def _traced_deterministics(self):
+        if self._deterministics is None:
+            self._deterministics = self._trace_deterministics()
+        return self._deterministics
+
+    @property
+    def value_specs(self) -> List[tf.TensorSpec]:
+        return self.log_prob_function.structured_input_signature[0][0]
+
+    @property
+    def observed_specs(self) -> List[tf.TensorSpec]:
+        return self.log_prob_function.structured_input_signature[0][1]
+
+    def as_inputs(self, values: Sequence[Any], observed: Dict[str, Any]) -> Optional[Tuple]:
+        """Convert values and observed values to the inputs of the compiled functions.
+
+        Return ``None`` if they do not match the signature the model was compiled for.
+        """
+        if len(values) != len(self.value_names):
+            return None
+        values = [tf.convert_to_tensor(value) for value in values]
+        if not all(spec.is_compatible_with(value) for spec, value in zip(self.value_specs, values)):
+            return None
+        observed_values = []
+        for name, spec in zip(self.observed_names, self.observed_specs):
+            value = tf.cast(observed[name], spec.dtype)
+            if not spec.shape.is_compatible_with(value.shape):
+                return None
+            observed_values.append(value)
+        return values, observed_values
+
+    def log_prob(self, values: Sequence[Any], observed: Dict[str, Any]) -> tf.Tensor:
+        """Compute the log probability of the model, summed over all the variables."""
+        return self.log_prob_function(*self._checked_inputs(values, observed))
+
+    def deterministics(self, values: Sequence[Any], observed: Dict[str, Any]) -> List[tf.Tensor]:
+        """Compute the deterministics of the model, in the order of ``deterministic_names``."""
+        return self.deterministics_function(*self._checked_inputs(values, observed))
+
+    def _checked_inputs(self, values, observed):
+        inputs = self.as_inputs(values, observed)
+        if inputs is None:
+            raise ValueError(
+                "The values do not match the signature {} the model was compiled for".format(
+                    self.value_specs
+                )
+            )
+        return inputs
+
+    def __repr__(self):
+        return "{}(value_names={}, observed_names={})".format(
+            self.__class__.__name__, self.value_names, self.observed_names
+        )
+
+
+def collect_deterministics(state: SamplingState) -> Dict[str, Any]:
+    """Return the deterministics of an evaluated state.
+
+    The untransformed values of the transformed variables are deterministics of the
+    transformed values.
+    """
+    deterministics = dict(state.deterministics)
+    for transformed_name in state.transformed_values:
+        untransformed_name = utils.NameParts.from_name(transformed_name).full_untransformed_name
+        deterministics[untransformed_name] = state.untransformed_values[untransformed_name]
+    return deterministics
+
+
+def static_shape(value: Any) -> tf.TensorShape:
+    return value.shape if tf.is_tensor(value) else tf.TensorShape(np.shape(value))
+
+
+@tf.autograph.experimental.do_not_convert
+def build_model_ir(
+    model: Model, value_names: Sequence[str], observed: Dict[str, Any]
+) -> Optional[ModelIR]:
+    """Compile a model to a :class:`ModelIR`.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+        The model to compile.
+    value_names : Sequence[str]
+        The names of the free variables in the sampling state of the model, the
+        transformed names for the transformed variables.
+    observed : Dict[str, Any]
+        The observed values of the model, ``None`` for the observed variables that are
+        free variables instead.
+
+    Returns
+    -------
+    Optional[ModelIR]
+        ``None`` if the model can not be compiled, in which case it should be evaluated
+        by the executor.
+    """
+    # imported here since the executors are created in `pymc4.flow`
+    from pymc4.flow import evaluate_meta_model, evaluate_model_transformed
+
+    if any(isinstance(value, (MinibatchData, ShardedData)) for value in observed.values()):
+        return None
+    try:
+        _, meta = evaluate_meta_model(model, observed=dict(observed))
+        sampling_state, _ = meta.as_sampling_state()
+    except Exception:
+        # the executor will raise the error again with the full context
+        return None
+    if meta.minibatches:
+        return None
+    value_names = list(value_names)
+    observed_names = [name for name, value in observed.items() if value is not None]
+    suppressed = {name: None for name, value in observed.items() if value is None}
+    if set(value_names) != set(sampling_state.all_unobserved_values) or set(observed_names) != set(
+        sampling_state.observed_values
+    ):
+        return None
+    value_specs = []
+    for name in value_names:
+        value = sampling_state.all_unobserved_values[name]
+        value_specs.append(tf.TensorSpec(static_shape(value), value.dtype))
+    observed_specs = []
+    for name in observed_names:
+        value = observed[name]
+        observed_specs.append(tf.TensorSpec(static_shape(value), meta.distributions[name].dtype))
+    if not all(spec.shape.is_fully_defined() for spec in value_specs + observed_specs):
+        return None
+
+    layout = StateLayout(value_names)
+
+    def evaluate(values, observed_values, record_dependencies=False):
+        st = layout.state(
+            values,
+            dict(zip(observed_names, observed_values), **suppressed),
+            record_dependencies=record_dependencies,
+        )
+        _, st = evaluate_model_transformed(model, state=st)
+        if set(st.distributions) != set(meta.distributions):
+            raise TypeError("The variables of the model depend on the values of the variables")
+        return st
+
+    def log_prob_fn(values, observed_values):
+        return evaluate(values, observed_values).collect_log_prob()
+
+    def trace(fn):
+        return tf.function(fn, autograph=False).get_concrete_function(value_specs, observed_specs)
+
+    def trace_variables():
+        variables: Dict[str, VariableNode] = dict()
+        transformed_names = {
+            untransformed_name: name
+            for (_, name), untransformed_name in zip(layout.transformed, layout.untransformed_names)
+        }
+
+        def variables_fn(values, observed_values):
+            st = evaluate(values, observed_values, record_dependencies=True)
+            for name, dist in st.distributions.items():
+                variables[name] = VariableNode(
+                    name=name,
+                    distribution=type(dist),
+                    transformed_name=transformed_names.get(name),
+                    shape=static_shape(meta.all_values[name]),
+                    dtype=dist.dtype,
+                    observed=name in st.observed_values,
+                    parents=st.dependencies[name],
+                )
+            return []
+
+        trace(variables_fn)
+        return variables
+
+    def trace_deterministics():
+        deterministic_names: List[str] = []
+
+        def deterministics_fn(values, observed_values):
+            st = evaluate(values, observed_values)
+            deterministic_names.extend(list(st.deterministics) + layout.untransformed_names)
+            return layout.deterministics(st)
+
+        return deterministic_names, trace(deterministics_fn)
+
+    try:
+        log_prob_function = trace(log_prob_fn)
+    except (TypeError, tf.errors.OperatorNotAllowedInGraphError):
+        # data dependent control flow, see the module docstring
+        return None
+    return ModelIR(
+        value_names=value_names,
+        observed_names=observed_names,
+        log_prob_function=log_prob_function,
+        trace_variables=trace_variables,
+        trace_deterministics=trace_deterministics,
+    )
@@ -31,6 +31,7 @@ class MetaSamplingExecutor(TransformedSamplingExecutor):
         dist: distribution.Distribution,
         state: SamplingState,
         sample_shape: Union[int, Tuple[int], tf.TensorShape] = None,
+        seed: Any = None,
     ) -> Tuple[Any, SamplingState]:
         if dist.is_anonymous:
             raise EvaluationError("Attempting to create an anonymous Distribution")
@@ -7,7 +7,7 @@ import functools
 
 
 from typing import Mapping, Any
-from pymc4 import scopes, distributions
+from pymc4 import scopes
 from pymc4.distributions import distribution
 from pymc4.distributions.transforms import JacobianPreference
 from pymc4.flow.executor import (
@@ -61,7 +61,7 @@ def make_untransformed_model(dist, transform, state):
             transform.inverse_log_det_jacobian, sampled_transformed_value
         )
         coef = 1.0
-    yield distributions.Potential(potential_fn, coef=coef)
+    yield distribution.JacobianPotential(potential_fn, coef=coef)
     # 3. return value to the user
     return sampled_untransformed_value
 
@@ -97,7 +97,7 @@ def make_transformed_model(dist, transform, state):
             transform.inverse_log_det_jacobian, state.transformed_values[transformed_scoped_name]
         )
         coef = 1.0
-    yield distributions.Potential(potential_fn, coef=coef)
+    yield distribution.JacobianPotential(potential_fn, coef=coef)
     # 3. final return+yield will return untransformed_value
     # as it is stored in state.values
     # Note: we need yield here to make another checks on name duplicates, etc
@@ -12,6 +12,7 @@ from pymc4.flow import (
     evaluate_model_posterior_predictive,
     evaluate_meta_posterior_predictive_model,
 )
+from pymc4.inference.sampling import stateless_seed
 from pymc4.inference.utils import trace_to_arviz
 from pymc4.flow.executor import assert_values_compatible_with_distribution_shape
 
@@ -30,6 +31,7 @@ def sample_prior_predictive(
     var_names: Optional[Union[str, List[str]]] = None,
     state: Optional[SamplingState] = None,
     use_auto_batching: bool = True,
+    seed: Optional[int] = None,
 ) -> InferenceData:
     """
     Draw ``sample_shape`` values from the model for the desired ``var_names``.
@@ -69,6 +71,11 @@ def sample_prior_predictive(
         vectorized, then you can set this to ``False``, and your sampling should be faster than
         the auto batched counterpart. If you are not sure if your model is vectorized, then auto
         batching will safely sample from it but with some additional overhead.
+    seed: Optional[int]
+        The seed of the draws, an integer or a stateless seed. Every variable is drawn with a
+        stateless seed derived from it, the name of the variable and, with auto batching, the
+        index of the draw, so the same seed always gives the same draws and the first draws
+        do not depend on ``sample_shape``. If ``None``, the draws are not reproducible.
 
     Returns
     -------
@@ -101,6 +108,13 @@ def sample_prior_predictive(
     >>> [v.shape for v in prior_samples.prior_predictive.values()]
     [(1, 20, 3), (1, 20, 3)]
 
+    Passing a seed makes the draws reproducible
+
+    >>> first = sample_prior_predictive(model(), sample_shape=5, seed=42).prior_predictive
+    >>> second = sample_prior_predictive(model(), sample_shape=5, seed=42).prior_predictive
+    >>> np.array_equal(first["model/sd"], second["model/sd"])
+    True
+
     If we only wanted to draw samples from unobserved variables we would have done the following
 
     >>> prior_samples = sample_prior_predictive(model(), sample_from_observed=False)
@@ -171,6 +185,8 @@ def sample_prior_predictive(
     """
     if isinstance(sample_shape, int):
         sample_shape = (sample_shape,)
+    if seed is not None:
+        seed = stateless_seed(seed)
 
     # Do a single forward pass to establish the distributions, deterministics and observeds
     _, state = evaluate_meta_model(model, state=state)
@@ -202,14 +218,15 @@ def sample_prior_predictive(
 
     # If we don't have to auto-batch, then we can simply evaluate the model
     if not use_auto_batching:
-        _, state = evaluate_model(model, observed=observed, sample_shape=sample_shape)
+        _, state = evaluate_model(model, observed=observed, sample_shape=sample_shape, seed=seed)
         all_values = collections.ChainMap(state.all_values, state.deterministics)
         return trace_to_arviz(prior_predictive={k: all_values[k].numpy() for k in var_names})
 
     # Setup the function that makes a single draw
     @tf.function(autograph=False)
     def single_draw(index):
-        _, state = evaluate_model(model, observed=observed)
+        draw_seed = None if seed is None else tf.random.experimental.stateless_fold_in(seed, index)
+        _, state = evaluate_model(model, observed=observed, seed=draw_seed)
         return tuple(
             state.untransformed_values[k]
             if k in state.untransformed_values
@@ -236,6 +253,7 @@ def sample_posterior_predictive(
     observed: Optional[Dict[str, Any]] = None,
     use_auto_batching: bool = True,
     inplace: bool = True,
+    seed: Optional[int] = None,
 ) -> InferenceData:
     """
     Draw ``sample_shape`` values from the model for the desired ``var_names``.
@@ -263,6 +281,11 @@ def sample_posterior_predictive(
     inplace: If True (default) it will add a posterior_predictive group to the provided ``trace``,
         instead of returning a new InferenceData object. If a posterior_predictive group is already
         present in ``trace`` it will be overwritten.
+    seed: Optional[int]
+        The seed of the draws, an integer or a stateless seed. Every variable is drawn with a
+        stateless seed derived from it, the name of the variable and, with auto batching, the
+        chain and draw of the posterior sample, so the draws of a posterior sample do not
+        depend on the other samples in ``trace``. If ``None``, the draws are not reproducible.
 
     Returns
     -------
@@ -301,6 +324,8 @@ def sample_posterior_predictive(
         raise ValueError("Supplied an empty var_names list to sample from")
     if isinstance(var_names, str):
         var_names = [var_names]
+    if seed is not None:
+        seed = stateless_seed(seed)
 
     # If we don't have to deal with auto-batching we can simply evaluate_model
     # passing the trace as values
@@ -312,7 +337,7 @@ def sample_posterior_predictive(
         # observed conditionally independent variables
         sample_shape = (trace.posterior.sizes["chain"], trace.posterior.sizes["draw"])
         _, state = evaluate_model_posterior_predictive(
-            model, values=values, observed=observed, sample_shape=sample_shape
+            model, values=values, observed=observed, sample_shape=sample_shape, seed=seed
         )
         all_values = collections.ChainMap(state.all_values, state.deterministics)
         if var_names is None:
@@ -391,11 +416,24 @@ def sample_posterior_predictive(
         batched_val = tf.broadcast_to(v.values, batch_shape + core_shape)
         flattened_posterior.append(tf.reshape(batched_val, shape=[-1] + core_shape.as_list()))
     posterior_vars = list(posterior)
+    # The coordinates of every flattened batch element, e.g. its chain and draw, that are
+    # folded in the seed of the element
+    coordinates = np.reshape(
+        np.indices(batch_shape.as_list(), dtype="int32"),
+        (len(batch_shape), batch_shape.num_elements()),
+    ).T
     # Setup the function that makes a single draw
     @tf.function(autograph=False)
     def single_draw(elems):
+        elems, coordinate = elems
         values = dict(zip(posterior_vars, elems))
-        _, st = evaluate_model_posterior_predictive(model, values=values, observed=observed)
+        draw_seed = seed
+        if seed is not None:
+            for i in range(len(batch_shape)):
+                draw_seed = tf.random.experimental.stateless_fold_in(draw_seed, coordinate[i])
+        _, st = evaluate_model_posterior_predictive(
+            model, values=values, observed=observed, seed=draw_seed
+        )
         return tuple(
             [
                 (
@@ -410,7 +448,7 @@ def sample_posterior_predictive(
         )
 
     # Make draws in parallel across the batch elements with tf.vectorized_map
-    samples = tf.vectorized_map(single_draw, flattened_posterior)
+    samples = tf.vectorized_map(single_draw, (flattened_posterior, coordinates))
     # Convert the samples to ndarrays and make a dictionary with the correct
     # batch_shape + core_shape
     output = dict()
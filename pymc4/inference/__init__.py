@@ -1,2 +1,14 @@
 from . import utils
+from . import cache
+from . import storage
+from . import checkpoint
+from . import adaptation
+from . import step_methods
+from . import diagnostics
+from . import progress
+from . import parallel
 from . import sampling
+from . import smc
+from . import batched
+from . import benchmark
+from . import incremental
@@ -0,0 +1,318 @@
+"""Windowed mass matrix (metric) adaptation for the NUTS sampler.
+
+Badly scaled posteriors force NUTS to take tiny step sizes and very long trajectories.
+Preconditioning the Hamiltonian dynamics with a mass matrix that matches the posterior
+covariance removes most of that cost. This module estimates the mass matrix during
+``burn_in`` following Stan's windowed scheme:
+
+1. a fast initial window, where only the step size is adapted,
+2. a series of slow windows of doubling length, at the end of each one the mass matrix is
+   set from the (regularized) covariance of the draws of that window, and the dual
+   averaging of the step size is restarted,
+3. a fast terminal window, where the step size is adapted to the final mass matrix.
+"""
+import collections
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+from tensorflow_probability import mcmc
+
+tfd = tfp.distributions
+
+
+__all__ = ["MassMatrixAdaptation", "MassMatrixAdaptationResults", "adaptation_windows"]
+
+
+MASS_MATRIX_KINDS = ("diag", "dense")
+
+
+MassMatrixAdaptationResults = collections.namedtuple(
+    "MassMatrixAdaptationResults",
+    ["inner_results", "step", "count", "mean", "m2", "momentum_scale"],
+)
+
+
+def adaptation_windows(
+    num_adaptation_steps: int, init_buffer: int = 75, term_buffer: int = 50, base_window: int = 25
+) -> Tuple[int, List[int]]:
+    """Compute the slow adaptation windows of Stan's windowed adaptation scheme.
+
+    Parameters
+    ----------
+    num_adaptation_steps : int
+        The number of burn in steps.
+    init_buffer : int
+        The number of steps of the initial fast window.
+    term_buffer : int
+        The number of steps of the terminal fast window.
+    base_window : int
+        The length of the first slow window. Each following window doubles in length, and
+        the last one is stretched up to the terminal window.
+
+    Returns
+    -------
+    start : int
+        The step where the first slow window starts.
+    ends : List[int]
+        The steps where each slow window ends, and the mass matrix is updated.
+
+    Examples
+    --------
+    >>> adaptation_windows(1000)
+    (75, [100, 150, 250, 450, 950])
+    >>> adaptation_windows(100)
+    (15, [90])
+    """
+    if init_buffer + base_window + term_buffer > num_adaptation_steps:
+        init_buffer = int(0.15 * num_adaptation_steps)
+        term_buffer = int(0.1 * num_adaptation_steps)
+        base_window = num_adaptation_steps - init_buffer - term_buffer
+    stop = num_adaptation_steps - term_buffer
+    ends: List[int] = []
+    if base_window <= 0:
+        return init_buffer, ends
+    start, window = init_buffer, base_window
+    while start < stop:
+        end = start + window
+        if end + 2 * window > stop:
+            end = stop
+        ends.append(end)
+        start, window = end, 2 * window
+    return init_buffer, ends
+
+
+def flatten_state(state_parts: Sequence[tf.Tensor]) -> tf.Tensor:
+    """Concatenate the state parts of the chains into a ``(num_chains, size)`` tensor."""
+    return tf.concat(
+        [tf.reshape(part, tf.concat([tf.shape(part)[:1], [-1]], 0)) for part in state_parts],
+        axis=-1,
+    )
+
+
+def unflatten_state(flat: tf.Tensor, like: Sequence[tf.Tensor]) -> List[tf.Tensor]:
+    """Split a flat state back into parts with the shapes of the ``like`` state parts."""
+    sizes = [int(np.prod(part.shape[1:])) for part in like]
+    return [
+        tf.reshape(part, tf.shape(like_part))
+        for part, like_part in zip(tf.split(flat, sizes, axis=-1), like)
+    ]
+
+
+def _replace_innermost(results, **kwargs):
+    if all(hasattr(results, name) for name in kwargs):
+        return results._replace(**kwargs)
+    return results._replace(inner_results=_replace_innermost(results.inner_results, **kwargs))
+
+
+class MassMatrixAdaptation(mcmc.TransitionKernel):
+    """Adapt the mass matrix of a preconditioned NUTS sampler during the burn in.
+
+    The inner kernel runs on a single flat state part of shape ``(num_chains, size)`` built
+    by concatenating the (flattened) state parts, so that a dense mass matrix can couple
+    all the variables. The estimate is pooled across the chains (each chain's draws are
+    centered on their own mean), so many short chains still give a stable estimate. The
+    momentum distribution of the sampler is rebuilt from plain tensors held in the kernel
+    results at each step, so the results can be carried over between segments and
+    checkpointed.
+
+    Parameters
+    ----------
+    target_log_prob_fn : Callable
+        The log probability of the state parts, batched over the chains.
+    make_inner_kernel : Callable
+        Build the step size adaptation kernel from a target log probability function of the
+        flat state. It should return a ``tfp.mcmc.DualAveragingStepSizeAdaptation`` wrapping
+        a ``tfp.experimental.mcmc.PreconditionedNoUTurnSampler``, whose dual averaging is
+        restarted each time the mass matrix is updated.
+    num_adaptation_steps : int
+        The number of burn in steps.
+    kind : str
+        Either ``"diag"`` to adapt a diagonal mass matrix or ``"dense"`` to adapt a full
+        one, which captures the correlations between the variables at a cost that grows
+        quadratically with their total size.
+    init_buffer, term_buffer, base_window : int
+        The window configuration, see :func:`adaptation_windows`.
+    regularization : float
+        The estimated covariance is shrunk towards ``regularization`` times the identity
+        by an amount that decreases with the number of draws in the window.
+    """
+
+    def __init__(
+        self,
+        target_log_prob_fn: Callable,
+        make_inner_kernel: Callable[[Callable], mcmc.TransitionKernel],
+        num_adaptation_steps: int,
+        kind: str = "diag",
+        init_buffer: int = 75,
+        term_buffer: int = 50,
+        base_window: int = 25,
+        regularization: float = 1e-3,
+    ):
+        if kind not in MASS_MATRIX_KINDS:
+            raise ValueError(
+                "Unknown mass matrix kind {!r}, use one of {}".format(kind, MASS_MATRIX_KINDS)
+            )
+        self._target_log_prob_fn = target_log_prob_fn
+        self._make_inner_kernel = make_inner_kernel
+        self._num_adaptation_steps = num_adaptation_steps
+        self._kind = kind
+        self._regularization = regularization
+        self._window_start, self._window_ends = adaptation_windows(
+            num_adaptation_steps, init_buffer, term_buffer, base_window
+        )
+        self._parameters = dict(
+            target_log_prob_fn=target_log_prob_fn,
+            make_inner_kernel=make_inner_kernel,
+            num_adaptation_steps=num_adaptation_steps,
+            kind=kind,
+            init_buffer=init_buffer,
+            term_buffer=term_buffer,
+            base_window=base_window,
+            regularization=regularization,
+        )
+
+    @property
+    def parameters(self):
+        return self._parameters
+
+    @property
+    def is_calibrated(self):
+        return True
+
+    def inner_kernel(self, state_parts: Sequence[tf.Tensor]) -> mcmc.TransitionKernel:
+        """Build the inner kernel that runs on the flattened ``state_parts``."""
+
+        def flat_target_log_prob_fn(flat):
+            return self._target_log_prob_fn(*unflatten_state(flat, state_parts))
+
+        return self._make_inner_kernel(flat_target_log_prob_fn)
+
+    def momentum_distribution(self, flat: tf.Tensor, momentum_scale: tf.Tensor):
+        """Build the momentum distribution of the chains from the adapted ``momentum_scale``."""
+        loc = tf.zeros_like(flat)
+        if self._kind == "diag":
+            momentum = tfd.MultivariateNormalDiag(loc=loc, scale_diag=momentum_scale)
+        else:
+            momentum = tfd.MultivariateNormalTriL(loc=loc, scale_tril=momentum_scale)
+        # the sampler expects a distribution over the list of state parts
+        return tfd.JointDistributionSequential([momentum])
+
+    def one_step(self, current_state, previous_kernel_results, seed=None):
+        flat = flatten_state(current_state)
+        inner_results = _replace_innermost(
+            previous_kernel_results.inner_results,
+            momentum_distribution=self.momentum_distribution(
+                flat, previous_kernel_results.momentum_scale
+            ),
+        )
+        [flat], inner_results = self.inner_kernel(current_state).one_step(
+            [flat], inner_results, seed=seed
+        )
+        inner_results = _replace_innermost(inner_results, momentum_distribution=())
+
+        step = previous_kernel_results.step
+        in_window = (step >= self._window_start) & (
+            step < (self._window_ends[-1] if self._window_ends else 0)
+        )
+        count = previous_kernel_results.count + tf.cast(in_window, tf.int32)
+        delta = flat - previous_kernel_results.mean
+        mean = tf.where(
+            in_window,
+            previous_kernel_results.mean + delta / tf.cast(tf.maximum(count, 1), flat.dtype),
+            previous_kernel_results.mean,
+        )
+        if self._kind == "diag":
+            update = delta * (flat - mean)
+        else:
+            update = delta[..., :, None] * (flat - mean)[..., None, :]
+        m2 = tf.where(in_window, previous_kernel_results.m2 + update, previous_kernel_results.m2)
+
+        window_end = tf.reduce_any(
+            tf.equal(step + 1, tf.constant(self._window_ends, dtype=tf.int32))
+        )
+        momentum_scale = tf.where(
+            window_end,
+            self._estimate_momentum_scale(count, m2),
+            previous_kernel_results.momentum_scale,
+        )
+        inner_results = self._restart_step_size_adaptation(inner_results, window_end, step + 1)
+        return (
+            unflatten_state(flat, current_state),
+            MassMatrixAdaptationResults(
+                inner_results=inner_results,
+                step=step + 1,
+                count=tf.where(window_end, tf.zeros_like(count), count),
+                mean=tf.where(window_end, tf.zeros_like(mean), mean),
+                m2=tf.where(window_end, tf.zeros_like(m2), m2),
+                momentum_scale=momentum_scale,
+            ),
+        )
+
+    def refresh_results(self, state, kernel_results, refresh):
+        """Recompute the inner results at ``state``, keeping the adaptation state.
+
+        ``refresh`` is called with the inner kernel, its results and the flat state.
+        """
+        flat = flatten_state(state)
+        inner_results = _replace_innermost(
+            kernel_results.inner_results,
+            momentum_distribution=self.momentum_distribution(flat, kernel_results.momentum_scale),
+        )
+        inner_results = refresh(self.inner_kernel(state), inner_results, [flat])
+        inner_results = _replace_innermost(inner_results, momentum_distribution=())
+        return kernel_results._replace(inner_results=inner_results)
+
+    def bootstrap_results(self, init_state):
+        flat = flatten_state(init_state)
+        inner_results = self.inner_kernel(init_state).bootstrap_results([flat])
+        inner_results = _replace_innermost(inner_results, momentum_distribution=())
+        size = flat.shape[-1]
+        if self._kind == "diag":
+            m2 = tf.zeros_like(flat)
+            momentum_scale = tf.ones([size], dtype=flat.dtype)
+        else:
+            m2 = tf.zeros(tf.concat([tf.shape(flat), [size]], 0), dtype=flat.dtype)
+            momentum_scale = tf.eye(size, dtype=flat.dtype)
+        return MassMatrixAdaptationResults(
+            inner_results=inner_results,
+            step=tf.constant(0, dtype=tf.int32),
+            count=tf.constant(0, dtype=tf.int32),
+            mean=tf.zeros_like(flat),
+            m2=m2,
+            momentum_scale=momentum_scale,
+        )
+
+    def _estimate_momentum_scale(self, count, m2):
+        # the within chain covariances are averaged across the chains, and regularized as in Stan
+        n = tf.cast(count, m2.dtype)
+        covariance = tf.reduce_mean(m2, axis=0) / tf.maximum(n - 1.0, 1.0)
+        shrinkage = self._regularization * 5.0 / (n + 5.0)
+        covariance = n / (n + 5.0) * covariance
+        if self._kind == "diag":
+            return tf.math.rsqrt(covariance + shrinkage)
+        size = covariance.shape[-1]
+        covariance = covariance + shrinkage * tf.eye(size, dtype=covariance.dtype)
+        # the momentum is distributed as N(0, inv(covariance))
+        eye = tf.eye(size, dtype=covariance.dtype)
+        return tf.linalg.cholesky(tf.linalg.cholesky_solve(tf.linalg.cholesky(covariance), eye))
+
+    def _restart_step_size_adaptation(self, results, restart, step):
+        # restart the dual averaging of the step size once the mass matrix changes, biasing
+        # its exploration towards ten times the current step size
+        step_sizes = tf.nest.flatten(results.new_step_size)
+        return results._replace(
+            step=tf.where(restart, 0, results.step),
+            num_adaptation_steps=tf.where(
+                restart, self._num_adaptation_steps - step, results.num_adaptation_steps
+            ),
+            error_sum=[tf.where(restart, tf.zeros_like(e), e) for e in results.error_sum],
+            log_averaging_step=[
+                tf.where(restart, tf.zeros_like(s), s) for s in results.log_averaging_step
+            ],
+            log_shrinkage_target=[
+                tf.where(restart, np.log(10.0) + tf.math.log(s), target)
+                for s, target in zip(step_sizes, results.log_shrinkage_target)
+            ],
+        )
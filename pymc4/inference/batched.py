@@ -0,0 +1,216 @@
+"""Fit the same model to many datasets in a single compiled sampler.
+
+:func:`sample_many` stacks datasets with the same schema along a leading axis and runs the
+chains of all of them as a single batch: the log probability of every chain is evaluated
+on its own dataset with ``tf.vectorized_map``, and the whole run is one ``tf.function``, so
+the model is traced once instead of once per dataset. Since the posteriors of the datasets
+can have very different scales, the step size is adapted separately for every chain.
+"""
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import arviz as az
+import tensorflow as tf
+
+from pymc4.coroutine_model import Model
+from pymc4.data import ShardedData
+from pymc4.inference.adaptation import flatten_state, unflatten_state
+from pymc4.inference.sampling import (
+    initialize_state,
+    make_logp_and_deterministic_functions,
+    sample_chain,
+    stateless_seed,
+    tile_init,
+)
+from pymc4.inference.step_methods import CompoundStep, ReplicaExchange, StepMethod, as_step_method
+from pymc4.inference.utils import trace_to_arviz
+
+
+__all__ = ["sample_many"]
+
+
+def sample_many(
+    model: Model,
+    datasets: Sequence[Dict[str, Any]],
+    num_samples: int = 1000,
+    num_chains: int = 4,
+    burn_in: int = 100,
+    step_size: float = 0.1,
+    step: Optional[StepMethod] = None,
+    seed: Optional[int] = None,
+    xla: bool = False,
+    stack: bool = False,
+) -> Union[List[az.InferenceData], az.InferenceData]:
+    """Sample the posterior of a model for each one of many datasets in a single run.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+        The model to sample the posteriors of.
+    datasets : Sequence[Dict[str, Any]]
+        The observed values of every dataset, keyed by the names of the observed variables
+        of the model. All the datasets must set the same variables, with the same shapes.
+        The other observed values of the model are shared by all the datasets.
+    num_samples : int
+        The number of draws of each chain.
+    num_chains : int
+        The number of chains of each dataset.
+    burn_in : int
+        The number of burn in steps, during which the step size is adapted.
+    step_size : float
+        The initial step size.
+    step : Optional[StepMethod]
+        The step method, see :mod:`pymc4.inference.step_methods`. It must update all the
+        variables. Defaults to NUTS.
+    seed : Optional[int]
+        The seed of the run, see :func:`pymc4.inference.sampling.sample`.
+    xla : bool
+        Compile the run with XLA.
+    stack : bool
+        If ``True``, return a single InferenceData object whose variables have an extra
+        ``dataset`` dimension after the ``chain`` and ``draw`` ones.
+
+    Returns
+    -------
+    List[az.InferenceData] or az.InferenceData
+        One InferenceData object per dataset, or a single one if ``stack`` is ``True``.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def model():
+    ...     mu = yield pm.Normal("mu", 0, 10)
+    ...     yield pm.Normal("y", mu, 1, observed=np.zeros(10, "float32"))
+    >>> datasets = [{"model/y": np.full(10, i, "float32")} for i in range(1, 4)]
+    >>> traces = pm.sample_many(model(), datasets, num_samples=100, burn_in=100)
+    >>> [float(trace.posterior["model/mu"].mean().round()) for trace in traces]
+    [1.0, 2.0, 3.0]
+    >>> trace = pm.sample_many(model(), datasets, num_samples=100, stack=True)
+    >>> trace.posterior["model/mu"].dims
+    ('chain', 'draw', 'dataset')
+    """
+    if not datasets:
+        raise ValueError("There are no datasets to sample")
+    names = list(datasets[0])
+    for i, dataset in enumerate(datasets):
+        if set(dataset) != set(names):
+            raise ValueError(
+                "All the datasets must set the observed values of {}, dataset {} sets "
+                "{}".format(sorted(names), i, sorted(dataset))
+            )
+    state_, deterministic_names, suppressed_observed = initialize_state(
+        model, observed=dict(datasets[0])
+    )
+    unknown = [name for name in names if name not in state_.observed_values]
+    if unknown:
+        raise ValueError(
+            "The datasets set {}, which are not observed variables of the model {}".format(
+                unknown, sorted(state_.observed_values)
+            )
+        )
+    if state_.minibatches or any(
+        isinstance(value, ShardedData) for value in state_.observed_values.values()
+    ):
+        raise ValueError("`sample_many` does not support minibatches or sharded data")
+    stacked = dict()
+    for name in names:
+        values = [np.asarray(dataset[name]) for dataset in datasets]
+        if len({value.shape for value in values}) > 1:
+            raise ValueError(
+                "The observed values of {!r} have different shapes in different datasets: "
+                "{}".format(name, sorted({value.shape for value in values}))
+            )
+        stacked[name] = tf.constant(np.stack(values), dtype=state_.observed_values[name].dtype)
+    shared = {k: v for k, v in state_.observed_values.items() if k not in stacked}
+    shared.update({name: None for name in suppressed_observed})
+
+    unobserved_keys = list(state_.all_unobserved_values)
+    step = as_step_method(step, unobserved_keys)
+    if isinstance(step, (CompoundStep, ReplicaExchange)):
+        raise ValueError("`sample_many` needs a single step method that updates all the variables")
+    num_datasets = len(datasets)
+    num_draws = num_datasets * num_chains
+    init = tile_init(list(state_.all_unobserved_values.values()), num_draws)
+    sizes = [int(np.prod(part.shape[1:])) for part in init]
+
+    @tf.function(autograph=False)
+    def evaluate(values, observed):
+        logpfn, deterministics_callback = make_logp_and_deterministic_functions(
+            model, unobserved_keys, dict(shared, **observed)
+        )
+        return logpfn(*values), deterministics_callback(*values)
+
+    def batched(index, observed, like):
+        # the chains run on a single flat state part, so that a step size of shape
+        # [num_chains, 1] broadcasts against it, and every chain is evaluated on its own dataset
+        def batched_fn(flat):
+            state = unflatten_state(flat, like)
+            if num_draws == 1:
+                result = evaluate(
+                    [part[0] for part in state], {k: v[0] for k, v in observed.items()}
+                )
+                return tf.nest.map_structure(lambda value: value[None], result[index])
+            return tf.vectorized_map(lambda elems: evaluate(*elems)[index], (state, observed))
+
+        return batched_fn
+
+    @tf.function(autograph=False, jit_compile=xla)
+    def run_chains(init, step_size, observed, seed):
+        observed = {k: tf.repeat(v, num_chains, axis=0) for k, v in observed.items()}
+        deterministics_fn = batched(1, observed, init)
+        kernel = step.make_kernel(batched(0, observed, init), step_size, burn_in)
+
+        def trace_fn(current_state, pkr):
+            deterministics = deterministics_fn(*current_state) if deterministic_names else []
+            return current_state[0], step.sample_stats(pkr), deterministics
+
+        _, trace, _ = sample_chain(
+            num_samples,
+            current_state=[flatten_state(init)],
+            kernel=kernel,
+            num_burnin_steps=burn_in,
+            trace_fn=trace_fn,
+            seed=seed,
+        )
+        return trace
+
+    # the step size is adapted separately for every chain
+    step_size = tf.fill([num_draws, 1], tf.cast(step_size, init[0].dtype))
+    flat, stats, deterministics = run_chains(init, step_size, stacked, stateless_seed(seed))
+
+    def split(value, shape=None):
+        # split the batch of chains into [num_samples, num_datasets, num_chains, ...]
+        value = np.asarray(value)
+        shape = value.shape[2:] if shape is None else shape
+        return value.reshape((num_samples, num_datasets, num_chains) + tuple(shape))
+
+    posterior = {
+        k: split(v, part.shape[1:])
+        for k, v, part in zip(
+            unobserved_keys, np.split(flat.numpy(), np.cumsum(sizes)[:-1], -1), init
+        )
+    }
+    posterior.update({k: split(v) for k, v in zip(deterministic_names, deterministics)})
+    sampler_stats = {k: split(v) for k, v in zip(step.stat_names, stats)}
+    observed_data = {k: v for k, v in shared.items() if v is not None}
+
+    if stack:
+        stacked_names = list(posterior) + list(sampler_stats) + names
+        # move the chains first: [num_chains, num_samples, num_datasets, ...]
+        return az.from_dict(
+            posterior={k: np.moveaxis(v, 2, 0) for k, v in posterior.items()},
+            sample_stats={k: np.moveaxis(v, 2, 0) for k, v in sampler_stats.items()},
+            observed_data=dict(observed_data, **{k: v.numpy() for k, v in stacked.items()}),
+            coords={"dataset": np.arange(num_datasets)},
+            dims={name: ["dataset"] for name in stacked_names},
+        )
+    return [
+        trace_to_arviz(
+            {k: tf.convert_to_tensor(v[:, i]) for k, v in posterior.items()},
+            {k: tf.convert_to_tensor(v[:, i]) for k, v in sampler_stats.items()},
+            observed_data=dict(observed_data, **{k: v[i].numpy() for k, v in stacked.items()}),
+        )
+        for i in range(num_datasets)
+    ]
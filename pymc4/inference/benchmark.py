@@ -0,0 +1,224 @@
+"""Measure the cost of evaluating the log probability of a model and its gradient.
+
+:func:`benchmark_model` times the pieces of the work done at every step of ``pm.sample``
+separately from the sampler itself:
+
+- ``executor``: a forward pass of the model through the executor, which is the Python
+  overhead paid every time the model is traced.
+- ``logp/<mode>`` and ``logp_and_gradient/<mode>``: the log probability of a single
+  chain, and its value and gradient, with ``<mode>`` one of ``eager``, ``graph`` (a
+  ``tf.function``) or ``xla`` (a ``tf.function`` compiled with XLA).
+- ``chains/<batching>/<mode>``: the value and gradient over ``num_chains`` chains, either
+  auto batched with ``tf.vectorized_map`` or manually batched by the model itself (see
+  ``use_auto_batching`` in ``pm.sample``), in the compiled modes.
+
+The functions are called once before they are timed, so the latencies exclude tracing
+and compilation, while ``traces`` counts how many times a compiled function was traced:
+more than one trace means that it is traced again on every call.
+"""
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import time
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from pymc4 import flow
+from pymc4.coroutine_model import Model
+from pymc4.inference.sampling import (
+    initialize_state,
+    make_logp_and_deterministic_functions,
+    tile_init,
+    vectorize_logp_function,
+)
+
+
+__all__ = ["Timing", "benchmark_model", "benchmark_functions"]
+
+
+MODES = ("eager", "graph", "xla")
+BATCHING = ("auto", "manual")
+
+
+class Timing(NamedTuple):
+    """The latencies of a benchmarked function, in seconds.
+
+    ``traces`` is the number of times a compiled function was traced, ``None`` in eager
+    mode.
+    """
+
+    mean: float
+    p50: float
+    p90: float
+    p99: float
+    repeats: int
+    traces: Optional[int]
+
+
+def compile_function(fn: Callable, mode: str) -> Callable:
+    """Return ``fn`` as it runs in the ``eager``, ``graph`` or ``xla`` mode."""
+    if mode == "eager":
+        return fn
+    if mode == "graph":
+        return tf.function(fn, autograph=False)
+    if mode == "xla":
+        return tf.function(fn, autograph=False, jit_compile=True)
+    raise ValueError("Unknown mode {!r}, use any of {}".format(mode, MODES))
+
+
+def benchmark_functions(
+    model: Model,
+    num_chains: int = 10,
+    modes: Sequence[str] = MODES,
+    batching: Sequence[str] = ("auto",),
+    observed: Optional[Dict[str, Any]] = None,
+    state: Optional[flow.SamplingState] = None,
+) -> Dict[str, Tuple[Callable, List[Any]]]:
+    """Build the functions timed by :func:`benchmark_model` and their arguments.
+
+    Returns a dictionary mapping the names of the benchmarks to a function and the list
+    of its arguments, the initial values of the free variables.
+    """
+    for mode in modes:
+        compile_function(lambda: None, mode)
+    unknown = set(batching) - set(BATCHING)
+    if unknown:
+        raise ValueError("Unknown batching {}, use any of {}".format(sorted(unknown), BATCHING))
+    state_, _, suppressed_observed = initialize_state(model, observed=observed, state=state)
+    observed_values = dict(state_.observed_values)
+    observed_values.update({name: None for name in suppressed_observed})
+    unobserved_keys = list(state_.all_unobserved_values)
+    init = list(state_.all_unobserved_values.values())
+
+    def executor(*values):
+        st = flow.SamplingState.from_values(
+            dict(zip(unobserved_keys, values)), observed_values=observed_values
+        )
+        _, st = flow.evaluate_model_transformed(model, state=st)
+        return st.collect_log_prob()
+
+    logpfn, _ = make_logp_and_deterministic_functions(model, unobserved_keys, observed_values)
+
+    def logp_and_gradient(*values):
+        return tfp.math.value_and_gradient(logpfn, list(values))
+
+    functions: Dict[str, Tuple[Callable, List[Any]]] = {"executor": (executor, init)}
+    for mode in modes:
+        functions["logp/{}".format(mode)] = (compile_function(logpfn, mode), init)
+    for mode in modes:
+        functions["logp_and_gradient/{}".format(mode)] = (
+            compile_function(logp_and_gradient, mode),
+            init,
+        )
+    chains_init = tile_init(init, num_chains)
+    for kind in batching:
+        if kind == "auto":
+            batched_logpfn = vectorize_logp_function(tf.function(logpfn, autograph=False))
+        else:
+            batched_logpfn, _ = make_logp_and_deterministic_functions(
+                model,
+                unobserved_keys,
+                observed_values,
+                num_chains=num_chains,
+                collect_reduced_log_prob=False,
+            )
+
+        def batched_logp_and_gradient(*values, batched_logpfn=batched_logpfn):
+            return tfp.math.value_and_gradient(batched_logpfn, list(values))
+
+        for mode in modes:
+            if mode != "eager":
+                functions["chains/{}/{}".format(kind, mode)] = (
+                    compile_function(batched_logp_and_gradient, mode),
+                    chains_init,
+                )
+    return functions
+
+
+def time_function(fn: Callable, args: Sequence[Any], repeats: int) -> Timing:
+    """Time ``repeats`` calls of ``fn`` after a first call that traces it."""
+
+    def call():
+        # converting the results to numpy waits for the computation to finish
+        tf.nest.map_structure(lambda value: np.asarray(value), fn(*args))
+
+    call()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    traces = (
+        fn.experimental_get_tracing_count()
+        if hasattr(fn, "experimental_get_tracing_count")
+        else None
+    )
+    return Timing(
+        mean=float(np.mean(latencies)),
+        p50=float(p50),
+        p90=float(p90),
+        p99=float(p99),
+        repeats=repeats,
+        traces=traces,
+    )
+
+
+def benchmark_model(
+    model: Model,
+    num_chains: int = 10,
+    repeats: int = 100,
+    modes: Sequence[str] = MODES,
+    batching: Sequence[str] = ("auto",),
+    observed: Optional[Dict[str, Any]] = None,
+    state: Optional[flow.SamplingState] = None,
+) -> Dict[str, Timing]:
+    """Time the log probability of a model and its gradient, see :mod:`pymc4.inference.benchmark`.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+        The model to benchmark, evaluated at the initial values used by ``pm.sample``.
+    num_chains : int
+        The number of chains of the batched benchmarks.
+    repeats : int
+        The number of timed calls of every function.
+    modes : Sequence[str]
+        The modes to run the functions in, among ``"eager"``, ``"graph"`` and ``"xla"``.
+    batching : Sequence[str]
+        How to batch the chains, among ``"auto"`` and ``"manual"``. Manual batching
+        requires a model that handles a leading chains axis, see ``use_auto_batching`` in
+        ``pm.sample``.
+    observed : Optional[Dict[str, Any]]
+        Override the observed values of the model.
+    state : Optional[pymc4.flow.SamplingState]
+        Alternative way to pass the observed values.
+
+    Returns
+    -------
+    Dict[str, Timing]
+        The latencies of every benchmark, by name.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def model():
+    ...     mu = yield pm.Normal("mu", 0, 1)
+    ...     yield pm.Normal("y", mu, 1, observed=np.zeros(100, "float32"))
+    >>> timings = pm.benchmark_model(model(), repeats=5, modes=["eager", "graph"])
+    >>> list(timings)  # doctest: +NORMALIZE_WHITESPACE
+    ['executor', 'logp/eager', 'logp/graph', 'logp_and_gradient/eager',
+     'logp_and_gradient/graph', 'chains/auto/graph']
+    >>> timings["logp/graph"].traces
+    1
+    """
+    functions = benchmark_functions(
+        model,
+        num_chains=num_chains,
+        modes=modes,
+        batching=batching,
+        observed=observed,
+        state=state,
+    )
+    return {name: time_function(fn, args, repeats) for name, (fn, args) in functions.items()}
@@ -0,0 +1,271 @@
+"""Cache compiled sampling functions across ``pm.sample`` calls.
+
+Tracing the log probability of a model and the ``tf.function`` that runs the
+chains is often far more expensive than drawing a few hundred samples. When the
+same model structure is refit over and over on fresh data, the compiled
+functions can be reused as long as nothing that was baked into the graph
+changed. This module holds a small LRU cache for such functions and the helpers
+used to build the structural keys that index it.
+"""
+import collections
+import functools
+import hashlib
+import numbers
+from typing import Any, Callable, Collection, Dict, Hashable, Mapping, Optional, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+from pymc4.coroutine_model import Model
+
+
+__all__ = [
+    "CacheInfo",
+    "CompilationCache",
+    "UncacheableError",
+    "compilation_cache",
+    "lift_conditioners",
+]
+
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class UncacheableError(TypeError):
+    """Raised when a structural key can not be safely built for an object."""
+
+
+class CompilationCache:
+    """Least recently used cache of compiled sampling functions.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of compiled entries to keep. When a new entry is
+        added to a full cache, the least recently used entry is evicted.
+
+    Examples
+    --------
+    >>> cache = CompilationCache(maxsize=2)
+    >>> cache.get("a") is None
+    True
+    >>> cache.put("a", 1)
+    >>> cache.get("a")
+    1
+    >>> cache.info()
+    CacheInfo(hits=1, misses=1, maxsize=2, currsize=1)
+    """
+
+    def __init__(self, maxsize: int = 16):
+        if maxsize < 1:
+            raise ValueError("maxsize should be a positive integer, got {}".format(maxsize))
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "collections.OrderedDict[Hashable, Any]" = collections.OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the entry stored under ``key`` or ``None`` and update the counters."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Store ``value`` under ``key`` evicting the least recently used entries if needed."""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop all the entries and reset the hit and miss counters."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> CacheInfo:
+        """Return the cache statistics similar to ``functools.lru_cache``."""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __repr__(self):
+        return "{}(hits={hits}, misses={misses}, maxsize={maxsize}, currsize={currsize})".format(
+            self.__class__.__name__, **self.info()._asdict()
+        )
+
+
+def freeze(obj: Any) -> Hashable:
+    """Convert an arbitrary (possibly nested) object to a hashable structural key.
+
+    Arrays and eager tensors are keyed by their dtype, shape and a digest of their
+    content, containers are frozen recursively and other hashable objects are used
+    as they are.
+
+    Raises
+    ------
+    UncacheableError
+        If the object (or any of its nested members) can not be frozen safely.
+    """
+    if isinstance(obj, tf.Variable):
+        # variables are read when the graph runs, so their identity is enough
+        return ("variable", id(obj))
+    if isinstance(obj, (np.ndarray, np.generic)) or tf.is_tensor(obj):
+        if tf.is_tensor(obj):
+            if not hasattr(obj, "numpy"):
+                raise UncacheableError("Can not build a cache key for a symbolic tensor")
+            obj = obj.numpy()
+        obj = np.asarray(obj)
+        if obj.dtype == object:
+            raise UncacheableError("Can not build a cache key for an object array")
+        digest = hashlib.sha1(np.ascontiguousarray(obj).view(np.uint8)).hexdigest()
+        return ("array", str(obj.dtype), obj.shape, digest)
+    if isinstance(obj, (str, bytes, numbers.Number, type(None), tf.DType)):
+        return obj
+    if isinstance(obj, (tuple, list)):
+        return (type(obj).__name__,) + tuple(freeze(o) for o in obj)
+    if isinstance(obj, dict):
+        return ("dict",) + tuple(sorted(((freeze(k), freeze(v)) for k, v in obj.items()), key=repr))
+    if isinstance(obj, Model):
+        return model_key(obj)
+    try:
+        hash(obj)
+    except TypeError:
+        raise UncacheableError("Can not build a cache key for {!r}".format(type(obj)))
+    return obj
+
+
+def model_key(model: Model, lifted: Collection[str] = ()) -> Hashable:
+    """Build the structural key of a conditioned model.
+
+    Models created from a ``pm.model`` template are keyed by the template
+    function and their (frozen) conditioners. Other models can only be matched
+    by identity.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+    lifted : Collection[str]
+        The names of the conditioners that are fed to the compiled function as
+        inputs (see :func:`lift_conditioners`). These are only keyed by their
+        rank and dtype.
+    """
+    info = (model.name, model.model_info["keep_auxiliary"], model.model_info["keep_return"])
+    genfn = model.genfn
+    if isinstance(genfn, functools.partial):
+        args = [
+            rank_dtype(arg) if str(i) in lifted else freeze(arg) for i, arg in enumerate(genfn.args)
+        ]
+        kwargs = {
+            name: rank_dtype(arg) if name in lifted else freeze(arg)
+            for name, arg in (genfn.keywords or {}).items()
+        }
+        return ("model", genfn.func, tuple(args), freeze(kwargs)) + info
+    return ("model", model) + info
+
+
+def shape_dtype_key(values: Mapping[str, Any], relaxed: bool = False) -> Hashable:
+    """Key a mapping of tensors by their shapes (or only ranks if ``relaxed``) and dtypes."""
+    key = []
+    for name, value in values.items():
+        value = tf.convert_to_tensor(value)
+        if relaxed:
+            key.append((name, value.shape.rank, value.dtype.name))
+        else:
+            key.append((name, tuple(value.shape), value.dtype.name))
+    return tuple(key)
+
+
+def rank_dtype(value: Any) -> Hashable:
+    value = as_data_tensor(value)
+    return ("tensor", value.shape.rank, value.dtype.name)
+
+
+def is_data(value: Any) -> bool:
+    """Test if a conditioner holds data that can be fed to a compiled function as an input."""
+    if isinstance(value, np.ndarray):
+        return value.dtype != object
+    return tf.is_tensor(value) and not isinstance(value, tf.Variable) and hasattr(value, "numpy")
+
+
+def lift_conditioners(model: Model) -> Tuple[Dict[str, Any], Callable[[Mapping[str, Any]], Model]]:
+    """Split the array-like conditioners of a model from the rest of its template.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+        A model created by calling a ``pm.model`` template.
+
+    Returns
+    -------
+    conditioners : Dict[str, Any]
+        The array-like conditioners of the model converted to tensors. Positional
+        conditioners are named by their position and keyword conditioners by their
+        keyword. Floating point numpy arrays are converted to ``float32``, same as
+        TensorFlow does when they interact with the model's default ``float32`` values.
+    rebuild : Callable[[Mapping[str, Any]], pymc4.Model]
+        A function that conditions the model template again, using the supplied
+        (possibly symbolic) values for the lifted conditioners.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def regression(x, scale=1.0):
+    ...     b = yield pm.Normal("b", 0, 1)
+    ...     y = yield pm.Normal("y", b * x, scale)
+    >>> conditioners, rebuild = lift_conditioners(regression(np.ones(3)))
+    >>> list(conditioners)
+    ['0']
+    >>> rebuild({"0": np.zeros(5)}).name
+    'regression'
+    """
+    genfn = model.genfn
+    if not isinstance(genfn, functools.partial):
+        return {}, lambda conditioners: model
+    conditioners = dict()
+    for i, arg in enumerate(genfn.args):
+        if is_data(arg):
+            conditioners[str(i)] = as_data_tensor(arg)
+    for name, arg in (genfn.keywords or {}).items():
+        if is_data(arg):
+            conditioners[name] = as_data_tensor(arg)
+
+    def rebuild(values: Mapping[str, Any]) -> Model:
+        args = [values.get(str(i), arg) for i, arg in enumerate(genfn.args)]
+        kwargs = {name: values.get(name, arg) for name, arg in (genfn.keywords or {}).items()}
+        return Model(
+            functools.partial(genfn.func, *args, **kwargs),
+            name=model.name,
+            keep_auxiliary=model.model_info["keep_auxiliary"],
+            keep_return=model.model_info["keep_return"],
+        )
+
+    return conditioners, rebuild
+
+
+def as_data_tensor(value: Any) -> tf.Tensor:
+    if isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.floating):
+        return tf.convert_to_tensor(value, dtype=tf.float32)
+    return tf.convert_to_tensor(value)
+
+
+def relaxed_signature(values: Any) -> Any:
+    """Build a ``tf.TensorSpec`` structure that only fixes the ranks and dtypes of ``values``."""
+    return tf.nest.map_structure(
+        lambda value: tf.TensorSpec([None] * value.shape.rank, value.dtype),
+        tf.nest.map_structure(tf.convert_to_tensor, values),
+    )
+
+
+compilation_cache = CompilationCache()
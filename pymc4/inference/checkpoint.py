@@ -0,0 +1,127 @@
+"""Checkpoint and resume segmented ``pm.sample`` runs.
+
+A checkpoint holds everything that is needed to continue the chains of a segmented run
+exactly where they were left: the current positions, the final kernel results of the last
+segment (which include the adapted step size and the dual averaging state), the base
+stateless seed that the segment seeds are split from and the index of the next draw. The
+draws themselves are kept by a :class:`~pymc4.inference.storage.NpyTraceStore`, whose
+directory is recorded in the checkpoint.
+"""
+import os
+import pickle
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import tensorflow as tf
+
+
+__all__ = ["Checkpointer", "load_checkpoint", "validate_checkpoint_config"]
+
+
+CHECKPOINT_FILE = "checkpoint.pkl"
+
+
+def _map_leaves(fn, structure):
+    return tf.nest.map_structure(lambda leaf: None if leaf is None else fn(leaf), structure)
+
+
+class Checkpointer:
+    """Save the state of a segmented run after every ``every`` segments.
+
+    Instances are used as the ``segment_callback`` of
+    :func:`~pymc4.inference.sampling.sample_segmented`.
+
+    Parameters
+    ----------
+    directory : str
+        The directory where the checkpoint file is written.
+    config : Dict[str, Any]
+        The sampling configuration. It is validated against the arguments of a resumed run.
+    seed : Any
+        The base stateless seed of the run.
+    trace_directory : str
+        The directory of the :class:`~pymc4.inference.storage.NpyTraceStore` that holds the
+        draws.
+    every : int
+        Save a checkpoint every ``every`` segments. The last segment is always saved.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        config: Dict[str, Any],
+        seed: Any,
+        trace_directory: str,
+        every: int = 1,
+    ):
+        if every < 1:
+            raise ValueError("checkpoint_every should be a positive integer, got {}".format(every))
+        self.directory = directory
+        self.config = config
+        self.seed = np.asarray(seed)
+        self.trace_directory = trace_directory
+        self.every = every
+        self.num_segments = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(
+        self, next_draw: int, current_state: List[Any], kernel_results: Any, last: bool = False
+    ) -> None:
+        self.num_segments += 1
+        if self.num_segments % self.every and not last:
+            return
+        self.save(next_draw, current_state, kernel_results)
+
+    def save(self, next_draw: int, current_state: List[Any], kernel_results: Any) -> None:
+        checkpoint = dict(
+            config=self.config,
+            seed=self.seed,
+            trace_directory=os.path.abspath(self.trace_directory),
+            next_draw=next_draw,
+            current_state=[np.asarray(part) for part in current_state],
+            kernel_results=_map_leaves(np.asarray, kernel_results),
+        )
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        # write to a temporary file first, so that a crash while saving never leaves a
+        # corrupted checkpoint behind
+        with open(path + ".tmp", "wb") as buff:
+            pickle.dump(checkpoint, buff)
+        os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(directory: str) -> Dict[str, Any]:
+    """Load the checkpoint saved in ``directory``.
+
+    Returns
+    -------
+    checkpoint : Dict[str, Any]
+        A dictionary with the ``config``, ``seed``, ``trace_directory``, ``next_draw``,
+        ``current_state`` and ``kernel_results`` of the run. The state, the kernel results
+        and the seed are converted back to tensors.
+    """
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError("No checkpoint found in {!r}".format(directory))
+    with open(path, "rb") as buff:
+        checkpoint = pickle.load(buff)
+    checkpoint["seed"] = tf.convert_to_tensor(checkpoint["seed"])
+    checkpoint["current_state"] = [tf.convert_to_tensor(v) for v in checkpoint["current_state"]]
+    checkpoint["kernel_results"] = _map_leaves(tf.convert_to_tensor, checkpoint["kernel_results"])
+    return checkpoint
+
+
+def validate_checkpoint_config(
+    checkpoint: Dict[str, Any], config: Dict[str, Any], ignore: Optional[List[str]] = None
+) -> None:
+    """Raise a ``ValueError`` if a resumed run's configuration differs from the checkpoint's."""
+    ignore = ignore or []
+    mismatches = {
+        name: (checkpoint["config"].get(name), value)
+        for name, value in config.items()
+        if name not in ignore and checkpoint["config"].get(name) != value
+    }
+    if mismatches:
+        raise ValueError(
+            "Can not resume the run: the following arguments differ from the checkpoint "
+            "(checkpoint value, supplied value): {}".format(mismatches)
+        )
@@ -0,0 +1,351 @@
+"""Convergence diagnostics that are updated online while ``pm.sample`` runs.
+
+:class:`ConvergenceMonitor` receives the draws of a segmented run one segment at a time and
+keeps running estimates of the split-R-hat and of the bulk and tail effective sample sizes
+of every selected variable, so the chains can be stopped as soon as they converge. The
+draws are never stored: every chain is summarized by the Welford statistics (count, mean
+and sum of squared deviations) of consecutive batches of draws. When there are more than
+``max_batches`` batches, adjacent batches are merged and the batch size doubles, so the
+memory and the cost of an update do not grow with the length of the trace.
+
+The diagnostics are computed from the batches:
+
+- the split-R-hat compares the first and second halves of every chain, split at a batch
+  boundary.
+- the bulk ESS is the batch means estimate ``N * var(x) / (b * var(batch means))``.
+- the tail ESS is the smallest batch means ESS of the indicators of the 5% and 95%
+  quantiles. The quantiles are estimated from the first segment, since the indicators
+  must be computed with fixed thresholds.
+
+These estimators are not rank normalized, unlike the ones of ArviZ, but they agree for
+well behaved posteriors and never require a pass over the whole trace.
+"""
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+__all__ = ["ConvergenceMonitor"]
+
+
+TAIL_QUANTILES = (0.05, 0.95)
+
+
+def merge_moments(
+    count_a: np.ndarray,
+    mean_a: np.ndarray,
+    m2_a: np.ndarray,
+    count_b: np.ndarray,
+    mean_b: np.ndarray,
+    m2_b: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Combine the Welford statistics of two sets of draws (Chan et al.'s update).
+
+    Examples
+    --------
+    >>> x = np.arange(10.0)
+    >>> count, mean, m2 = merge_moments(4, x[:4].mean(), x[:4].var() * 4,
+    ...                                 6, x[4:].mean(), x[4:].var() * 6)
+    >>> count, mean, np.isclose(m2 / count, x.var())
+    (10, 4.5, True)
+    """
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    safe_count = np.maximum(count, 1)
+    mean = mean_a + delta * count_b / safe_count
+    m2 = m2_a + m2_b + delta**2 * count_a * count_b / safe_count
+    return count, mean, m2
+
+
+class _Batches:
+    """The batch statistics of a single variable, flattened to ``(num_chains, size)``."""
+
+    def __init__(self, thresholds: np.ndarray):
+        self.thresholds = thresholds
+        # the counts are shared by the chains, since they are all advanced together
+        self.counts: np.ndarray = np.zeros(0, dtype=np.int64)
+        self.means: Optional[np.ndarray] = None
+        self.m2s: Optional[np.ndarray] = None
+        self.tails: Optional[np.ndarray] = None
+
+    def summarize(self, draws: np.ndarray) -> Tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+        tails = (draws[..., None] <= self.thresholds).mean(axis=1)
+        mean = draws.mean(axis=1)
+        m2 = ((draws - mean[:, None]) ** 2).sum(axis=1)
+        return draws.shape[1], mean, m2, tails
+
+    def append(self, count, mean, m2, tails):
+        if self.means is None:
+            self.counts = np.array([count])
+            self.means, self.m2s, self.tails = mean[None], m2[None], tails[None]
+        else:
+            self.counts = np.append(self.counts, count)
+            self.means = np.concatenate([self.means, mean[None]])
+            self.m2s = np.concatenate([self.m2s, m2[None]])
+            self.tails = np.concatenate([self.tails, tails[None]])
+
+    def update_last(self, count, mean, m2, tails):
+        last_count = self.counts[-1]
+        new_count, self.means[-1], self.m2s[-1] = merge_moments(
+            last_count, self.means[-1], self.m2s[-1], count, mean, m2
+        )
+        self.tails[-1] = (self.tails[-1] * last_count + tails * count) / new_count
+        self.counts[-1] = new_count
+
+    def moments(self, part: slice) -> Tuple[int, np.ndarray, np.ndarray]:
+        """Combine the batches of ``part`` into the Welford statistics of every chain."""
+        counts = self.counts[part]
+        means = self.means[part]
+        m2s = self.m2s[part]
+        count, mean, m2 = counts[0], means[0], m2s[0]
+        for i in range(1, len(counts)):
+            count, mean, m2 = merge_moments(count, mean, m2, counts[i], means[i], m2s[i])
+        return count, mean, m2
+
+    def halve(self):
+        # merge the batches pairwise; an odd batch out stays last, which keeps every batch
+        # but the last one full
+        num_pairs = len(self.counts) // 2
+        first = slice(0, 2 * num_pairs, 2)
+        second = slice(1, 2 * num_pairs, 2)
+        count_a = self.counts[first]
+        count_b = self.counts[second]
+        extra = (Ellipsis,) + (None,) * (self.means.ndim - 1)
+        counts, means, m2s = merge_moments(
+            count_a[extra],
+            self.means[first],
+            self.m2s[first],
+            count_b[extra],
+            self.means[second],
+            self.m2s[second],
+        )
+        tails = (
+            self.tails[first] * count_a[extra + (None,)]
+            + self.tails[second] * count_b[extra + (None,)]
+        ) / counts[..., None]
+        tail = slice(2 * num_pairs, None)
+        self.counts = np.concatenate([count_a + count_b, self.counts[tail]])
+        self.means = np.concatenate([means, self.means[tail]])
+        self.m2s = np.concatenate([m2s, self.m2s[tail]])
+        self.tails = np.concatenate([tails, self.tails[tail]])
+
+
+class ConvergenceMonitor:
+    """Decide when a segmented ``pm.sample`` run has converged.
+
+    Pass an instance as the ``convergence`` argument of ``pm.sample``. After every segment,
+    the monitor is updated with the new draws and sampling stops once every element of the
+    monitored variables has a split-R-hat of at most ``rhat`` and bulk and tail effective
+    sample sizes of at least ``ess_bulk`` and ``ess_tail``. ``num_samples`` is then the hard
+    cap of the number of draws. Any target can be set to ``None`` to ignore it.
+
+    Parameters
+    ----------
+    rhat : Optional[float]
+        The largest acceptable split-R-hat.
+    ess_bulk : Optional[float]
+        The smallest acceptable bulk effective sample size, summed over the chains.
+    ess_tail : Optional[float]
+        The smallest acceptable tail effective sample size, summed over the chains.
+    var_names : Optional[Sequence[str]]
+        The variables to monitor. Defaults to all the free variables of the model, as they
+        are sampled (i.e. in the transformed space).
+    min_draws : int
+        The number of draws of every chain before the run is allowed to stop.
+    max_batches : int
+        The largest number of batches kept for every chain. Larger values make the ESS
+        estimates less noisy for long runs.
+
+    Attributes
+    ----------
+    num_draws : int
+        The number of draws of every chain seen by the monitor.
+    diagnostics : Dict[str, Dict[str, np.ndarray]]
+        The last ``"rhat"``, ``"ess_bulk"`` and ``"ess_tail"`` of every monitored variable.
+    converged : bool
+        Whether the last update met all the targets.
+
+    Examples
+    --------
+    >>> monitor = ConvergenceMonitor(ess_bulk=1000, var_names=["x"])
+    >>> draws = np.random.RandomState(0).normal(size=(4, 500))
+    >>> monitor.update({"x": draws})
+    True
+    >>> sorted(monitor.diagnostics["x"])
+    ['ess_bulk', 'ess_tail', 'rhat']
+    """
+
+    def __init__(
+        self,
+        rhat: Optional[float] = 1.01,
+        ess_bulk: Optional[float] = 400,
+        ess_tail: Optional[float] = 400,
+        var_names: Optional[Sequence[str]] = None,
+        min_draws: int = 100,
+        max_batches: int = 32,
+    ):
+        if max_batches < 4:
+            raise ValueError("max_batches should be at least 4, got {}".format(max_batches))
+        self.rhat = rhat
+        self.ess_bulk = ess_bulk
+        self.ess_tail = ess_tail
+        self.var_names = None if var_names is None else list(var_names)
+        self.min_draws = min_draws
+        self.max_batches = max_batches
+        self.reset()
+
+    def __repr__(self):
+        return (
+            "{}(rhat={!r}, ess_bulk={!r}, ess_tail={!r}, var_names={!r}, min_draws={!r}, "
+            "max_batches={!r})".format(
+                self.__class__.__name__,
+                self.rhat,
+                self.ess_bulk,
+                self.ess_tail,
+                self.var_names,
+                self.min_draws,
+                self.max_batches,
+            )
+        )
+
+    def reset(self) -> None:
+        """Forget all the draws seen so far."""
+        self.num_draws = 0
+        self.batch_size = 1
+        self.converged = False
+        self.diagnostics: Dict[str, Dict[str, np.ndarray]] = dict()
+        self._batches: Dict[str, _Batches] = dict()
+
+    def update(self, posterior: Dict[str, np.ndarray]) -> bool:
+        """Add a segment of draws and return whether the chains have converged.
+
+        Parameters
+        ----------
+        posterior : Dict[str, np.ndarray]
+            The new draws of the variables with shape ``(num_chains, num_draws, *shape)``.
+            It must contain all the monitored variables.
+        """
+        var_names = list(posterior) if self.var_names is None else self.var_names
+        missing = [name for name in var_names if name not in posterior]
+        if missing:
+            raise ValueError(
+                "Unknown variables {} in the convergence monitor, use any of {}".format(
+                    missing, sorted(posterior)
+                )
+            )
+        num_draws = None
+        for name in var_names:
+            draws = np.asarray(posterior[name], dtype=np.float64)
+            draws = draws.reshape(draws.shape[:2] + (-1,))
+            num_draws = draws.shape[1]
+            if name not in self._batches:
+                thresholds = np.quantile(draws, TAIL_QUANTILES, axis=(0, 1)).T
+                self._batches[name] = _Batches(thresholds)
+            self._add(self._batches[name], draws)
+        if num_draws is None:
+            return False
+        self.num_draws += num_draws
+        while len(next(iter(self._batches.values())).counts) > self.max_batches:
+            for batches in self._batches.values():
+                batches.halve()
+            self.batch_size *= 2
+        self.diagnostics = {
+            name: self._diagnose(batches) for name, batches in self._batches.items()
+        }
+        self.converged = self.num_draws >= self.min_draws and self._targets_met()
+        return self.converged
+
+    def _add(self, batches: _Batches, draws: np.ndarray) -> None:
+        size = self.batch_size
+        if len(batches.counts) and batches.counts[-1] < size:
+            fill = size - batches.counts[-1]
+            batches.update_last(*batches.summarize(draws[:, :fill]))
+            draws = draws[:, fill:]
+        num_full = draws.shape[1] // size
+        if num_full:
+            full = draws[:, : num_full * size]
+            full = full.reshape((full.shape[0], num_full, size) + full.shape[2:])
+            means = full.mean(axis=2)
+            m2s = ((full - means[:, :, None]) ** 2).sum(axis=2)
+            tails = (full[..., None] <= batches.thresholds).mean(axis=2)
+            batches.counts = np.concatenate(
+                [batches.counts, np.full(num_full, size, dtype=np.int64)]
+            )
+            means, m2s, tails = (np.swapaxes(value, 0, 1) for value in (means, m2s, tails))
+            if batches.means is None:
+                batches.means, batches.m2s, batches.tails = means, m2s, tails
+            else:
+                batches.means = np.concatenate([batches.means, means])
+                batches.m2s = np.concatenate([batches.m2s, m2s])
+                batches.tails = np.concatenate([batches.tails, tails])
+        if draws.shape[1] > num_full * size:
+            batches.append(*batches.summarize(draws[:, num_full * size :]))
+
+    def _diagnose(self, batches: _Batches) -> Dict[str, np.ndarray]:
+        num_chains = batches.means.shape[1]
+        # split-R-hat, from the moments of the two halves of every chain
+        half = max(len(batches.counts) // 2, 1)
+        halves = [
+            batches.moments(slice(None, half)),
+            batches.moments(slice(half, None)),
+        ]
+        if len(batches.counts) > 1:
+            counts = np.array([halves[0][0], halves[1][0]], dtype=np.float64)
+            n = counts.mean()
+            means = np.concatenate([halves[0][1], halves[1][1]])
+            within = np.concatenate(
+                [halves[0][2] / max(counts[0] - 1, 1), halves[1][2] / max(counts[1] - 1, 1)]
+            ).mean(axis=0)
+            between = n * means.var(axis=0, ddof=1)
+            var_plus = (n - 1) / n * within + between / n
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rhat = np.sqrt(var_plus / within)
+        else:
+            rhat = np.full(batches.means.shape[2:], np.nan)
+        # batch means effective sample sizes, from the full batches only
+        full = batches.counts == self.batch_size
+        count, _, m2s = batches.moments(slice(None))
+        ess_bulk = self._batch_means_ess(batches.means[full], m2s / max(count - 1, 1))
+        tails = batches.tails[full]
+        ess_tail = np.min(
+            [
+                self._batch_means_ess(
+                    tails[..., i], tails[..., i].mean(0) * (1 - tails[..., i].mean(0))
+                )
+                for i in range(len(TAIL_QUANTILES))
+            ],
+            axis=0,
+        )
+        return dict(rhat=rhat, ess_bulk=ess_bulk, ess_tail=ess_tail)
+
+    def _batch_means_ess(self, batch_means: np.ndarray, variances: np.ndarray) -> np.ndarray:
+        # The asymptotic variance of every chain is estimated from the spread of its batch
+        # means, and the disagreement between the chains increases the autocorrelation
+        # time as in the multi-chain ESS of Vehtari et al. (2021), whose autocorrelations
+        # are truncated around the batch size.
+        num_batches, num_chains = batch_means.shape[:2]
+        if num_batches < 2:
+            return np.zeros(variances.shape[1:])
+        n = num_batches * self.batch_size
+        total = num_chains * n
+        chain_means = batch_means.mean(axis=0)
+        asymptotic = self.batch_size * batch_means.var(axis=0, ddof=1).mean(axis=0)
+        within = variances.mean(axis=0)
+        between = n * chain_means.var(axis=0, ddof=1) if num_chains > 1 else 0.0
+        var_plus = (n - 1) / n * within + between / n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tau = (asymptotic + 2 * self.batch_size * (var_plus - within)) / var_plus
+            ess = total / tau
+        # the same cap as ArviZ, for antithetic chains
+        ess = np.where(np.isnan(ess), 0.0, ess)
+        return np.minimum(ess, total * np.log10(max(total, 10)))
+
+    def _targets_met(self) -> bool:
+        for values in self.diagnostics.values():
+            if self.rhat is not None and not np.all(values["rhat"] <= self.rhat):
+                return False
+            if self.ess_bulk is not None and not np.all(values["ess_bulk"] >= self.ess_bulk):
+                return False
+            if self.ess_tail is not None and not np.all(values["ess_tail"] >= self.ess_tail):
+                return False
+        return True
@@ -0,0 +1,176 @@
+"""Update the log probability of a model when the value of a single variable changes.
+
+Metropolis-within-Gibbs and other coordinate-wise schemes change the value of one variable
+at a time, while :meth:`pymc4.flow.SamplingState.collect_log_prob` computes the log
+probability of every variable of the model again. :class:`IncrementalLogProb` caches the
+log probability term of every variable, its summed term of
+:meth:`~pymc4.flow.SamplingState.collect_log_prob_elemwise`, and when the value of a
+variable changes, it only recomputes the terms of the variable and of its children in the
+:class:`pymc4.flow.DependencyGraph` of the model.
+
+The model is traced once into a graph, and a function that only computes the terms
+affected by a variable is pruned from this graph for every variable, so the model is not
+evaluated again and the other terms are not computed at all.
+"""
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import tensorflow as tf
+
+from pymc4 import flow
+from pymc4.coroutine_model import Model
+from pymc4.data import ShardedData
+from pymc4.distributions.distribution import JacobianPotential
+from pymc4.flow.dependencies import tensor_parents
+from pymc4.inference.sampling import initialize_state
+from pymc4.utils import NameParts
+
+
+__all__ = ["IncrementalLogProb"]
+
+
+class IncrementalLogProb:
+    """The log probability of a model, updated one variable at a time.
+
+    The term of a transformed variable includes the log Jacobian determinant of its
+    transformation, and every other potential of the model is a term of its own, named
+    ``"potential:<index>"``.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+        The model to evaluate.
+    values : Optional[Dict[str, Any]]
+        The initial values of the free variables, by their names in the sampling state,
+        i.e. the transformed names of the transformed variables. The values that are not
+        set default to the initial values used by ``pm.sample``.
+    observed : Optional[Dict[str, Any]]
+        Override the observed values of the model.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def model():
+    ...     mu = yield pm.Normal("mu", 0, 1)
+    ...     yield pm.Normal("x", mu, 1, batch_stack=3)
+    ...     yield pm.Normal("z", 0, 1)
+    >>> log_prob = pm.IncrementalLogProb(model())
+    >>> log_prob.affected_terms("model/mu")
+    ['model/mu', 'model/x']
+    >>> difference, terms = log_prob.propose("model/z", 1.0)
+    >>> float(difference)
+    -0.5
+    >>> new_log_prob = log_prob.update("model/z", 1.0, terms)
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        values: Optional[Dict[str, Any]] = None,
+        observed: Optional[Dict[str, Any]] = None,
+    ):
+        state, _, suppressed_observed = initialize_state(model, observed=observed)
+        if state.minibatches or any(
+            isinstance(value, ShardedData) for value in state.observed_values.values()
+        ):
+            raise ValueError("IncrementalLogProb does not support minibatches or sharded data")
+        self.model = model
+        self.observed = dict(state.observed_values)
+        self.observed.update({name: None for name in suppressed_observed})
+        self.values: Dict[str, tf.Tensor] = {
+            name: tf.convert_to_tensor(value) for name, value in state.all_unobserved_values.items()
+        }
+        for name, value in (values or {}).items():
+            self.values[self._check_name(name)] = self._convert(name, value)
+        self.term_names: List[str] = []
+        self.term_parents: Dict[str, Set[str]] = dict()
+        self.graph: Optional[flow.DependencyGraph] = None
+        self._inputs: List[tf.Tensor] = []
+        self._outputs: List[tf.Tensor] = []
+        self._function = tf.compat.v1.wrap_function(
+            self._trace, [tf.TensorSpec(value.shape, value.dtype) for value in self.values.values()]
+        )
+        self._pruned: Dict[str, Any] = dict()
+        self.terms: Dict[str, tf.Tensor] = dict(
+            zip(self.term_names, self._function(*self.values.values()))
+        )
+
+    def _trace(self, *values):
+        st = flow.SamplingState.from_values(
+            dict(zip(self.values, values)), observed_values=self.observed, record_dependencies=True
+        )
+        _, st = flow.evaluate_model_transformed(self.model, state=st)
+        self.graph = st.dependency_graph()
+        names = {value.ref(): name for name, value in st.untransformed_values.items()}
+        for name, value in zip(self.values, values):
+            names[value.ref()] = NameParts.from_name(name).full_untransformed_name
+        terms = dict()
+        for name, dist in st.distributions.items():
+            terms[name] = tf.reduce_sum(st.scaled_log_prob(name, dist))
+            self.term_parents[name] = {name, *st.dependencies[name]}
+        for index, potential in enumerate(st.potentials):
+            value = tf.reduce_sum(potential.value)
+            parents = tensor_parents([value], names)
+            if isinstance(potential, JacobianPotential) and len(parents) == 1:
+                # the log Jacobian determinant of the transformation of a variable
+                terms[parents[0]] = terms[parents[0]] + value
+            else:
+                name = "potential:{}".format(index)
+                terms[name] = value
+                self.term_parents[name] = set(parents)
+        self.term_names = list(terms)
+        self._inputs = list(values)
+        self._outputs = list(terms.values())
+        return self._outputs
+
+    def _check_name(self, name: str) -> str:
+        if name not in self.values:
+            raise ValueError(
+                "{!r} is not a free variable of the model, use any of {}".format(
+                    name, list(self.values)
+                )
+            )
+        return name
+
+    def _convert(self, name: str, value: Any) -> tf.Tensor:
+        return tf.convert_to_tensor(value, dtype=self.values[name].dtype)
+
+    def affected_terms(self, name: str) -> List[str]:
+        """Return the terms that change with the value of the free variable ``name``."""
+        variable = NameParts.from_name(self._check_name(name)).full_untransformed_name
+        return [term for term in self.term_names if variable in self.term_parents[term]]
+
+    def log_prob(self) -> tf.Tensor:
+        """Return the log probability of the current values, the sum of the cached terms."""
+        return sum(self.terms.values())
+
+    def propose(self, name: str, value: Any) -> Tuple[tf.Tensor, Dict[str, tf.Tensor]]:
+        """Evaluate a new value of a variable, without setting it.
+
+        Returns the change of the log probability and the recomputed terms, which can be
+        passed to :meth:`update` to set the value.
+        """
+        if name not in self._pruned:
+            self._pruned[name] = self._function.prune(
+                self._inputs,
+                [self._outputs[self.term_names.index(term)] for term in self.affected_terms(name)],
+            )
+        values = dict(self.values)
+        values[name] = self._convert(name, value)
+        terms = dict(zip(self.affected_terms(name), self._pruned[name](*values.values())))
+        difference = sum(terms[term] - self.terms[term] for term in terms)
+        return difference, terms
+
+    def update(
+        self, name: str, value: Any, terms: Optional[Dict[str, tf.Tensor]] = None
+    ) -> tf.Tensor:
+        """Set the value of a variable and return the new log probability.
+
+        ``terms`` are the terms returned by :meth:`propose` for the same value, they are
+        recomputed if not given.
+        """
+        if terms is None:
+            _, terms = self.propose(name, value)
+        self.values[name] = self._convert(name, value)
+        self.terms.update(terms)
+        return self.log_prob()
@@ -0,0 +1,101 @@
+"""Run the chains of ``pm.sample`` in a pool of worker processes.
+
+By default, all the chains run inside a single TensorFlow graph, vectorized with
+``tf.vectorized_map`` or batched by the model itself. That is not possible for models
+that can not be batched, and NUTS wastes work when the chains of a batch need trees of
+different depths, since every chain waits for the deepest tree. Running each chain in its
+own process avoids both problems at the cost of one TensorFlow runtime per worker.
+
+The workers are started with the ``spawn`` method, because TensorFlow is not fork safe,
+and the model is shipped to them with ``cloudpickle``, so models defined in interactive
+sessions or inside functions are supported.
+"""
+import multiprocessing
+import os
+import pickle
+from typing import Any, Dict, Optional, Tuple
+
+import cloudpickle
+import numpy as np
+import arviz as az
+import tensorflow as tf
+
+from pymc4.coroutine_model import Model
+
+
+__all__ = ["sample_processes"]
+
+
+def _init_worker(threads_per_worker: int) -> None:
+    # the thread pools must be configured before the TensorFlow runtime is initialized
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _sample_chain(payload: bytes) -> Tuple[Dict[str, np.ndarray], ...]:
+    from pymc4.inference.sampling import sample
+
+    model, seed, sample_kwargs = pickle.loads(payload)
+    trace = sample(model, num_chains=1, seed=seed, **sample_kwargs)
+    groups = []
+    for group in ("posterior", "sample_stats", "observed_data"):
+        dataset = getattr(trace, group, None)
+        groups.append(
+            {} if dataset is None else {k: v.values for k, v in dataset.data_vars.items()}
+        )
+    return tuple(groups)
+
+
+def sample_processes(
+    model: Model,
+    num_chains: int,
+    seed: Any,
+    num_workers: Optional[int] = None,
+    threads_per_worker: Optional[int] = None,
+    **sample_kwargs,
+) -> az.InferenceData:
+    """Run each chain in its own process and merge them in a single InferenceData object.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+    num_chains : int
+    seed : Any
+        The stateless seed of the run. Each chain gets its own seed, ``seed`` folded with the
+        index of the chain, so the draws of a chain do not depend on ``num_chains``.
+    num_workers : Optional[int]
+        The number of worker processes. Defaults to the smallest of ``num_chains`` and the
+        number of CPUs.
+    threads_per_worker : Optional[int]
+        The number of intra-op threads of each worker. Defaults to the number of CPUs
+        divided by ``num_workers``, so that the workers do not oversubscribe the CPUs.
+    **sample_kwargs
+        The other arguments of ``pm.sample``, used to sample every chain.
+
+    Returns
+    -------
+    ArviZ's InferenceData object
+    """
+    num_cpus = os.cpu_count() or 1
+    if num_workers is None:
+        num_workers = min(num_chains, num_cpus)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, num_cpus // num_workers)
+    seeds = [
+        np.asarray(tf.random.experimental.stateless_fold_in(seed, chain))
+        for chain in range(num_chains)
+    ]
+    payloads = [cloudpickle.dumps((model, chain_seed, sample_kwargs)) for chain_seed in seeds]
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        num_workers, initializer=_init_worker, initargs=(threads_per_worker,)
+    ) as pool:
+        chains = pool.map(_sample_chain, payloads)
+    posterior, sample_stats, observed_data = zip(*chains)
+    return az.from_dict(
+        posterior={k: np.concatenate([chain[k] for chain in posterior]) for k in posterior[0]},
+        sample_stats={
+            k: np.concatenate([chain[k] for chain in sample_stats]) for k in sample_stats[0]
+        },
+        observed_data=observed_data[0] or None,
+    )
@@ -0,0 +1,322 @@
+"""Report the progress and the throughput of ``pm.sample`` while the chains run.
+
+A :class:`ProgressMonitor` passed to ``pm.sample(progress=...)`` adds a few operations to
+the compiled sampling loop: the divergences and the gradient evaluations of every chain are
+accumulated at every step, and every ``every`` steps they are sent to the host with
+``tf.py_function``, along with the current step size and tree depth of every chain. The
+host callback drops the reports that come less than ``min_interval`` seconds after the
+previous one, so that neither the callback nor slow sinks stall the loop. The last step
+is always reported.
+
+The reports are :class:`ProgressReport` tuples, handed to every sink of the monitor. A
+sink is any callable that takes a report, such as :class:`LogSink`, which logs a line per
+report, or :class:`PrometheusTextFileSink`, which exposes the last report as gauges in a
+file read by the textfile collector of the Prometheus node exporter.
+"""
+import logging
+import math
+import os
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+import tensorflow as tf
+
+
+__all__ = ["ProgressReport", "ProgressMonitor", "LogSink", "PrometheusTextFileSink"]
+
+
+class ProgressReport(NamedTuple):
+    """The progress of the chains at a step of the sampling loop.
+
+    The rates are averaged since the previous report. The arrays have one entry per chain
+    and are ``None`` if the step methods do not record the statistic: the gradient
+    evaluations and the tree depth are taken from the ``tree_size`` statistic of NUTS, and
+    the step size from :meth:`pymc4.inference.step_methods.StepMethod.current_step_size`.
+    """
+
+    step: int
+    total_steps: int
+    tuning: bool
+    elapsed: float
+    draws_per_second: float
+    gradients_per_second: Optional[np.ndarray]
+    step_size: Optional[np.ndarray]
+    divergences: np.ndarray
+    tree_depth: Optional[np.ndarray]
+
+
+class ProgressMonitor:
+    """Send progress reports of the sampling loop of ``pm.sample`` to sinks.
+
+    Reuse the same monitor to reuse the compiled sampler across calls to ``pm.sample``,
+    since the monitor is part of the compiled function.
+
+    Parameters
+    ----------
+    sinks : Optional[Sequence[Callable[[ProgressReport], Any]]]
+        The callables that receive the reports. Defaults to a :class:`LogSink`.
+    every : int
+        Report every ``every`` steps of the chains.
+    min_interval : float
+        The minimal number of seconds between two reports. The reports that come sooner
+        are dropped.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def model():
+    ...     yield pm.Normal("x", 0, 1)
+    >>> reports = []
+    >>> monitor = ProgressMonitor(sinks=[reports.append], every=50, min_interval=0)
+    >>> trace = pm.sample(model(), num_samples=100, burn_in=100, progress=monitor)
+    >>> [report.step for report in reports]
+    [50, 100, 150, 200]
+    >>> reports[-1].divergences.shape
+    (10,)
+    """
+
+    def __init__(
+        self,
+        sinks: Optional[Sequence[Callable[[ProgressReport], Any]]] = None,
+        every: int = 100,
+        min_interval: float = 1.0,
+    ):
+        if every < 1:
+            raise ValueError("every should be a positive integer, got {}".format(every))
+        self.sinks = [LogSink()] if sinks is None else list(sinks)
+        self.every = every
+        self.min_interval = min_interval
+        self.step_method: Any = None
+        self.total_steps = 0
+        # read by the compiled loop, which is reused by the runs of other lengths
+        self._every = tf.Variable(every, dtype=tf.int32, trainable=False)
+        self._total_steps = tf.Variable(0, dtype=tf.int32, trainable=False)
+        self.burn_in = 0
+        self._fields: List[str] = []
+        self._start_time = 0.0
+        self._last: Dict[str, Any] = dict()
+        self._divergences: Any = 0
+        self._gradients: Any = 0
+
+    def start(self, step_method: Any, total_steps: int, burn_in: int, first_step: int = 0):
+        """Prepare the monitor for a run of ``total_steps`` steps of ``step_method``.
+
+        ``first_step`` is the step the run starts from when it is resumed.
+        """
+        self.step_method = step_method
+        self.total_steps = total_steps
+        self.burn_in = burn_in
+        self._every.assign(self.every)
+        self._total_steps.assign(total_steps)
+        self._start_time = time.perf_counter()
+        self._last = dict(step=first_step, time=self._start_time)
+        self._divergences = 0
+        self._gradients = 0
+
+    def initial_totals(self, kernel_results: Any) -> Any:
+        """Return the divergences and gradient evaluations accumulated before the first step."""
+        divergences, gradients = self._step_totals(kernel_results)
+        return tf.zeros_like(divergences), tf.zeros_like(gradients)
+
+    def update(
+        self, step: tf.Tensor, totals: Any, kernel_results: Any, last_step: Any = None
+    ) -> Any:
+        """Accumulate the statistics of a step and report them every ``every`` steps.
+
+        This is called inside the compiled loop with the index of the step (from 0), the
+        divergences and gradient evaluations accumulated since they were last sent to the
+        host, the kernel results after the step and the index of the last step of the loop,
+        at which the accumulated statistics are always sent. It returns the new totals.
+        """
+        divergences, gradients = self._step_totals(kernel_results)
+        divergences, gradients = totals[0] + divergences, totals[1] + gradients
+        done = step + 1
+        due = tf.logical_or(tf.equal(done % self._every, 0), tf.equal(done, self._total_steps))
+        values = dict(step=done, due=due, divergences=divergences, gradients=gradients)
+        if self._has_stat("tree_size"):
+            # a trajectory of depth d takes at most 2 ** d - 1 leapfrog steps
+            tree_size = tf.cast(self._stat_sum(kernel_results, "tree_size"), tf.float32)
+            values["tree_depth"] = tf.math.ceil(tf.math.log(tree_size + 1.0) / math.log(2.0))
+        step_size = self.step_method.current_step_size(kernel_results)
+        if step_size is not None:
+            values["step_size"] = per_chain(step_size, divergences.shape[0])
+        self._fields = list(values)
+
+        def send():
+            sent = tf.py_function(self._receive, list(values.values()), Tout=tf.bool)
+            with tf.control_dependencies([sent]):
+                return tf.zeros_like(divergences), tf.zeros_like(gradients)
+
+        flush = due if last_step is None else tf.logical_or(due, tf.equal(step, last_step))
+        return tf.cond(flush, send, lambda: (divergences, gradients))
+
+    def _has_stat(self, name):
+        return any(
+            stat == name or stat.startswith(name + "_") for stat in self.step_method.stat_names
+        )
+
+    def _stat_sum(self, kernel_results, name):
+        stats = dict(
+            zip(self.step_method.stat_names, self.step_method.sample_stats(kernel_results))
+        )
+        return tf.add_n(
+            [
+                tf.cast(value, tf.int32)
+                for stat, value in stats.items()
+                if stat == name or stat.startswith(name + "_")
+            ]
+        )
+
+    def _step_totals(self, kernel_results):
+        lp = self.step_method.sample_stats(kernel_results)[0]
+        divergences = tf.zeros_like(lp, dtype=tf.int32)
+        if self._has_stat("diverging"):
+            divergences += self._stat_sum(kernel_results, "diverging")
+        gradients = tf.zeros_like(lp, dtype=tf.int64)
+        if self._has_stat("tree_size"):
+            gradients += tf.cast(self._stat_sum(kernel_results, "tree_size"), tf.int64)
+        return divergences, gradients
+
+    def _receive(self, *values):
+        values = dict(zip(self._fields, (value.numpy() for value in values)))
+        # the totals are accumulated on the host, since the loop is restarted by every segment
+        self._divergences = self._divergences + values["divergences"]
+        self._gradients = self._gradients + values["gradients"]
+        step = int(values["step"])
+        now = time.perf_counter()
+        if not values["due"] or (
+            step != self.total_steps and now - self._last["time"] < self.min_interval
+        ):
+            return False
+        interval = max(now - self._last["time"], 1e-9)
+        report = ProgressReport(
+            step=step,
+            total_steps=self.total_steps,
+            tuning=step <= self.burn_in,
+            elapsed=now - self._start_time,
+            draws_per_second=(step - self._last["step"]) * len(self._divergences) / interval,
+            gradients_per_second=(self._gradients / interval if "tree_depth" in values else None),
+            step_size=values.get("step_size"),
+            divergences=self._divergences,
+            tree_depth=values.get("tree_depth"),
+        )
+        self._last = dict(step=step, time=now)
+        self._gradients = 0
+        for sink in self.sinks:
+            sink(report)
+        return True
+
+
+def per_chain(value: Any, num_chains: int) -> tf.Tensor:
+    """Reduce a (possibly per chain) step size to one value per chain."""
+    value = tf.cast(tf.convert_to_tensor(tf.nest.flatten(value)[0]), tf.float32)
+    if value.shape.rank == 0 or value.shape[0] != num_chains:
+        return tf.fill([num_chains], tf.reduce_mean(value))
+    return tf.reduce_mean(tf.reshape(value, [num_chains, -1]), axis=1)
+
+
+class LogSink:
+    """Log a line per progress report.
+
+    Parameters
+    ----------
+    logger : Optional[logging.Logger]
+        Defaults to the ``pymc4`` logger.
+    level : int
+        The level of the log records.
+    """
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.INFO):
+        self.logger = logging.getLogger("pymc4") if logger is None else logger
+        self.level = level
+
+    def __call__(self, report: ProgressReport):
+        parts = [
+            "{} {}/{} ({:.0%})".format(
+                "tuning" if report.tuning else "sampling",
+                report.step,
+                report.total_steps,
+                report.step / max(report.total_steps, 1),
+            ),
+            "{:.1f} draws/s".format(report.draws_per_second),
+        ]
+        if report.gradients_per_second is not None:
+            parts.append("{:.1f} gradients/s".format(float(report.gradients_per_second.sum())))
+        if report.step_size is not None:
+            parts.append("step size {:.3g}".format(float(np.mean(report.step_size))))
+        parts.append("{} divergences".format(int(report.divergences.sum())))
+        if report.tree_depth is not None:
+            parts.append("tree depth {:.0f}".format(float(np.max(report.tree_depth))))
+        self.logger.log(self.level, ", ".join(parts))
+
+
+class PrometheusTextFileSink:
+    """Write the last progress report to a file in the Prometheus text format.
+
+    The file is replaced atomically at every report, so that the textfile collector of
+    the node exporter never reads a partial file. The statistics of the chains are
+    labelled by the ``chain`` index.
+
+    Parameters
+    ----------
+    path : str
+        The file to write, it should end with ``.prom``.
+    prefix : str
+        The prefix of the metric names.
+    labels : Optional[Dict[str, str]]
+        Labels added to all the metrics, e.g. the name of the model.
+    """
+
+    def __init__(
+        self, path: str, prefix: str = "pymc4_sampler", labels: Optional[Dict[str, str]] = None
+    ):
+        self.path = path
+        self.prefix = prefix
+        self.labels = dict(labels or {})
+
+    def _metric(self, lines, name, help_text, values, per_chain=False):
+        name = "{}_{}".format(self.prefix, name)
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} gauge".format(name))
+        values = np.atleast_1d(values) if per_chain else [values]
+        for chain, value in enumerate(values):
+            labels = dict(self.labels, chain=str(chain)) if per_chain else self.labels
+            label_text = ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+            lines.append(
+                "{}{} {}".format(name, "{" + label_text + "}" if label_text else "", float(value))
+            )
+
+    def __call__(self, report: ProgressReport):
+        lines: List[str] = []
+        self._metric(lines, "step", "The number of steps taken by the chains.", report.step)
+        self._metric(lines, "total_steps", "The number of steps of the run.", report.total_steps)
+        self._metric(lines, "tuning", "Whether the chains are tuning.", report.tuning)
+        self._metric(
+            lines,
+            "draws_per_second",
+            "The draws of all the chains per second.",
+            report.draws_per_second,
+        )
+        self._metric(
+            lines, "divergences", "The divergent transitions so far.", report.divergences, True
+        )
+        if report.gradients_per_second is not None:
+            self._metric(
+                lines,
+                "gradients_per_second",
+                "The gradient evaluations per second.",
+                report.gradients_per_second,
+                True,
+            )
+        if report.step_size is not None:
+            self._metric(lines, "step_size", "The current step size.", report.step_size, True)
+        if report.tree_depth is not None:
+            self._metric(
+                lines, "tree_depth", "The depth of the last NUTS tree.", report.tree_depth, True
+            )
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary, self.path)
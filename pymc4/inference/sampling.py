@@ -1,10 +1,30 @@
-from typing import Optional, Dict, Any
+import os
+from typing import Optional, Dict, Any, List, Sequence, Tuple, Callable, Union
+import numpy as np
+import arviz as az
+import xarray as xr
 import tensorflow as tf
-from tensorflow_probability import mcmc
+import tensorflow_probability as tfp
+from tensorflow_probability.python.internal import loop_util
 from pymc4.coroutine_model import Model
 from pymc4 import flow
+from pymc4.inference.cache import (
+    UncacheableError,
+    compilation_cache,
+    freeze,
+    lift_conditioners,
+    model_key,
+    relaxed_signature,
+    shape_dtype_key,
+)
+from pymc4.inference.checkpoint import Checkpointer, load_checkpoint, validate_checkpoint_config
+from pymc4.inference.diagnostics import ConvergenceMonitor
+from pymc4.inference.parallel import sample_processes
+from pymc4.inference.progress import ProgressMonitor
+from pymc4.inference.step_methods import NUTS, ReplicaExchange, StepMethod, as_step_method
+from pymc4.inference.storage import TraceStore, MemoryTraceStore, NpyTraceStore
 from pymc4.inference.utils import initialize_sampling_state, trace_to_arviz
-from pymc4.utils import NameParts
+from pymc4.data import ShardedData
 
 
 def sample(
@@ -20,9 +40,28 @@ def sample(
     sample_chain_kwargs: Optional[Dict[str, Any]] = None,
     xla: bool = False,
     use_auto_batching: bool = True,
+    use_compilation_cache: bool = True,
+    data_as_inputs: bool = False,
+    chunk_size: Optional[int] = None,
+    trace_store: Optional[TraceStore] = None,
+    seed: Optional[int] = None,
+    checkpoint_dir: Optional[str] = None,
+    checkpoint_every: int = 1,
+    resume: Optional[str] = None,
+    mass_matrix: Optional[str] = None,
+    mass_matrix_kwargs: Optional[Dict[str, Any]] = None,
+    step: Union[None, StepMethod, Sequence[StepMethod]] = None,
+    chain_method: str = "vectorized",
+    num_workers: Optional[int] = None,
+    convergence: Optional[ConvergenceMonitor] = None,
+    var_names: Optional[Sequence[str]] = None,
+    thin: int = 1,
+    stats: Optional[Sequence[str]] = None,
+    deterministics: str = "trace",
+    progress: Optional[ProgressMonitor] = None,
 ):
     """
-    Perform MCMC sampling using NUTS (for now).
+    Perform MCMC sampling, using NUTS by default.
 
     Parameters
     ----------
@@ -47,8 +86,7 @@ def sample(
         Pass non-default values for nuts kernel, see
         ``tensorflow_probability.mcmc.dual_averaging_step_size_adaptation.DualAveragingStepSizeAdaptation`` for options
     sample_chain_kwargs : Optional[Dict[str, Any]]
-        Pass non-default values for nuts kernel, see
-        ``tensorflow_probability.mcmc.sample_chain`` for options
+        Pass non-default values for the sampling loop, see :func:`sample_chain` for options
     xla : bool
         Enable experimental XLA
     use_auto_batching : bool
@@ -63,6 +101,109 @@ def sample(
         ``batch_shape``. Achieving this is a hard task, but it enables the model to be safely
         evaluated in parallel across all chains in MCMC, so sampling will be faster than in the
         automatically batched scenario.
+    use_compilation_cache : bool
+        If ``True`` (default), the compiled sampling function is looked up in
+        ``pymc4.inference.cache.compilation_cache`` before being built. The cache is keyed by
+        the model template and its conditioners, the observed values' shapes and dtypes,
+        ``num_chains``, the batching mode and the kernel kwargs, so refitting the same model
+        structure on new observed values or initial states skips tracing altogether. Values
+        captured by the model function's closure, other than observed values, are considered
+        part of the template and are not checked for changes.
+    data_as_inputs : bool
+        If ``True``, the observed values and the array-like conditioners of the model (the
+        arrays and tensors passed to the ``pm.model`` template) are fed to the compiled sampler
+        as tensor arguments whose shapes are relaxed to only have a fixed rank. The same
+        compiled sampler will then serve any dataset with the same schema (ranks and dtypes)
+        without being traced again. For this to work, the model must not depend on the static
+        shapes of its data. Floating point numpy conditioners are converted to ``float32``.
+        Ignored when ``xla=True`` because XLA requires static shapes.
+    chunk_size : Optional[int]
+        If provided, the chains are run in segments of ``chunk_size`` draws. Each segment
+        starts from the last draw and the final kernel results of the previous one and is
+        written to ``trace_store`` as soon as it is drawn, so the peak memory used by
+        TensorFlow does not depend on ``num_samples``.
+    trace_store : Optional[pymc4.inference.storage.TraceStore]
+        The store that receives the segments of draws. Use
+        :class:`~pymc4.inference.storage.NpyTraceStore` to stream the draws to memory-mapped
+        ``.npy`` files on disk. Defaults to a
+        :class:`~pymc4.inference.storage.MemoryTraceStore`. Passing a store without a
+        ``chunk_size`` runs the chains in segments of 100 draws.
+    seed : Optional[int]
+        The seed of the run. Every step of the chains is driven by a stateless seed that only
+        depends on this seed and on the index of the step, so two runs with the same seed and
+        arguments produce the same draws, whether they are run in one go or in segments of
+        ``chunk_size`` draws. With ``chain_method="processes"`` every chain gets its own seed
+        folded with the index of the chain, so the draws of a chain do not depend on
+        ``num_chains`` either. If ``None``, the seed is drawn from TensorFlow's global random
+        generator.
+    checkpoint_dir : Optional[str]
+        If provided, the chains are run in segments (see ``chunk_size``) and the full sampler
+        state (current positions, kernel results with the adapted step size and the dual
+        averaging state, the seed and the index of the next draw) is saved to this directory.
+        The draws are streamed to an :class:`~pymc4.inference.storage.NpyTraceStore`, by
+        default in the ``trace`` subdirectory.
+    checkpoint_every : int
+        Save a checkpoint every ``checkpoint_every`` segments.
+    resume : Optional[str]
+        A ``checkpoint_dir`` of a previous run of the same model. The chains are continued
+        from the last checkpoint and, since the seeds of the steps only depend on the seed of
+        the run and the index of the step, the result is identical to an uninterrupted run.
+        The other sampling arguments should match the checkpointed ones.
+    mass_matrix : Optional[str]
+        If ``"diag"`` or ``"dense"``, a diagonal or dense mass matrix is adapted during
+        ``burn_in`` along with the step size, following Stan's windowed adaptation. This lets
+        NUTS take larger steps and shorter trajectories in badly scaled or correlated
+        posteriors. A dense mass matrix also captures the correlations between variables, but
+        its cost grows quadratically with the total size of the variables. If ``None`` (the
+        default), only the step size is adapted.
+    mass_matrix_kwargs : Optional[Dict[str, Any]]
+        Pass non-default values for the windowed adaptation, see
+        :class:`pymc4.inference.adaptation.MassMatrixAdaptation` for options.
+    step : Union[None, StepMethod, Sequence[StepMethod]]
+        The step method used to draw the samples, see :mod:`pymc4.inference.step_methods`.
+        ``None`` uses NUTS configured by ``nuts_kwargs``, ``adaptation_kwargs``,
+        ``mass_matrix`` and ``mass_matrix_kwargs``. A list of step methods (or a step method
+        restricted to some ``var_names``) updates each group of variables in turn, and the
+        variables without a step method are updated with NUTS. The sampler statistics
+        depend on the step methods.
+    chain_method : str
+        ``"vectorized"`` (the default) runs all the chains in a single graph, see
+        ``use_auto_batching``. ``"processes"`` runs each chain independently in a pool of
+        ``num_workers`` processes, each one with its own TensorFlow runtime and a share of
+        the CPU threads. This helps for models that can not be batched, and for NUTS
+        chains that need trees of very different depths. The draws are returned in the
+        same layout. It can not be combined with ``trace_store``, ``checkpoint_dir`` or
+        ``resume``.
+    num_workers : Optional[int]
+        The number of worker processes used by ``chain_method="processes"``. Defaults to
+        the smallest of ``num_chains`` and the number of CPUs.
+    convergence : Optional[pymc4.inference.diagnostics.ConvergenceMonitor]
+        If provided, the chains are run in segments (see ``chunk_size``) and sampling stops
+        as soon as the monitor reports that the chains have converged, or after
+        ``num_samples`` draws. The monitor's R-hat and effective sample sizes are updated
+        online from every segment and can be inspected after the run.
+    var_names : Optional[Sequence[str]]
+        The free variables and deterministics to keep in the trace. The other ones are
+        never copied out of the compiled sampling loop, and the deterministics are not
+        computed at all if none of them is kept. Defaults to all of them.
+    thin : int
+        Keep only every ``thin``-th draw. The intermediate draws are discarded inside the
+        compiled sampling loop, so ``num_samples`` (and ``chunk_size``) count the draws that
+        are kept and ``thin * num_samples`` steps are taken after the burn-in.
+    stats : Optional[Sequence[str]]
+        The sampler statistics to keep, among the ones recorded by the step methods.
+        Defaults to all of them.
+    deterministics : str
+        When to compute the deterministics (including the untransformed values of the
+        transformed variables). ``"trace"`` (the default) evaluates them at every step of
+        the sampling loop. ``"posthoc"`` computes them after sampling, or after every
+        segment, from the stored draws in vectorized batches, which avoids evaluating the
+        model twice per step. ``"skip"`` leaves them out of the trace; they can be computed
+        later with :func:`compute_deterministics`.
+    progress : Optional[pymc4.inference.progress.ProgressMonitor]
+        Report the throughput, step size, divergences and tree depth of the chains from
+        inside the compiled sampling loop, see :mod:`pymc4.inference.progress`. Not
+        supported with ``xla=True``.
 
     Returns
     -------
@@ -106,91 +247,842 @@ def sample(
     This will give a trace with new observed variables. This way is considered to be explicit.
 
     """
-    (
-        logpfn,
+    state_, deterministic_names, suppressed_observed = initialize_state(
+        model, observed=observed, state=state
+    )
+    if state_.minibatches:
+        raise ValueError(
+            "The variables {} are observed on minibatches, which `sample` does not support. "
+            "Use `pm.fit` instead.".format(sorted(state_.minibatches))
+        )
+    if chain_method == "processes":
+        if any(
+            arg is not None for arg in (trace_store, checkpoint_dir, resume, convergence, progress)
+        ):
+            raise ValueError(
+                "`trace_store`, `checkpoint_dir`, `resume`, `convergence` and `progress` are "
+                'not supported with `chain_method="processes"`'
+            )
+        return sample_processes(
+            model,
+            num_chains=num_chains,
+            seed=stateless_seed(seed),
+            num_workers=num_workers,
+            num_samples=num_samples,
+            burn_in=burn_in,
+            step_size=step_size,
+            observed=observed,
+            state=state,
+            nuts_kwargs=nuts_kwargs,
+            adaptation_kwargs=adaptation_kwargs,
+            sample_chain_kwargs=sample_chain_kwargs,
+            xla=xla,
+            use_auto_batching=use_auto_batching,
+            use_compilation_cache=use_compilation_cache,
+            data_as_inputs=data_as_inputs,
+            chunk_size=chunk_size,
+            mass_matrix=mass_matrix,
+            mass_matrix_kwargs=mass_matrix_kwargs,
+            step=step,
+            var_names=var_names,
+            thin=thin,
+            stats=stats,
+            deterministics=deterministics,
+        )
+    elif chain_method != "vectorized":
+        raise ValueError(
+            'Unknown chain_method {!r}, use "vectorized" or "processes"'.format(chain_method)
+        )
+    init = dict(state_.all_unobserved_values)
+    init_keys = list(init)
+    nuts_arguments = dict(
+        nuts_kwargs=nuts_kwargs,
+        adaptation_kwargs=adaptation_kwargs,
+        mass_matrix=mass_matrix,
+        mass_matrix_kwargs=mass_matrix_kwargs,
+    )
+    if step is None:
+        step = NUTS(**nuts_arguments)
+    elif any(value is not None for value in nuts_arguments.values()):
+        raise ValueError(
+            "Can't use `step` together with the {} arguments, pass them to "
+            "`pymc4.inference.step_methods.NUTS` instead".format(list(nuts_arguments))
+        )
+    step = as_step_method(step, init_keys)
+    if isinstance(step, ReplicaExchange) and not use_auto_batching:
+        raise ValueError(
+            "Replica exchange evaluates the replicas as a batch of chains, it requires "
+            "`use_auto_batching=True`"
+        )
+    if thin < 1:
+        raise ValueError("thin should be a positive integer, got {}".format(thin))
+    if progress is not None and xla:
+        raise ValueError("Progress reports are sent from the host, they can't be used with XLA")
+    sample_chain_kwargs = dict(sample_chain_kwargs or dict())
+    if thin > 1:
+        if "num_steps_between_results" in sample_chain_kwargs:
+            raise ValueError(
+                "Can't use both `thin` and the `num_steps_between_results` sample_chain argument"
+            )
+        sample_chain_kwargs["num_steps_between_results"] = thin - 1
+    if var_names is not None:
+        unknown = set(var_names) - set(init_keys) - set(deterministic_names)
+        if unknown:
+            raise ValueError(
+                "Unknown variables {} in `var_names`, use any of {}".format(
+                    sorted(unknown), init_keys + list(deterministic_names)
+                )
+            )
+    if stats is not None and set(stats) - set(step.stat_names):
+        raise ValueError(
+            "Unknown sampler statistics {} in `stats`, the step methods record {}".format(
+                sorted(set(stats) - set(step.stat_names)), list(step.stat_names)
+            )
+        )
+    if deterministics not in ("trace", "posthoc", "skip"):
+        raise ValueError(
+            'Unknown deterministics mode {!r}, use "trace", "posthoc" or "skip"'.format(
+                deterministics
+            )
+        )
+    trace_selection = dict(
+        var_names=None if var_names is None else tuple(var_names),
+        stats=None if stats is None else tuple(stats),
+    )
+    traced_keys = select_names(init_keys, var_names)
+    traced_deterministics = select_names(deterministic_names, var_names)
+    stat_names = select_names(step.stat_names, stats)
+    postprocess = None
+    loop_keys, loop_deterministics = traced_keys, traced_deterministics
+    if deterministics != "trace":
+        loop_deterministics = []
+        if deterministics == "posthoc" and traced_deterministics:
+            # all the free variables are needed to compute the deterministics
+            loop_keys = init_keys
+            trace_selection["var_names"] = tuple(init_keys)
+            postprocess = make_posthoc_deterministics(
+                model,
+                init_keys,
+                dict(state_.observed_values, **{name: None for name in suppressed_observed}),
+                deterministic_names,
+                var_names=traced_deterministics,
+                keep=traced_keys,
+            )
+        else:
+            traced_deterministics = []
+    init_state = tile_init(list(init.values()), num_chains)
+    sharded = [k for k, v in state_.observed_values.items() if isinstance(v, ShardedData)]
+    overrides = state.observed_values if state is not None else (observed or {})
+    if set(sharded) & set(overrides):
+        raise ValueError(
+            "The sharded data of {} must be the observed values of the model itself, "
+            "they can not be overridden".format(sorted(set(sharded) & set(overrides)))
+        )
+    # sharded data is streamed by the model itself instead of being fed to the function
+    observed_values = {
+        k: tf.convert_to_tensor(v) for k, v in state_.observed_values.items() if k not in sharded
+    }
+    step_size = tf.convert_to_tensor(step_size, dtype_hint=init_state[0].dtype)
+    relax_data_shapes = data_as_inputs and not xla
+    if relax_data_shapes:
+        conditioners, rebuild_model = lift_conditioners(model)
+        input_signature = [
+            [tf.TensorSpec(part.shape, part.dtype) for part in init_state],
+            tf.TensorSpec(step_size.shape, step_size.dtype),
+            relaxed_signature(observed_values),
+            relaxed_signature(conditioners),
+            tf.TensorSpec([2], tf.int32),
+        ]
+    else:
+        conditioners, rebuild_model, input_signature = {}, None, None
+
+    checkpoint = None
+    if resume is not None:
+        if trace_store is not None:
+            raise ValueError("Can't use both `resume` and `trace_store` arguments")
+        checkpoint = load_checkpoint(resume)
+        chunk_size = chunk_size or checkpoint["config"]["chunk_size"]
+        checkpoint_dir = checkpoint_dir or resume
+        seed = checkpoint["seed"]
+    seed = stateless_seed(seed)
+    segmented = any(
+        arg is not None for arg in (chunk_size, trace_store, checkpoint_dir, convergence)
+    )
+    cache_key = None
+    run_chains = None
+    if use_compilation_cache:
+        try:
+            cache_key = (
+                model_key(model, lifted=conditioners),
+                shape_dtype_key(init),
+                shape_dtype_key(observed_values, relaxed=relax_data_shapes),
+                tuple(suppressed_observed),
+                tuple(deterministic_names),
+                deterministics,
+                None if segmented else num_samples,
+                num_chains,
+                burn_in,
+                use_auto_batching,
+                xla,
+                segmented,
+                freeze(step),
+                freeze(sample_chain_kwargs),
+                freeze(trace_selection),
+                progress,
+            )
+        except UncacheableError:
+            cache_key = None
+        else:
+            run_chains = compilation_cache.get(cache_key)
+    if run_chains is None:
+        common_kwargs = dict(
+            suppressed_observed=suppressed_observed,
+            num_chains=num_chains,
+            burn_in=burn_in,
+            step=step,
+            sample_chain_kwargs=sample_chain_kwargs,
+            use_auto_batching=use_auto_batching,
+            rebuild_model=rebuild_model,
+            deterministic_names=deterministic_names if deterministics == "trace" else (),
+            progress=progress,
+            **trace_selection,
+        )
+        if segmented:
+            run_chains = build_run_segment_function(
+                model, init_keys, relax_shapes=relax_data_shapes, **common_kwargs
+            )
+        else:
+            run_chains = build_run_chains_function(
+                model,
+                init_keys,
+                num_samples=num_samples,
+                input_signature=input_signature,
+                **common_kwargs,
+            )
+        if cache_key is not None:
+            compilation_cache.put(cache_key, run_chains)
+
+    if progress is not None:
+        next_draw = 0 if checkpoint is None else checkpoint["next_draw"]
+        progress.start(
+            step,
+            total_steps=burn_in + 1 + (num_samples - 1) * thin,
+            burn_in=burn_in,
+            first_step=0 if next_draw == 0 else burn_in + 1 + (next_draw - 1) * thin,
+        )
+    if segmented:
+        chunk_size = chunk_size or 100
+        segment_kwargs: Dict[str, Any] = dict()
+        if checkpoint_dir is not None:
+            config = dict(
+                num_samples=num_samples,
+                num_chains=num_chains,
+                burn_in=burn_in,
+                chunk_size=chunk_size,
+                init_keys=init_keys,
+                deterministic_names=list(deterministic_names),
+                step=repr(step),
+                convergence=repr(convergence),
+                thin=thin,
+                deterministics=deterministics,
+                **trace_selection,
+            )
+            if checkpoint is not None:
+                validate_checkpoint_config(checkpoint, config)
+                trace_store = NpyTraceStore(checkpoint["trace_directory"])
+                trace_store.restore(checkpoint["next_draw"])
+                init_state = checkpoint["current_state"]
+                segment_kwargs.update(
+                    start=checkpoint["next_draw"], kernel_results=checkpoint["kernel_results"]
+                )
+            elif trace_store is None:
+                trace_store = NpyTraceStore(os.path.join(checkpoint_dir, "trace"))
+            elif not isinstance(trace_store, NpyTraceStore):
+                raise ValueError(
+                    "Checkpointing requires the draws to be stored on disk, use a "
+                    "`pymc4.inference.storage.NpyTraceStore` as the `trace_store`"
+                )
+            segment_kwargs["segment_callback"] = Checkpointer(
+                checkpoint_dir, config, seed, trace_store.directory, every=checkpoint_every
+            )
+        if convergence is not None:
+            unknown = set(convergence.var_names or ()) - set(traced_keys + traced_deterministics)
+            if unknown:
+                raise ValueError(
+                    "Unknown variables {} in the convergence monitor, use any of the traced "
+                    "variables {}".format(sorted(unknown), traced_keys + traced_deterministics)
+                )
+            segment_kwargs["convergence"] = convergence
+        trace_store = sample_segmented(
+            run_chains,
+            init_state,
+            step_size,
+            observed_values,
+            conditioners,
+            loop_keys,
+            loop_deterministics,
+            stat_names,
+            trace_store=MemoryTraceStore() if trace_store is None else trace_store,
+            num_samples=num_samples,
+            num_chains=num_chains,
+            burn_in=burn_in,
+            chunk_size=chunk_size,
+            seed=seed,
+            xla=xla,
+            thin=thin,
+            postprocess=postprocess,
+            **segment_kwargs,
+        )
+        return trace_store.to_inference_data(observed_data=state_.observed_values)
+
+    if xla:
+        results, sample_stats = tf.xla.experimental.compile(
+            run_chains, inputs=[init_state, step_size, observed_values, conditioners, seed]
+        )
+    else:
+        results, sample_stats = run_chains(
+            init_state, step_size, observed_values, conditioners, seed
+        )
+
+    posterior, sampler_stats = split_sample_stats(
+        results, sample_stats, loop_keys, loop_deterministics, stat_names
+    )
+    if postprocess is not None:
+        posterior = {k: tf.convert_to_tensor(v) for k, v in postprocess(posterior).items()}
+    return trace_to_arviz(posterior, sampler_stats, observed_data=state_.observed_values)
+
+
+def sample_segmented(
+    run_segment: Callable,
+    init_state: List[Any],
+    step_size: Any,
+    observed_values: Dict[str, Any],
+    conditioners: Dict[str, Any],
+    init_keys: Sequence[str],
+    deterministic_names: Sequence[str],
+    stat_names: Sequence[str],
+    trace_store: TraceStore,
+    num_samples: int,
+    num_chains: int,
+    burn_in: int,
+    chunk_size: int,
+    seed: Any,
+    xla: bool = False,
+    thin: int = 1,
+    start: int = 0,
+    kernel_results: Any = None,
+    segment_callback: Optional[Callable[[int, List[Any], Any, bool], None]] = None,
+    convergence: Optional[ConvergenceMonitor] = None,
+    postprocess: Optional[Callable[[Dict[str, np.ndarray]], Dict[str, np.ndarray]]] = None,
+) -> TraceStore:
+    """Run the chains in segments of ``chunk_size`` draws streaming them to ``trace_store``.
+
+    Only the draws of the current segment are held in memory. The last draw and the final
+    kernel results of each segment are used to start the next one. Every segment continues
+    the stateless seeds of the steps of an uninterrupted run (see :func:`sample_chain`), so
+    the draws do not depend on ``chunk_size``, and a run that is resumed from ``start`` with
+    the ``kernel_results`` and state reached at that draw is identical to an uninterrupted
+    one. ``init_keys`` and ``deterministic_names`` are the names of the traced
+    variables, and ``thin`` the thinning of the draws: the segments after the first one start
+    with ``thin - 1`` steps, so that the draws stay evenly spaced. ``segment_callback`` is
+    called after each segment with the index of the next draw, the current state, the
+    kernel results and whether it is the last segment.
+    If a ``convergence`` monitor is given, it is updated with the draws of the free variables
+    (or of its ``var_names``) after each segment, and the run stops once it converges.
+    ``postprocess`` maps the draws of every segment to the draws that are stored, see
+    :func:`make_posthoc_deterministics`.
+    """
+    if start == 0:
+        trace_store.setup(num_chains=num_chains, num_samples=num_samples)
+    if convergence is not None:
+        monitored = convergence.var_names or init_keys
+        convergence.reset()
+        if start > 0 and convergence.update(
+            {k: v for k, v in trace_store.read()[0].items() if k in monitored}
+        ):
+            return trace_store
+    current_state = init_state
+    num_burnin_steps = burn_in if start == 0 else thin - 1
+    for start in range(start, num_samples, chunk_size):
+        num_results = min(chunk_size, num_samples - start)
+        segment_args = (
+            current_state,
+            step_size,
+            observed_values,
+            conditioners,
+            seed,
+            # the index of the first step of the segment in an uninterrupted run
+            0 if start == 0 else burn_in + 1 + (start - 1) * thin,
+            kernel_results,
+            num_results,
+            num_burnin_steps,
+        )
+        if xla:
+            results, sample_stats, current_state, kernel_results = tf.xla.experimental.compile(
+                lambda *args, pkr=kernel_results, n=num_results, b=num_burnin_steps: run_segment(
+                    *args, pkr, n, b
+                ),
+                inputs=list(segment_args[:6]),
+            )
+        else:
+            results, sample_stats, current_state, kernel_results = run_segment(*segment_args)
+        num_burnin_steps = thin - 1
+        posterior, sampler_stats = split_sample_stats(
+            results, sample_stats, init_keys, deterministic_names, stat_names
+        )
+        posterior = {k: np.swapaxes(v.numpy(), 1, 0) for k, v in posterior.items()}
+        if postprocess is not None:
+            posterior = postprocess(posterior)
+        trace_store.write(start, posterior, {k: v.numpy().T for k, v in sampler_stats.items()})
+        converged = convergence is not None and convergence.update(
+            {k: v for k, v in posterior.items() if k in monitored}
+        )
+        last = converged or start + num_results >= num_samples
+        if segment_callback is not None:
+            segment_callback(start + num_results, current_state, kernel_results, last)
+        if converged:
+            break
+    return trace_store
+
+
+def build_run_chains_function(
+    model: Model,
+    unobserved_keys: List[str],
+    suppressed_observed: Sequence[str] = (),
+    num_samples: int = 1000,
+    num_chains: int = 10,
+    burn_in: int = 100,
+    step: Optional[StepMethod] = None,
+    sample_chain_kwargs: Optional[Dict[str, Any]] = None,
+    use_auto_batching: bool = True,
+    rebuild_model: Optional[Callable[[Dict[str, Any]], Model]] = None,
+    input_signature: Optional[List[Any]] = None,
+    deterministic_names: Sequence[str] = (),
+    var_names: Optional[Sequence[str]] = None,
+    stats: Optional[Sequence[str]] = None,
+    progress: Optional[ProgressMonitor] = None,
+):
+    """Build the compiled function that runs the NUTS chains of a model.
+
+    The returned ``tf.function`` takes the tiled initial state, the initial step size,
+    a dictionary with the observed values, a dictionary with the lifted conditioners of
+    the model (see :func:`pymc4.inference.cache.lift_conditioners`), which are used to
+    condition the model again with ``rebuild_model``, and a stateless seed. Because the data
+    are inputs of the function instead of constants captured by it, the function can be
+    reused for any data with the same shapes and dtypes (or the same ranks and dtypes if
+    ``input_signature`` has relaxed shapes) without being traced again. Only the variables
+    in ``var_names`` and the sampler statistics in ``stats`` are traced, see
+    :func:`make_kernel_and_trace_fn`. The ``progress`` monitor is updated at every step.
+    """
+
+    @tf.function(autograph=False, input_signature=input_signature)
+    def run_chains(init, step_size, observed_values, conditioners, seed):
+        kernel, trace_fn = make_kernel_and_trace_fn(
+            model if rebuild_model is None else rebuild_model(conditioners),
+            unobserved_keys,
+            observed_values,
+            step_size,
+            suppressed_observed=suppressed_observed,
+            num_chains=num_chains,
+            burn_in=burn_in,
+            step=step,
+            use_auto_batching=use_auto_batching,
+            deterministic_names=deterministic_names,
+            var_names=var_names,
+            stats=stats,
+        )
+        _, (results, sample_stats), _ = sample_chain(
+            num_samples,
+            current_state=init,
+            kernel=kernel,
+            num_burnin_steps=burn_in,
+            trace_fn=trace_fn,
+            seed=seed,
+            progress=progress,
+            **(sample_chain_kwargs or dict()),
+        )
+
+        return results, sample_stats
+
+    return run_chains
+
+
+def build_run_segment_function(
+    model: Model,
+    unobserved_keys: List[str],
+    suppressed_observed: Sequence[str] = (),
+    num_chains: int = 10,
+    burn_in: int = 100,
+    step: Optional[StepMethod] = None,
+    sample_chain_kwargs: Optional[Dict[str, Any]] = None,
+    use_auto_batching: bool = True,
+    rebuild_model: Optional[Callable[[Dict[str, Any]], Model]] = None,
+    relax_shapes: bool = False,
+    deterministic_names: Sequence[str] = (),
+    var_names: Optional[Sequence[str]] = None,
+    stats: Optional[Sequence[str]] = None,
+    progress: Optional[ProgressMonitor] = None,
+):
+    """Build the compiled function that runs a segment of the NUTS chains of a model.
+
+    This is the segmented counterpart of :func:`build_run_chains_function`. The returned
+    ``tf.function`` takes the same inputs followed by the index of the first step of the
+    segment, the kernel results returned by the previous segment (``None`` for the first
+    one), the number of draws and the number of burn-in steps of the segment. It returns the
+    draws, the traced sampler statistics, the last state and the final kernel results, which
+    carry the step size adaptation state over to the next segment.
+    """
+
+    @tf.function(autograph=False, experimental_relax_shapes=relax_shapes)
+    def run_segment(
         init,
-        _deterministics_callback,
-        deterministic_names,
-        state_,
-    ) = build_logp_and_deterministic_functions(
+        step_size,
+        observed_values,
+        conditioners,
+        seed,
+        first_step,
+        previous_kernel_results,
+        num_results,
+        num_burnin_steps,
+    ):
+        kernel, trace_fn = make_kernel_and_trace_fn(
+            model if rebuild_model is None else rebuild_model(conditioners),
+            unobserved_keys,
+            observed_values,
+            step_size,
+            suppressed_observed=suppressed_observed,
+            num_chains=num_chains,
+            burn_in=burn_in,
+            step=step,
+            use_auto_batching=use_auto_batching,
+            deterministic_names=deterministic_names,
+            var_names=var_names,
+            stats=stats,
+        )
+        final_state, (results, sample_stats), final_kernel_results = sample_chain(
+            num_results,
+            current_state=init,
+            previous_kernel_results=previous_kernel_results,
+            first_step=first_step,
+            kernel=kernel,
+            num_burnin_steps=num_burnin_steps,
+            trace_fn=trace_fn,
+            seed=seed,
+            progress=progress,
+            **(sample_chain_kwargs or dict()),
+        )
+        return results, sample_stats, final_state, final_kernel_results
+
+    return run_segment
+
+
+def make_kernel_and_trace_fn(
+    model: Model,
+    unobserved_keys: Sequence[str],
+    observed_values: Dict[str, Any],
+    step_size: Any,
+    suppressed_observed: Sequence[str] = (),
+    num_chains: int = 10,
+    burn_in: int = 100,
+    step: Optional[StepMethod] = None,
+    use_auto_batching: bool = True,
+    deterministic_names: Sequence[str] = (),
+    var_names: Optional[Sequence[str]] = None,
+    stats: Optional[Sequence[str]] = None,
+):
+    """Build the transition kernel of a model and the function that traces its draws.
+
+    The kernel is built by the ``step`` method (NUTS by default, see
+    :mod:`pymc4.inference.step_methods`), which also records the sampler statistics.
+    ``trace_fn`` returns the parts of the state and the deterministics (named by
+    ``deterministic_names``) that are in ``var_names``, and the statistics in ``stats``.
+    ``None`` selects all of them.
+    """
+    observed = dict(observed_values)
+    observed.update({name: None for name in suppressed_observed})
+    logpfn, _deterministics_callback = make_logp_and_deterministic_functions(
         model,
+        unobserved_keys,
+        observed,
         num_chains=num_chains,
-        state=state,
-        observed=observed,
         collect_reduced_log_prob=use_auto_batching,
     )
-    init_state = list(init.values())
-    init_keys = list(init.keys())
+    logpfn = tf.function(logpfn, autograph=False)
+    _deterministics_callback = tf.function(_deterministics_callback, autograph=False)
     if use_auto_batching:
         parallel_logpfn = vectorize_logp_function(logpfn)
         deterministics_callback = vectorize_logp_function(_deterministics_callback)
-        init_state = tile_init(init_state, num_chains)
     else:
         parallel_logpfn = logpfn
         deterministics_callback = _deterministics_callback
-        init_state = tile_init(init_state, num_chains)
+
+    step = as_step_method(step, unobserved_keys)
+    state_indices = select_indices(unobserved_keys, var_names)
+    deterministic_indices = select_indices(deterministic_names, var_names)
+    stat_indices = select_indices(step.stat_names, stats)
 
     def trace_fn(current_state, pkr):
-        return (
-            pkr.inner_results.target_log_prob,
-            pkr.inner_results.leapfrogs_taken,
-            pkr.inner_results.has_divergence,
-            pkr.inner_results.energy,
-            pkr.inner_results.log_accept_ratio,
-        ) + tuple(deterministics_callback(*current_state))
-
-    @tf.function(autograph=False)
-    def run_chains(init, step_size):
-        nuts_kernel = mcmc.NoUTurnSampler(
-            target_log_prob_fn=parallel_logpfn, step_size=step_size, **(nuts_kwargs or dict())
+        sample_stats = step.sample_stats(pkr)
+        traced = tuple(sample_stats[i] for i in stat_indices)
+        if deterministic_indices:
+            deterministics = deterministics_callback(*current_state)
+            traced += tuple(deterministics[i] for i in deterministic_indices)
+        return [current_state[i] for i in state_indices], traced
+
+    kernel = step.make_kernel(parallel_logpfn, step_size, burn_in)
+    return kernel, trace_fn
+
+
+def select_names(names: Sequence[str], selection: Optional[Sequence[str]]) -> List[str]:
+    """Return the ``names`` that are in ``selection``, all of them if it is ``None``."""
+    return [names[i] for i in select_indices(names, selection)]
+
+
+def select_indices(names: Sequence[str], selection: Optional[Sequence[str]]) -> List[int]:
+    if selection is None:
+        return list(range(len(names)))
+    selection = set(selection)
+    return [i for i, name in enumerate(names) if name in selection]
+
+
+def sample_chain(
+    num_results: int,
+    current_state: List[Any],
+    kernel: tfp.mcmc.TransitionKernel,
+    trace_fn: Callable[[List[Any], Any], Any],
+    seed: Any,
+    previous_kernel_results: Any = None,
+    first_step: Any = 0,
+    progress: Optional[ProgressMonitor] = None,
+    num_burnin_steps: int = 0,
+    num_steps_between_results: int = 0,
+    parallel_iterations: int = 10,
+    name: Optional[str] = None,
+):
+    """Run a Markov chain and trace the values returned by ``trace_fn``.
+
+    This is ``tfp.mcmc.sample_chain`` with one difference: ``tfp.mcmc.sample_chain`` always
+    stacks the whole state of every draw, while here only the output of ``trace_fn`` is
+    traced. The variables that are not traced are never copied out of the sampling loop.
+    The seed of every step is ``seed`` folded with the index of the step, counted from
+    ``first_step``, instead of being split from the seed of the previous step. The draws of
+    a step then only depend on ``seed`` and its index, so a chain that is run in segments,
+    each one starting at the index where the previous one stopped, is identical to a chain
+    run in one go. If a ``progress`` monitor is given, it is updated after every step, see
+    :class:`pymc4.inference.progress.ProgressMonitor`.
+
+    Returns
+    -------
+    final_state : List[Any]
+        The state of the chain after the last step.
+    trace : Any
+        The outputs of ``trace_fn`` stacked over the ``num_results`` draws.
+    final_kernel_results : Any
+        The kernel results after the last step.
+    """
+    seed = tfp.random.sanitize_seed(seed, salt="mcmc.sample_chain")
+    with tf.name_scope(name or "mcmc_sample_chain"):
+        current_state = tf.nest.map_structure(tf.convert_to_tensor, current_state)
+        if previous_kernel_results is None:
+            previous_kernel_results = kernel.bootstrap_results(current_state)
+
+        def seeded_one_step(step, totals, *state_and_results):
+            step_seed = tf.random.experimental.stateless_fold_in(seed, step)
+            state, results = kernel.one_step(*state_and_results, seed=step_seed)
+            if progress is not None:
+                totals = progress.update(step, totals, results, last_step=last_step)
+            return [step + 1, totals, state, results]
+
+        def run_steps(step_state_and_results, num_steps):
+            return loop_util.smart_for_loop(
+                loop_num_iter=num_steps,
+                body_fn=seeded_one_step,
+                initial_loop_vars=list(step_state_and_results),
+                parallel_iterations=parallel_iterations,
+            )
+
+        first_step = tf.convert_to_tensor(first_step, dtype=tf.int32)
+        totals = () if progress is None else progress.initial_totals(previous_kernel_results)
+        last_step = (
+            first_step + num_burnin_steps + (num_results - 1) * (num_steps_between_results + 1)
         )
-        adapt_nuts_kernel = mcmc.DualAveragingStepSizeAdaptation(
-            inner_kernel=nuts_kernel,
-            num_adaptation_steps=burn_in,
-            step_size_getter_fn=lambda pkr: pkr.step_size,
-            log_accept_prob_getter_fn=lambda pkr: pkr.log_accept_ratio,
-            step_size_setter_fn=lambda pkr, new_step_size: pkr._replace(step_size=new_step_size),
-            **(adaptation_kwargs or dict()),
+        (_, _, final_state, final_kernel_results), trace = loop_util.trace_scan(
+            loop_fn=run_steps,
+            initial_state=(first_step, totals, current_state, previous_kernel_results),
+            elems=tf.one_hot(
+                indices=0,
+                depth=num_results,
+                on_value=1 + num_burnin_steps,
+                off_value=1 + num_steps_between_results,
+                dtype=tf.int32,
+            ),
+            trace_fn=lambda loop_vars: trace_fn(*loop_vars[2:]),
+            parallel_iterations=parallel_iterations,
         )
+    return final_state, trace, final_kernel_results
 
-        results, sample_stats = mcmc.sample_chain(
-            num_samples,
-            current_state=init,
-            kernel=adapt_nuts_kernel,
-            num_burnin_steps=burn_in,
-            trace_fn=trace_fn,
-            **(sample_chain_kwargs or dict()),
-        )
 
-        return results, sample_stats
+def make_posthoc_deterministics(
+    model: Model,
+    unobserved_keys: Sequence[str],
+    observed: Dict[str, Any],
+    deterministic_names: Sequence[str],
+    var_names: Optional[Sequence[str]] = None,
+    keep: Optional[Sequence[str]] = None,
+    batch_size: int = 1000,
+) -> Callable[[Dict[str, Any]], Dict[str, np.ndarray]]:
+    """Build a function that computes the deterministics of stored posterior draws.
 
-    if xla:
-        results, sample_stats = tf.xla.experimental.compile(
-            run_chains, inputs=[init_state, step_size]
+    The returned function takes a dictionary with the draws of the free variables, whose
+    first two axes are the chains and the draws (in any order), and returns a dictionary
+    with the free variables in ``keep`` (all of them by default) and the deterministics in
+    ``var_names``, with the same leading axes. The model is evaluated on vectorized
+    batches of ``batch_size`` draws by a single compiled function.
+    """
+    _, deterministics_callback = make_logp_and_deterministic_functions(
+        model, unobserved_keys, observed, num_chains=None, collect_reduced_log_prob=True
+    )
+    vectorized_callback = vectorize_logp_function(
+        tf.function(deterministics_callback, autograph=False)
+    )
+    indices = select_indices(deterministic_names, var_names)
+    keep = list(unobserved_keys) if keep is None else list(keep)
+
+    @tf.function(autograph=False, experimental_relax_shapes=True)
+    def compute_batch(*state):
+        values = vectorized_callback(*state)
+        return [values[i] for i in indices]
+
+    def postprocess(posterior):
+        missing = [name for name in unobserved_keys if name not in posterior]
+        if missing:
+            raise ValueError(
+                "The deterministics can not be computed without the draws of {}".format(missing)
+            )
+        leading = tuple(np.shape(posterior[unobserved_keys[0]])[:2])
+        size = int(np.prod(leading))
+        flat = [
+            np.reshape(posterior[name], (size,) + np.shape(posterior[name])[2:])
+            for name in unobserved_keys
+        ]
+        batches = [
+            compute_batch(*[part[start : start + batch_size] for part in flat])
+            for start in range(0, size, batch_size)
+        ]
+        result = {name: np.asarray(posterior[name]) for name in keep}
+        for i, index in enumerate(indices):
+            value = np.concatenate([batch[i].numpy() for batch in batches])
+            result[deterministic_names[index]] = value.reshape(leading + value.shape[1:])
+        return result
+
+    return postprocess
+
+
+def compute_deterministics(
+    model: Model,
+    trace: Any,
+    observed: Optional[Dict[str, Any]] = None,
+    state: Optional[flow.SamplingState] = None,
+    var_names: Optional[Sequence[str]] = None,
+    batch_size: int = 1000,
+) -> xr.Dataset:
+    """Compute the deterministics of a model for the posterior draws of a trace.
+
+    This is useful after sampling with ``deterministics="skip"``. The model is evaluated
+    on vectorized batches of ``batch_size`` draws.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+    trace : Union[az.InferenceData, Dict[str, Any]]
+        The trace returned by :func:`sample`, or a dictionary with the draws of all the free
+        variables with shape ``(num_chains, num_draws, *shape)``.
+    observed : Optional[Dict[str, Any]]
+        The observed values used for sampling, if they were overridden.
+    state : Optional[pymc4.flow.SamplingState]
+        The state used for sampling, if any.
+    var_names : Optional[Sequence[str]]
+        The deterministics to compute. Defaults to all of them.
+    batch_size : int
+        The number of draws evaluated at once.
+
+    Returns
+    -------
+    deterministics : xarray.Dataset
+        The values of the deterministics, with the ``chain`` and ``draw`` dimensions of the
+        posterior group of ArviZ's InferenceData objects.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def model():
+    ...     x = yield pm.Normal("x", 0, 1)
+    ...     yield pm.Deterministic("y", x + 1)
+    >>> trace = pm.sample(model(), num_samples=10, num_chains=2, deterministics="skip")
+    >>> values = compute_deterministics(model(), trace, var_names=["model/y"])
+    >>> trace.posterior = trace.posterior.merge(values)
+    >>> trace.posterior["model/y"].shape
+    (2, 10)
+    """
+    state_, deterministic_names, suppressed_observed = initialize_state(
+        model, observed=observed, state=state
+    )
+    if var_names is not None and set(var_names) - set(deterministic_names):
+        raise ValueError(
+            "Unknown deterministics {}, use any of {}".format(
+                sorted(set(var_names) - set(deterministic_names)), deterministic_names
+            )
         )
-    else:
-        results, sample_stats = run_chains(init_state, step_size)
+    unobserved_keys = list(state_.all_unobserved_values)
+    posterior = trace.posterior if hasattr(trace, "posterior") else trace
+    postprocess = make_posthoc_deterministics(
+        model,
+        unobserved_keys,
+        dict(state_.observed_values, **{name: None for name in suppressed_observed}),
+        deterministic_names,
+        var_names=var_names,
+        keep=[],
+        batch_size=batch_size,
+    )
+    return az.convert_to_dataset(
+        postprocess({name: np.asarray(posterior[name]) for name in unobserved_keys})
+    )
 
+
+def split_sample_stats(
+    results: Sequence[Any],
+    sample_stats: Sequence[Any],
+    init_keys: Sequence[str],
+    deterministic_names: Sequence[str],
+    stat_names: Sequence[str] = NUTS.stat_names,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Split the values traced by ``trace_fn`` into the posterior and the sampler statistics."""
     posterior = dict(zip(init_keys, results))
-    # Keep in sync with pymc3 naming convention
-    stat_names = ["lp", "tree_size", "diverging", "energy", "mean_tree_accept"]
     if len(sample_stats) > len(stat_names):
         deterministic_values = sample_stats[len(stat_names) :]
         sample_stats = sample_stats[: len(stat_names)]
     sampler_stats = dict(zip(stat_names, sample_stats))
     if len(deterministic_names) > 0:
         posterior.update(dict(zip(deterministic_names, deterministic_values)))
+    return posterior, sampler_stats
 
-    return trace_to_arviz(posterior, sampler_stats, observed_data=state_.observed_values)
 
+def initialize_state(
+    model: Model, observed: Optional[dict] = None, state: Optional[flow.SamplingState] = None
+) -> Tuple[flow.SamplingState, List[str], List[str]]:
+    """Validate the sampling arguments and initialize the model's sampling state.
 
-def build_logp_and_deterministic_functions(
-    model,
-    num_chains: Optional[int] = None,
-    observed: Optional[dict] = None,
-    state: Optional[flow.SamplingState] = None,
-    collect_reduced_log_prob: bool = True,
-):
+    Returns
+    -------
+    state: pymc4.flow.SamplingState
+        The model's sampling state
+    deterministic_names: List[str]
+        The list of names of the model's deterministics
+    suppressed_observed: List[str]
+        The names of the observed variables that were explicitly set to ``None`` and
+        have to be treated as unobserved
+    """
     if not isinstance(model, Model):
         raise TypeError(
             "`sample` function only supports `pymc4.Model` objects, but you've passed `{}`".format(
@@ -200,69 +1092,122 @@ def build_logp_and_deterministic_functions(
     if state is not None and observed is not None:
         raise ValueError("Can't use both `state` and `observed` arguments")
 
+    overrides = state.observed_values if state is not None else (observed or {})
+    suppressed_observed = [name for name, value in overrides.items() if value is None]
+
     state, deterministic_names = initialize_sampling_state(model, observed=observed, state=state)
 
     if not state.all_unobserved_values:
         raise ValueError(
             f"Can not calculate a log probability: the model {model.name or ''} has no unobserved values."
         )
+    return state, deterministic_names, suppressed_observed
 
-    observed_var = state.observed_values
-    unobserved_keys, unobserved_values = zip(*state.all_unobserved_values.items())
 
-    if collect_reduced_log_prob:
+def make_logp_and_deterministic_functions(
+    model: Model,
+    unobserved_keys: Sequence[str],
+    observed: Dict[str, Any],
+    num_chains: Optional[int] = None,
+    collect_reduced_log_prob: bool = True,
+    use_ir: bool = True,
+):
+    """Build the log probability and deterministics functions of a model.
 
-        @tf.function(autograph=False)
-        def logpfn(*values, **kwargs):
-            if kwargs and values:
-                raise TypeError("Either list state should be passed or a dict one")
-            elif values:
-                kwargs = dict(zip(unobserved_keys, values))
-            st = flow.SamplingState.from_values(kwargs, observed_values=observed)
-            _, st = flow.evaluate_model_transformed(model, state=st)
-            return st.collect_log_prob()
+    The returned functions are not compiled and ``observed`` may hold symbolic tensors, so
+    they can be created inside a ``tf.function`` that receives the observed values as inputs.
 
-    else:
+    With ``use_ir``, the model is compiled to a :class:`pymc4.flow.ir.ModelIR` the first
+    time one of the functions is called, and later calls evaluate it instead of the model.
+    The model is still evaluated by the executor if it can not be compiled or with manual
+    batching.
+    """
+    if not collect_reduced_log_prob and num_chains is not None:
         # When we use manual batching, we need to manually tile the chains axis
         # to the left of the observed tensors
-        if num_chains is not None:
-            obs = state.observed_values
-            if observed is not None:
-                obs.update(observed)
-            else:
-                observed = obs
-            for k, o in obs.items():
-                o = tf.convert_to_tensor(o)
-                o = tf.tile(o[None, ...], [num_chains] + [1] * o.ndim)
-                observed[k] = o
-
-        @tf.function(autograph=False)
-        def logpfn(*values, **kwargs):
-            if kwargs and values:
-                raise TypeError("Either list state should be passed or a dict one")
-            elif values:
+        observed = {
+            k: None if o is None else tile_observed(o, num_chains) for k, o in observed.items()
+        }
+
+    # the names are parsed once, not at every evaluation
+    layout = flow.StateLayout(unobserved_keys)
+
+    def evaluate_state(values, kwargs):
+        if kwargs and values:
+            raise TypeError("Either list state should be passed or a dict one")
+        elif len(values) == len(layout.names):
+            st = layout.state(values, observed)
+        else:
+            if values:
                 kwargs = dict(zip(unobserved_keys, values))
             st = flow.SamplingState.from_values(kwargs, observed_values=observed)
-            _, st = flow.evaluate_model_transformed(model, state=st)
+        _, st = flow.evaluate_model_transformed(model, state=st)
+        return st
+
+    compiled: Dict[str, Optional[flow.ModelIR]] = dict()
+
+    def ir_inputs(values, kwargs):
+        if not (use_ir and collect_reduced_log_prob):
+            return None, None
+        if "ir" not in compiled:
+            compiled["ir"] = flow.build_model_ir(model, unobserved_keys, observed)
+        model_ir = compiled["ir"]
+        if model_ir is None or (kwargs and values):
+            return None, None
+        if kwargs:
+            if set(kwargs) != set(unobserved_keys):
+                return None, None
+            values = [kwargs[name] for name in unobserved_keys]
+        return model_ir, model_ir.as_inputs(values, observed)
+
+    def logpfn(*values, **kwargs):
+        model_ir, inputs = ir_inputs(values, kwargs)
+        if inputs is not None:
+            return model_ir.log_prob_function(*inputs)
+        st = evaluate_state(values, kwargs)
+        if collect_reduced_log_prob:
+            return st.collect_log_prob()
+        else:
             return st.collect_unreduced_log_prob()
 
-    @tf.function(autograph=False)
     def deterministics_callback(*values, **kwargs):
-        if kwargs and values:
-            raise TypeError("Either list state should be passed or a dict one")
-        elif values:
-            kwargs = dict(zip(unobserved_keys, values))
-        st = flow.SamplingState.from_values(kwargs, observed_values=observed_var)
-        _, st = flow.evaluate_model_transformed(model, state=st)
-        for transformed_name in st.transformed_values:
-            untransformed_name = NameParts.from_name(transformed_name).full_untransformed_name
-            st.deterministics[untransformed_name] = st.untransformed_values.pop(untransformed_name)
-        return st.deterministics.values()
+        model_ir, inputs = ir_inputs(values, kwargs)
+        if inputs is not None:
+            return model_ir.deterministics_function(*inputs)
+        st = evaluate_state(values, kwargs)
+        if kwargs:
+            return list(flow.collect_deterministics(st).values())
+        return layout.deterministics(st)
+
+    return logpfn, deterministics_callback
+
+
+def build_logp_and_deterministic_functions(
+    model,
+    num_chains: Optional[int] = None,
+    observed: Optional[dict] = None,
+    state: Optional[flow.SamplingState] = None,
+    collect_reduced_log_prob: bool = True,
+):
+    state, deterministic_names, suppressed_observed = initialize_state(
+        model, observed=observed, state=state
+    )
+    observed_values = dict(state.observed_values)
+    observed_values.update({name: None for name in suppressed_observed})
+    # evaluate the variables observed on minibatches on the batch current at each evaluation
+    observed_values.update(state.minibatches)
+    logpfn, deterministics_callback = make_logp_and_deterministic_functions(
+        model,
+        list(state.all_unobserved_values),
+        observed_values,
+        num_chains=num_chains,
+        collect_reduced_log_prob=collect_reduced_log_prob,
+    )
 
     return (
-        logpfn,
+        tf.function(logpfn, autograph=False),
         dict(state.all_unobserved_values),
-        deterministics_callback,
+        tf.function(deterministics_callback, autograph=False),
         deterministic_names,
         state,
     )
@@ -271,10 +1216,35 @@ def build_logp_and_deterministic_functions(
 def vectorize_logp_function(logpfn):
     # TODO: vectorize with dict
     def vectorized_logpfn(*state):
+        if all(part.shape[:1] == [1] for part in state):
+            # a single chain: vectorized_map would gather it, and the gradient of the
+            # gather is an IndexedSlices that the MCMC kernels can not handle
+            return tf.nest.map_structure(
+                lambda value: value[None], logpfn(*[part[0] for part in state])
+            )
         return tf.vectorized_map(lambda mini_state: logpfn(*mini_state), state)
 
     return vectorized_logpfn
 
 
+def stateless_seed(seed):
+    """Convert an integer seed to the ``[2]`` int32 stateless seed used by the chains.
+
+    Integers are expanded with ``np.random.SeedSequence``, which, unlike
+    ``tfp.random.sanitize_seed``, always maps the same integer to the same stateless seed.
+    ``None`` draws the seed from TensorFlow's global random generator, and stateless seeds
+    are returned as they are.
+    """
+    if seed is None or tf.is_tensor(seed) or np.ndim(seed) == 1:
+        return tfp.random.sanitize_seed(seed)
+    state = np.random.SeedSequence(seed).generate_state(2, dtype=np.uint32)
+    return tf.convert_to_tensor(state.view(np.int32))
+
+
 def tile_init(init, num_repeats):
     return [tf.tile(tf.expand_dims(tens, 0), [num_repeats] + [1] * tens.ndim) for tens in init]
+
+
+def tile_observed(observed, num_repeats):
+    observed = tf.convert_to_tensor(observed)
+    return tf.tile(observed[None, ...], [num_repeats] + [1] * observed.shape.rank)
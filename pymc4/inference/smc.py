@@ -0,0 +1,335 @@
+"""Sequential Monte Carlo (SMC) sampling.
+
+SMC moves a population of particles from the prior to the posterior through a sequence of
+tempered distributions ``prior * likelihood ** beta``, with ``beta`` increasing from 0 to 1.
+At every stage, ``beta`` is chosen so that the effective sample size of the reweighted
+particles stays above a threshold, the particles are resampled by weight and then
+rejuvenated with a few steps of a random walk Metropolis-Hastings or HMC kernel. Because
+the particles start from independent prior draws and are never attracted to a single
+mode, SMC explores multimodal posteriors better than NUTS. The normalizing constants of
+the successive reweightings give an estimate of the log marginal likelihood of the model.
+
+The particles are initialized with vectorized prior draws, like ``sample_prior_predictive``,
+and the log probability of all of them is evaluated in a single batched call, so that the
+whole run is a single TensorFlow graph.
+"""
+from typing import Any, Dict, Optional
+
+import numpy as np
+import arviz as az
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from pymc4.coroutine_model import Model
+from pymc4 import flow
+from pymc4.data import ShardedData
+from pymc4.inference.sampling import (
+    initialize_state,
+    make_posthoc_deterministics,
+    stateless_seed,
+    vectorize_logp_function,
+)
+from pymc4.inference.utils import trace_to_arviz
+
+
+__all__ = ["sample_smc"]
+
+
+_kernels = {
+    "rwmh": lambda num_leapfrog_steps: tfp.experimental.mcmc.make_rwmh_kernel_fn,
+    "hmc": lambda num_leapfrog_steps: tfp.experimental.mcmc.gen_make_hmc_kernel_fn(
+        num_leapfrog_steps
+    ),
+}
+
+
+def sample_smc(
+    model: Model,
+    num_particles: int = 1000,
+    num_chains: int = 1,
+    kernel: str = "rwmh",
+    num_leapfrog_steps: int = 10,
+    min_num_steps: int = 2,
+    max_num_steps: int = 25,
+    max_stage: int = 100,
+    ess_threshold_ratio: float = 0.5,
+    seed: Optional[Any] = None,
+    observed: Optional[Dict[str, Any]] = None,
+    state: Optional[flow.SamplingState] = None,
+    xla: bool = False,
+) -> az.InferenceData:
+    """Sample from the posterior of a model with tempered Sequential Monte Carlo.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+        Model to sample posterior for
+    num_particles : int
+        The number of particles of each chain. The particles are returned as the draws.
+    num_chains : int
+        The number of independent SMC runs, which are batched together.
+    kernel : str
+        The kernel that rejuvenates the particles: ``"rwmh"`` (random walk
+        Metropolis-Hastings, the default) or ``"hmc"``. The scale of the steps is tuned
+        from the covariance of the particles and their acceptance rate at every stage.
+    num_leapfrog_steps : int
+        The number of leapfrog steps of the ``"hmc"`` kernel.
+    min_num_steps : int
+        The smallest number of kernel steps in a rejuvenation.
+    max_num_steps : int
+        The largest number of kernel steps in a rejuvenation. The number of steps is tuned
+        from the acceptance rate of the previous stage.
+    max_stage : int
+        The largest number of tempering stages. A ``ValueError`` is raised if some chain
+        does not reach the posterior, at an inverse temperature of 1, in that many stages.
+    ess_threshold_ratio : float
+        The effective sample size, relative to ``num_particles``, that the next inverse
+        temperature keeps.
+    seed : Optional[Any]
+        The seed of the run. If ``None``, the seed is drawn from TensorFlow's global random
+        generator.
+    observed : Optional[Dict[str, Any]]
+        Override the observed values of the model.
+    state : Optional[pymc4.flow.SamplingState]
+        Alternative way to pass the observed values.
+    xla : bool
+        Compile the run with XLA.
+
+    Returns
+    -------
+    ArviZ's InferenceData object
+        The particles are the draws of the posterior group. The attributes of the
+        ``sample_stats`` group hold the ``log_marginal_likelihood`` of each chain and the
+        ``num_stages`` of the run. The statistics of the particles are their
+        ``likelihood_log_prob`` and the ``inverse_temperature`` they reached.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def two_modes():
+    ...     x = yield pm.Normal("x", 0, 5)
+    ...     yield pm.Normal("y", x ** 2, 1, observed=9.0)
+    >>> trace = pm.sample_smc(two_modes(), num_particles=500, seed=1)
+    >>> trace.posterior["two_modes/x"].shape
+    (1, 500)
+    >>> float((trace.posterior["two_modes/x"] > 0).mean().round(1))
+    0.5
+    """
+    if kernel not in _kernels:
+        raise ValueError("Unknown kernel {!r}, use any of {}".format(kernel, list(_kernels)))
+    state_, deterministic_names, suppressed_observed = initialize_state(
+        model, observed=observed, state=state
+    )
+    unsupported = sorted(state_.minibatches) + [
+        k for k, v in state_.observed_values.items() if isinstance(v, ShardedData)
+    ]
+    if unsupported:
+        raise ValueError(
+            "The variables {} are observed on minibatches or sharded data, which "
+            "`sample_smc` does not support".format(unsupported)
+        )
+    unobserved_keys = list(state_.all_unobserved_values)
+    observed_values = dict(state_.observed_values)
+    observed_values.update({name: None for name in suppressed_observed})
+    num_draws = num_particles * num_chains
+
+    def prior_draw(index, seed):
+        seed = tf.random.experimental.stateless_fold_in(seed, index)
+        _, st = flow.evaluate_model_transformed(model, observed=observed_values, seed=seed)
+        return [st.all_unobserved_values[k] for k in unobserved_keys]
+
+    def log_prob_parts(*values):
+        st = flow.SamplingState.from_values(
+            dict(zip(unobserved_keys, values)), observed_values=observed_values
+        )
+        _, st = flow.evaluate_model_transformed(model, state=st)
+        prior, likelihood = st.collect_log_prob_parts()
+        return tf.convert_to_tensor(prior), tf.convert_to_tensor(likelihood, dtype_hint=prior.dtype)
+
+    batched_log_prob_parts = vectorize_logp_function(tf.function(log_prob_parts, autograph=False))
+
+    def particles_log_prob_parts(*particles):
+        # the particles have the shape [num_particles, num_chains, ...]
+        flat = [tf.reshape(p, tf.concat([[-1], tf.shape(p)[2:]], axis=0)) for p in particles]
+        return [
+            tf.reshape(part, tf.shape(particles[0])[:2]) for part in batched_log_prob_parts(*flat)
+        ]
+
+    def make_tempered_target_log_prob_fn(beta):
+        def tempered_target_log_prob(*particles):
+            prior, likelihood = particles_log_prob_parts(*particles)
+            return prior + likelihood * beta
+
+        return tempered_target_log_prob
+
+    make_kernel_fn = _kernels[kernel](num_leapfrog_steps)
+    resample = tfp.experimental.mcmc.weighted_resampling.resample
+
+    def mutate(particles, log_scalings, num_steps, beta, seed):
+        kernel = make_kernel_fn(
+            make_tempered_target_log_prob_fn(beta), particles, tf.exp(log_scalings)
+        )
+
+        def one_step(i, seed, particles, kernel_results, log_accept_prob_sum):
+            step_seed, seed = tfp.random.split_seed(seed)
+            particles, kernel_results = kernel.one_step(particles, kernel_results, seed=step_seed)
+            log_accept_prob = tf.minimum(kernel_results.log_accept_ratio, 0.0)
+            return (
+                i + 1,
+                seed,
+                particles,
+                kernel_results,
+                tf.math.reduce_logsumexp([log_accept_prob_sum, log_accept_prob], axis=0),
+            )
+
+        kernel_results = kernel.bootstrap_results(particles)
+        _, _, particles, _, log_accept_prob_sum = tf.while_loop(
+            lambda i, *_: i < num_steps,
+            one_step,
+            (
+                0,
+                seed,
+                particles,
+                kernel_results,
+                tf.fill(tf.shape(log_scalings), tf.constant(-np.inf, log_scalings.dtype)),
+            ),
+        )
+        log_accept_prob = log_accept_prob_sum - tf.math.log(tf.cast(num_steps, log_scalings.dtype))
+        return particles, log_accept_prob
+
+    def next_inverse_temperature(beta, likelihood):
+        # the largest inverse temperature whose weights keep the effective sample size
+        # above the threshold, found by bisection
+        threshold = tf.cast(num_particles * ess_threshold_ratio, likelihood.dtype)
+
+        def ess(new_beta):
+            log_weights = (new_beta - beta) * likelihood
+            return tf.exp(
+                2 * tf.reduce_logsumexp(log_weights, axis=0)
+                - tf.reduce_logsumexp(2 * log_weights, axis=0)
+            )
+
+        def bisect(i, lower, upper):
+            middle = (lower + upper) / 2
+            above = ess(middle) >= threshold
+            return i + 1, tf.where(above, middle, lower), tf.where(above, upper, middle)
+
+        _, lower, _ = tf.while_loop(lambda i, *_: i < 50, bisect, (0, beta, tf.ones_like(beta)))
+        return tf.where(ess(tf.ones_like(beta)) >= threshold, tf.ones_like(beta), lower)
+
+    @tf.function(autograph=False, jit_compile=xla)
+    def run_smc(seed):
+        prior_seed, seed = tfp.random.split_seed(seed)
+        draws = tf.vectorized_map(lambda index: prior_draw(index, prior_seed), tf.range(num_draws))
+        particles = [
+            tf.reshape(draw, tf.concat([[num_particles, num_chains], tf.shape(draw)[1:]], 0))
+            for draw in draws
+        ]
+        likelihood = particles_log_prob_parts(*particles)[1]
+        dtype = likelihood.dtype
+        dimension = sum(int(np.prod(particle.shape[2:])) for particle in particles)
+        # the optimal scaling of a random walk for a normal target of the same dimension
+        log_scalings = tf.fill(
+            tf.shape(likelihood), tf.constant(np.log(min(2.38**2 / dimension, 1.0)), dtype)
+        )
+
+        def stage(
+            i,
+            seed,
+            particles,
+            likelihood,
+            log_scalings,
+            log_accept_prob,
+            num_steps,
+            beta,
+            log_marginal_likelihood,
+        ):
+            resample_seed, mutate_seed, seed = tfp.random.split_seed(seed, n=3)
+            new_beta = next_inverse_temperature(beta, likelihood)
+            log_weights = (new_beta - beta) * likelihood
+            log_marginal_likelihood += tfp.math.reduce_logmeanexp(log_weights, axis=0)
+            (particles, (log_scalings, log_accept_prob)), _, _ = resample(
+                (particles, (log_scalings, log_accept_prob)),
+                log_weights,
+                tfp.experimental.mcmc.resample_systematic,
+                seed=resample_seed,
+            )
+            # tune the kernel from the acceptance rate of the previous rejuvenation
+            tuned_num_steps, tuned_log_scalings = tfp.experimental.mcmc.simple_heuristic_tuning(
+                num_steps, log_scalings, log_accept_prob
+            )
+            num_steps = tf.clip_by_value(
+                tf.where(i > 0, tuned_num_steps, num_steps), min_num_steps, max_num_steps
+            )
+            log_scalings = tf.where(i > 0, tuned_log_scalings, log_scalings)
+            particles, log_accept_prob = mutate(
+                particles, log_scalings, num_steps, new_beta, mutate_seed
+            )
+            likelihood = particles_log_prob_parts(*particles)[1]
+            return (
+                i + 1,
+                seed,
+                particles,
+                likelihood,
+                log_scalings,
+                log_accept_prob,
+                num_steps,
+                new_beta,
+                log_marginal_likelihood,
+            )
+
+        def not_tempered(i, *args):
+            beta = args[-2]
+            return (i < max_stage) & tf.reduce_any(beta < 1)
+
+        beta = tf.zeros([num_chains], dtype)
+        (
+            num_stages,
+            _,
+            particles,
+            likelihood,
+            _,
+            _,
+            _,
+            beta,
+            log_marginal_likelihood,
+        ) = tf.while_loop(
+            not_tempered,
+            stage,
+            (
+                0,
+                seed,
+                particles,
+                likelihood,
+                log_scalings,
+                tf.zeros_like(likelihood),
+                tf.constant(max_num_steps),
+                beta,
+                tf.zeros_like(beta),
+            ),
+        )
+        return num_stages, particles, likelihood, beta, log_marginal_likelihood
+
+    num_stages, particles, likelihood, beta, log_marginal_likelihood = run_smc(stateless_seed(seed))
+    if np.any(beta.numpy() < 1):
+        # the particles are drawn from a tempered posterior
+        raise ValueError(
+            "The chains reached the inverse temperatures {} instead of 1 after {} stages, "
+            "increase `max_stage`".format(beta.numpy().tolist(), int(num_stages))
+        )
+    posterior = {k: v.numpy() for k, v in zip(unobserved_keys, particles)}
+    postprocess = make_posthoc_deterministics(
+        model, unobserved_keys, observed_values, deterministic_names
+    )
+    trace = trace_to_arviz(
+        {k: tf.convert_to_tensor(v) for k, v in postprocess(posterior).items()},
+        {
+            "likelihood_log_prob": likelihood,
+            "inverse_temperature": tf.broadcast_to(beta, tf.shape(likelihood)),
+        },
+        observed_data=state_.observed_values,
+    )
+    trace.sample_stats.attrs["log_marginal_likelihood"] = log_marginal_likelihood.numpy()
+    trace.sample_stats.attrs["num_stages"] = int(num_stages)
+    return trace
@@ -0,0 +1,795 @@
+"""Step methods that ``pm.sample`` can use to draw from the posterior.
+
+A step method builds the ``tfp.mcmc`` transition kernel that updates some (or all) of the
+unobserved variables of a model and picks the sampler statistics that are traced along
+with the draws. Gradient based methods (:class:`NUTS`, :class:`HMC`) are usually the
+most efficient ones for continuous variables, while gradient free methods
+(:class:`RandomWalkMetropolis`, :class:`Slice`) can be used for discrete variables, or
+for cheap blocks of variables that do not need to pay for gradient evaluations. Different
+step methods can be assigned to different groups of variables with a
+:class:`CompoundStep`, which updates each group in turn conditioned on the others, as in
+a Gibbs sampler. :class:`ReplicaExchange` runs tempered replicas of another step method to
+sample from multimodal posteriors.
+
+Examples
+--------
+>>> import pymc4 as pm
+>>> @pm.model
+... def model():
+...     mu = yield pm.Normal("mu", 0, 1)
+...     k = yield pm.Poisson("k", 3.0)
+>>> step = [NUTS(var_names=["model/mu"]), RandomWalkMetropolis(["model/k"], discrete=True)]
+>>> trace = pm.sample(model(), step=step, num_samples=10, burn_in=10)
+"""
+import collections
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import tensorflow as tf
+import tensorflow_probability as tfp
+from tensorflow_probability import mcmc
+
+from pymc4.inference.adaptation import MassMatrixAdaptation
+from pymc4.inference.cache import freeze
+from pymc4.utils import NameParts
+
+
+__all__ = [
+    "StepMethod",
+    "NUTS",
+    "HMC",
+    "RandomWalkMetropolis",
+    "Slice",
+    "ReplicaExchange",
+    "CompoundStep",
+    "CompoundKernel",
+    "ReplicaExchangeKernel",
+    "as_step_method",
+]
+
+
+class StepMethod:
+    """Base class of the step methods.
+
+    Subclasses set their ``stat_names`` and implement :meth:`make_kernel` and
+    :meth:`sample_stats`.
+
+    Parameters
+    ----------
+    var_names : Optional[Sequence[str]]
+        The names of the variables that are updated by this step method, as they appear in
+        ``state.all_unobserved_values`` (auto transformed variables can also be named by
+        their untransformed name). ``None`` means all the variables.
+    """
+
+    stat_names: Tuple[str, ...] = ("lp",)
+
+    def __init__(self, var_names: Optional[Sequence[str]] = None, **parameters):
+        self.var_names = None if var_names is None else list(var_names)
+        self.parameters = parameters
+
+    def make_kernel(
+        self, target_log_prob_fn: Callable, step_size: Any, num_adaptation_steps: int
+    ) -> mcmc.TransitionKernel:
+        """Build the transition kernel of the step method.
+
+        Parameters
+        ----------
+        target_log_prob_fn : Callable
+            The log probability of the state parts updated by the step method, batched
+            over the chains.
+        step_size : Any
+            The initial step size passed to ``pm.sample``. Step methods that were given
+            their own step size ignore it.
+        num_adaptation_steps : int
+            The number of burn in steps, during which the kernel can be tuned.
+        """
+        raise NotImplementedError
+
+    def sample_stats(self, kernel_results: Any) -> Tuple[Any, ...]:
+        """Return the sampler statistics, in the order of ``stat_names``, from the results."""
+        raise NotImplementedError
+
+    def current_step_size(self, kernel_results: Any) -> Optional[Any]:
+        """Return the current step size from the results, ``None`` if there is none."""
+        return None
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        arguments = ["{}={!r}".format(k, v) for k, v in self.parameters.items()]
+        if self.var_names is not None:
+            arguments.insert(0, "var_names={!r}".format(self.var_names))
+        return "{}({})".format(self.__class__.__name__, ", ".join(arguments))
+
+    def _key(self):
+        return (
+            type(self),
+            None if self.var_names is None else tuple(self.var_names),
+            freeze(self.parameters),
+        )
+
+
+def _make_step_size_adaptation(kernel, num_adaptation_steps, adaptation_kwargs):
+    return mcmc.DualAveragingStepSizeAdaptation(
+        inner_kernel=kernel, num_adaptation_steps=num_adaptation_steps, **adaptation_kwargs
+    )
+
+
+class NUTS(StepMethod):
+    """The No-U-Turn sampler with dual averaging step size adaptation.
+
+    Parameters
+    ----------
+    var_names : Optional[Sequence[str]]
+    step_size : Optional[float]
+        The initial step size. If ``None``, the ``step_size`` passed to ``pm.sample`` is
+        used.
+    nuts_kwargs : Optional[Dict[str, Any]]
+        Pass non-default values for the ``tfp.mcmc.NoUTurnSampler`` kernel.
+    adaptation_kwargs : Optional[Dict[str, Any]]
+        Pass non-default values for the ``tfp.mcmc.DualAveragingStepSizeAdaptation`` kernel.
+    mass_matrix : Optional[str]
+        Also adapt a ``"diag"`` or ``"dense"`` mass matrix, see
+        :class:`pymc4.inference.adaptation.MassMatrixAdaptation`.
+    mass_matrix_kwargs : Optional[Dict[str, Any]]
+        Pass non-default values for the mass matrix adaptation.
+    """
+
+    # Keep in sync with pymc3 naming convention
+    stat_names = ("lp", "tree_size", "diverging", "energy", "mean_tree_accept")
+
+    def __init__(
+        self,
+        var_names: Optional[Sequence[str]] = None,
+        step_size: Optional[float] = None,
+        nuts_kwargs: Optional[Dict[str, Any]] = None,
+        adaptation_kwargs: Optional[Dict[str, Any]] = None,
+        mass_matrix: Optional[str] = None,
+        mass_matrix_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        super().__init__(
+            var_names,
+            step_size=step_size,
+            nuts_kwargs=nuts_kwargs,
+            adaptation_kwargs=adaptation_kwargs,
+            mass_matrix=mass_matrix,
+            mass_matrix_kwargs=mass_matrix_kwargs,
+        )
+
+    def make_kernel(self, target_log_prob_fn, step_size, num_adaptation_steps):
+        if self.parameters["step_size"] is not None:
+            step_size = self.parameters["step_size"]
+
+        def make_adaptive_kernel(target_log_prob_fn, kernel_class=mcmc.NoUTurnSampler):
+            nuts_kernel = kernel_class(
+                target_log_prob_fn=target_log_prob_fn,
+                step_size=step_size,
+                **(self.parameters["nuts_kwargs"] or dict()),
+            )
+            return mcmc.DualAveragingStepSizeAdaptation(
+                inner_kernel=nuts_kernel,
+                num_adaptation_steps=num_adaptation_steps,
+                step_size_getter_fn=lambda pkr: pkr.step_size,
+                log_accept_prob_getter_fn=lambda pkr: pkr.log_accept_ratio,
+                step_size_setter_fn=lambda pkr, new_step_size: pkr._replace(
+                    step_size=new_step_size
+                ),
+                **(self.parameters["adaptation_kwargs"] or dict()),
+            )
+
+        if self.parameters["mass_matrix"] is None:
+            return make_adaptive_kernel(target_log_prob_fn)
+        return MassMatrixAdaptation(
+            target_log_prob_fn,
+            lambda target_log_prob_fn: make_adaptive_kernel(
+                target_log_prob_fn, tfp.experimental.mcmc.PreconditionedNoUTurnSampler
+            ),
+            num_adaptation_steps=num_adaptation_steps,
+            kind=self.parameters["mass_matrix"],
+            **(self.parameters["mass_matrix_kwargs"] or dict()),
+        )
+
+    def sample_stats(self, kernel_results):
+        if self.parameters["mass_matrix"] is not None:
+            kernel_results = kernel_results.inner_results
+        nuts_results = kernel_results.inner_results
+        return (
+            nuts_results.target_log_prob,
+            nuts_results.leapfrogs_taken,
+            nuts_results.has_divergence,
+            nuts_results.energy,
+            nuts_results.log_accept_ratio,
+        )
+
+    def current_step_size(self, kernel_results):
+        if self.parameters["mass_matrix"] is not None:
+            kernel_results = kernel_results.inner_results
+        return kernel_results.new_step_size
+
+
+class HMC(StepMethod):
+    """Hamiltonian Monte Carlo with a fixed number of leapfrog steps.
+
+    Parameters
+    ----------
+    var_names : Optional[Sequence[str]]
+    step_size : Optional[float]
+        The initial step size. If ``None``, the ``step_size`` passed to ``pm.sample`` is
+        used.
+    num_leapfrog_steps : int
+        The number of leapfrog steps of each trajectory.
+    adapt_step_size : bool
+        Adapt the step size with dual averaging during the burn in.
+    adaptation_kwargs : Optional[Dict[str, Any]]
+        Pass non-default values for the ``tfp.mcmc.DualAveragingStepSizeAdaptation`` kernel.
+    """
+
+    stat_names = ("lp", "accepted", "accept")
+
+    def __init__(
+        self,
+        var_names: Optional[Sequence[str]] = None,
+        step_size: Optional[float] = None,
+        num_leapfrog_steps: int = 10,
+        adapt_step_size: bool = True,
+        adaptation_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        super().__init__(
+            var_names,
+            step_size=step_size,
+            num_leapfrog_steps=num_leapfrog_steps,
+            adapt_step_size=adapt_step_size,
+            adaptation_kwargs=adaptation_kwargs,
+        )
+
+    def make_kernel(self, target_log_prob_fn, step_size, num_adaptation_steps):
+        if self.parameters["step_size"] is not None:
+            step_size = self.parameters["step_size"]
+        kernel = mcmc.HamiltonianMonteCarlo(
+            target_log_prob_fn=target_log_prob_fn,
+            step_size=step_size,
+            num_leapfrog_steps=self.parameters["num_leapfrog_steps"],
+        )
+        if not self.parameters["adapt_step_size"]:
+            return kernel
+        return _make_step_size_adaptation(
+            kernel, num_adaptation_steps, self.parameters["adaptation_kwargs"] or dict()
+        )
+
+    def sample_stats(self, kernel_results):
+        if self.parameters["adapt_step_size"]:
+            kernel_results = kernel_results.inner_results
+        return _metropolis_hastings_stats(kernel_results)
+
+    def current_step_size(self, kernel_results):
+        if self.parameters["adapt_step_size"]:
+            return kernel_results.new_step_size
+        return kernel_results.accepted_results.step_size
+
+
+class RandomWalkMetropolis(StepMethod):
+    """Random walk Metropolis with normal (or rounded normal) proposals.
+
+    Parameters
+    ----------
+    var_names : Optional[Sequence[str]]
+    scale : float
+        The scale of the normal proposal.
+    discrete : bool
+        Round the proposed jumps to integers. Use this to update discrete variables.
+    """
+
+    stat_names = ("lp", "accepted", "accept")
+
+    def __init__(
+        self, var_names: Optional[Sequence[str]] = None, scale: float = 1.0, discrete: bool = False
+    ):
+        super().__init__(var_names, scale=scale, discrete=discrete)
+
+    def make_kernel(self, target_log_prob_fn, step_size, num_adaptation_steps):
+        scale = self.parameters["scale"]
+        if self.parameters["discrete"]:
+            normal_fn = mcmc.random_walk_normal_fn(scale=scale)
+
+            def new_state_fn(state_parts, seed):
+                proposed = normal_fn(state_parts, seed)
+                return [part + tf.round(new - part) for part, new in zip(state_parts, proposed)]
+
+        else:
+            new_state_fn = mcmc.random_walk_normal_fn(scale=scale)
+        return mcmc.RandomWalkMetropolis(target_log_prob_fn, new_state_fn=new_state_fn)
+
+    def sample_stats(self, kernel_results):
+        return _metropolis_hastings_stats(kernel_results)
+
+
+class Slice(StepMethod):
+    """Univariate slice sampling along a random direction, with stepping out by doubling.
+
+    Parameters
+    ----------
+    var_names : Optional[Sequence[str]]
+    step_size : float
+        The initial width of the slice.
+    max_doublings : int
+        The maximum number of doublings of the slice width.
+    """
+
+    def __init__(
+        self,
+        var_names: Optional[Sequence[str]] = None,
+        step_size: float = 1.0,
+        max_doublings: int = 5,
+    ):
+        super().__init__(var_names, step_size=step_size, max_doublings=max_doublings)
+
+    def make_kernel(self, target_log_prob_fn, step_size, num_adaptation_steps):
+        return mcmc.SliceSampler(
+            target_log_prob_fn,
+            step_size=self.parameters["step_size"],
+            max_doublings=self.parameters["max_doublings"],
+        )
+
+    def sample_stats(self, kernel_results):
+        return (kernel_results.target_log_prob,)
+
+
+class ReplicaExchange(StepMethod):
+    """Replica exchange (parallel tempering) on top of another step method.
+
+    Every chain runs one replica per inverse temperature ``beta``, each one sampling from
+    ``posterior ** beta`` with the ``step`` method. After every step, the pairs of adjacent
+    replicas (alternately the even and the odd pairs) propose to swap their states. The
+    replicas at high temperatures (small ``beta``) move freely between the modes of the
+    posterior and pass them down to the replica at ``beta = 1``, which is the one that is
+    traced. The log probability of all the replicas of all the chains is evaluated in a
+    single vectorized batch, and the swaps happen inside the compiled sampling loop, see
+    :class:`ReplicaExchangeKernel`. The step size of the inner step method is shared by the
+    replicas. The statistics are the ones of the replica at ``beta = 1``, and
+    ``swap_accepted`` tells whether it swapped its state with the next replica.
+
+    Parameters
+    ----------
+    step : Optional[StepMethod]
+        The step method of every replica. Defaults to :class:`NUTS`.
+    inverse_temperatures : Sequence[float]
+        The decreasing and positive inverse temperatures of the replicas, starting at 1.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def two_modes():
+    ...     x = yield pm.Normal("x", 0, 5)
+    ...     yield pm.Normal("y", x ** 2, 0.5, observed=9.0)
+    >>> step = ReplicaExchange(inverse_temperatures=[1.0, 0.3, 0.1, 0.03])
+    >>> trace = pm.sample(two_modes(), step=step, num_samples=100, num_chains=2, burn_in=100)
+    >>> sorted(trace.sample_stats.data_vars)[-2:]
+    ['swap_accepted', 'tree_size']
+    """
+
+    def __init__(
+        self,
+        step: Optional[StepMethod] = None,
+        inverse_temperatures: Sequence[float] = (1.0, 0.5, 0.25, 0.125),
+    ):
+        inverse_temperatures = tuple(float(beta) for beta in inverse_temperatures)
+        if (
+            not inverse_temperatures
+            or inverse_temperatures[0] != 1
+            or inverse_temperatures[-1] <= 0
+            or any(a <= b for a, b in zip(inverse_temperatures, inverse_temperatures[1:]))
+        ):
+            raise ValueError(
+                "The inverse temperatures should decrease from 1 and stay positive, got "
+                "{}".format(list(inverse_temperatures))
+            )
+        if isinstance(step, (list, tuple, CompoundStep)) or (
+            step is not None and step.var_names is not None
+        ):
+            raise ValueError(
+                "The step method of the replicas should update all the variables, "
+                "wrap a single step method without `var_names`"
+            )
+        super().__init__(
+            None, step=NUTS() if step is None else step, inverse_temperatures=inverse_temperatures
+        )
+
+    @property
+    def stat_names(self):  # type: ignore
+        return self.parameters["step"].stat_names + ("swap_accepted",)
+
+    def make_kernel(self, target_log_prob_fn, step_size, num_adaptation_steps):
+        step = self.parameters["step"]
+        return ReplicaExchangeKernel(
+            target_log_prob_fn,
+            self.parameters["inverse_temperatures"],
+            lambda fn: step.make_kernel(fn, step_size, num_adaptation_steps),
+            # every step method records the log probability as its first statistic
+            lambda results: step.sample_stats(results)[0],
+        )
+
+    def sample_stats(self, kernel_results):
+        stats = self.parameters["step"].sample_stats(kernel_results.pre_swap_results)
+        return (
+            (kernel_results.log_prob[0],)
+            + tuple(stat[0] for stat in stats[1:])
+            + (kernel_results.is_swap_accepted[0],)
+        )
+
+    def current_step_size(self, kernel_results):
+        # the replicas share the step size of the step method
+        return self.parameters["step"].current_step_size(kernel_results.pre_swap_results)
+
+
+def _metropolis_hastings_stats(kernel_results):
+    return (
+        kernel_results.accepted_results.target_log_prob,
+        kernel_results.is_accepted,
+        tf.exp(tf.minimum(kernel_results.log_accept_ratio, 0.0)),
+    )
+
+
+class CompoundStep(StepMethod):
+    """Update groups of variables in turn, each one with its own step method.
+
+    Every step method updates its ``var_names`` conditioned on the current values of the
+    other variables. The variables that are not assigned to any step method are updated
+    with :class:`NUTS`. The ``lp`` statistic is the log probability after the full update,
+    and the other statistics of the ``i``-th step method are suffixed with ``_i``.
+
+    Parameters
+    ----------
+    steps : Sequence[StepMethod]
+        The step methods, all but one of them must have their ``var_names`` set.
+    """
+
+    def __init__(self, steps: Sequence[StepMethod]):
+        if sum(step.var_names is None for step in steps) > 1:
+            raise ValueError(
+                "Only one of the step methods of a CompoundStep can leave its `var_names` unset"
+            )
+        if any(isinstance(step, ReplicaExchange) for step in steps):
+            raise ValueError("Replica exchange can not update a group of variables")
+        super().__init__(None)
+        self.steps = list(steps)
+        self.blocks: List[List[int]] = []
+        self.state_names: Optional[List[str]] = None
+
+    def bind(self, state_names: Sequence[str]) -> "CompoundStep":
+        """Assign the state parts, named by ``state_names``, to the step methods."""
+        if self.state_names == list(state_names):
+            return self
+        assigned: Dict[int, StepMethod] = dict()
+        blocks: List[Optional[List[int]]] = []
+        for step in self.steps:
+            if step.var_names is None:
+                blocks.append(None)
+                continue
+            indices = [_match_var_name(name, state_names) for name in step.var_names]
+            for index in indices:
+                if index in assigned:
+                    raise ValueError(
+                        "Variable {!r} is assigned to more than one step method".format(
+                            state_names[index]
+                        )
+                    )
+                assigned[index] = step
+            blocks.append(indices)
+        rest = [index for index in range(len(state_names)) if index not in assigned]
+        steps = list(self.steps)
+        if None in blocks:
+            blocks[blocks.index(None)] = rest
+        elif rest:
+            steps.append(NUTS())
+            blocks.append(rest)
+        bound = CompoundStep([step for step, indices in zip(steps, blocks) if indices])
+        bound.blocks = [indices for indices in blocks if indices]
+        bound.state_names = list(state_names)
+        return bound
+
+    @property
+    def stat_names(self):  # type: ignore
+        names = ["lp"]
+        for i, step in enumerate(self.steps):
+            names.extend("{}_{}".format(name, i) for name in step.stat_names if name != "lp")
+        return tuple(names)
+
+    def make_kernel(self, target_log_prob_fn, step_size, num_adaptation_steps):
+        if self.state_names is None:
+            raise ValueError("The step methods must be bound to the state names first")
+        return CompoundKernel(
+            target_log_prob_fn,
+            [
+                (
+                    indices,
+                    lambda fn, step=step: step.make_kernel(fn, step_size, num_adaptation_steps),
+                )
+                for step, indices in zip(self.steps, self.blocks)
+            ],
+        )
+
+    def sample_stats(self, kernel_results):
+        stats = []
+        for i, (step, results) in enumerate(zip(self.steps, kernel_results)):
+            step_stats = dict(zip(step.stat_names, step.sample_stats(results)))
+            lp = step_stats.pop("lp")
+            stats.extend(step_stats.values())
+        return (lp,) + tuple(stats)
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.steps)
+
+    def _key(self):
+        return (type(self), tuple(step._key() for step in self.steps))
+
+
+def _match_var_name(name: str, state_names: Sequence[str]) -> int:
+    for i, state_name in enumerate(state_names):
+        if name == state_name or name == NameParts.from_name(state_name).full_untransformed_name:
+            return i
+    raise ValueError(
+        "Unknown variable {!r}, the unobserved variables of the model are {}".format(
+            name, list(state_names)
+        )
+    )
+
+
+def as_step_method(
+    step: Union[None, StepMethod, Sequence[StepMethod]], state_names: Sequence[str]
+) -> StepMethod:
+    """Convert the ``step`` argument of ``pm.sample`` to a step method over ``state_names``.
+
+    ``None`` selects :class:`NUTS`, and a list of step methods, or a single step method that
+    only updates some of the variables, are combined in a :class:`CompoundStep`.
+    """
+    if step is None:
+        return NUTS()
+    if isinstance(step, (list, tuple)):
+        step = CompoundStep(step)
+    elif not isinstance(step, StepMethod):
+        raise TypeError("`step` should be a StepMethod or a list of them, got {!r}".format(step))
+    elif not isinstance(step, CompoundStep) and step.var_names is not None:
+        step = CompoundStep([step])
+    if isinstance(step, CompoundStep):
+        step = step.bind(state_names)
+    return step
+
+
+class CompoundKernel(mcmc.TransitionKernel):
+    """Update blocks of state parts in turn with their own transition kernels.
+
+    Parameters
+    ----------
+    target_log_prob_fn : Callable
+        The log probability of all the state parts.
+    blocks : List[Tuple[List[int], Callable]]
+        The indices of the state parts of each block, and a function that builds the
+        kernel of the block from the conditional log probability of its state parts.
+    """
+
+    def __init__(
+        self,
+        target_log_prob_fn: Callable,
+        blocks: List[Tuple[List[int], Callable[[Callable], mcmc.TransitionKernel]]],
+    ):
+        self._target_log_prob_fn = target_log_prob_fn
+        self._blocks = blocks
+        self._parameters = dict(target_log_prob_fn=target_log_prob_fn, blocks=blocks)
+
+    @property
+    def parameters(self):
+        return self._parameters
+
+    @property
+    def is_calibrated(self):
+        return True
+
+    def block_kernel(self, i: int, state: Sequence[tf.Tensor]) -> mcmc.TransitionKernel:
+        """Build the kernel of the ``i``-th block conditioned on the rest of the ``state``."""
+        indices, make_kernel = self._blocks[i]
+
+        def conditional_log_prob_fn(*block_parts):
+            parts = list(state)
+            for index, part in zip(indices, block_parts):
+                parts[index] = part
+            return self._target_log_prob_fn(*parts)
+
+        return make_kernel(conditional_log_prob_fn)
+
+    def one_step(self, current_state, previous_kernel_results, seed=None):
+        seeds = tfp.random.split_seed(seed, n=len(self._blocks))
+        state = list(current_state)
+        kernel_results = []
+        for i, (indices, _) in enumerate(self._blocks):
+            kernel = self.block_kernel(i, state)
+            block = [state[index] for index in indices]
+            # the other blocks moved since these results were computed
+            results = refresh_kernel_results(kernel, previous_kernel_results[i], block)
+            block, results = kernel.one_step(block, results, seed=seeds[i])
+            for index, part in zip(indices, block):
+                state[index] = part
+            kernel_results.append(results)
+        return state, tuple(kernel_results)
+
+    def bootstrap_results(self, init_state):
+        return tuple(
+            self.block_kernel(i, init_state).bootstrap_results(
+                [init_state[index] for index in indices]
+            )
+            for i, (indices, _) in enumerate(self._blocks)
+        )
+
+
+def refresh_kernel_results(kernel: mcmc.TransitionKernel, kernel_results: Any, state: Any) -> Any:
+    """Recompute the results that depend on the target log probability at ``state``.
+
+    The state of adaptive kernels (such as the dual averaging of the step size) is kept,
+    and only the innermost results are bootstrapped again.
+    """
+    if hasattr(kernel, "refresh_results"):
+        return kernel.refresh_results(state, kernel_results, refresh_kernel_results)
+    if hasattr(kernel_results, "inner_results") and hasattr(kernel, "inner_kernel"):
+        return kernel_results._replace(
+            inner_results=refresh_kernel_results(
+                kernel.inner_kernel, kernel_results.inner_results, state
+            )
+        )
+    return kernel.bootstrap_results(state)
+
+
+ReplicaExchangeResults = collections.namedtuple(
+    "ReplicaExchangeResults",
+    "replica_states, replica_results, pre_swap_results, log_prob, is_swap_accepted, step_count",
+)
+
+
+class ReplicaExchangeKernel(mcmc.TransitionKernel):
+    """Run tempered replicas of a transition kernel and swap their states.
+
+    The state of the kernel is the one of the replica at ``beta = 1``, the states of all
+    the replicas, with the shape ``[num_replicas, num_chains, ...]``, are held in the
+    kernel results. The inner kernel updates all the replicas at once: their state parts
+    are merged into a single batch of ``num_replicas * num_chains`` chains for
+    ``target_log_prob_fn``. The swaps alternate between the even and the odd pairs of
+    adjacent replicas, and use the log probability read from the inner kernel results,
+    so they do not evaluate the model again. Only when some swap is accepted, the inner
+    kernel results are refreshed at the swapped states.
+
+    Parameters
+    ----------
+    target_log_prob_fn : Callable
+        The log probability of the state parts, batched over the chains.
+    inverse_temperatures : Sequence[float]
+        The decreasing and positive inverse temperatures of the replicas, starting at 1.
+    make_kernel_fn : Callable
+        A function that builds the inner kernel from the tempered log probability.
+    log_prob_getter_fn : Callable
+        A function that reads the (tempered) log probability of the state from the inner
+        kernel results.
+    """
+
+    def __init__(
+        self,
+        target_log_prob_fn: Callable,
+        inverse_temperatures: Sequence[float],
+        make_kernel_fn: Callable[[Callable], mcmc.TransitionKernel],
+        log_prob_getter_fn: Callable[[Any], Any],
+    ):
+        self._target_log_prob_fn = target_log_prob_fn
+        self._inverse_temperatures = tuple(inverse_temperatures)
+        self._make_kernel_fn = make_kernel_fn
+        self._log_prob_getter_fn = log_prob_getter_fn
+        self._parameters = dict(
+            target_log_prob_fn=target_log_prob_fn,
+            inverse_temperatures=inverse_temperatures,
+            make_kernel_fn=make_kernel_fn,
+            log_prob_getter_fn=log_prob_getter_fn,
+        )
+
+    @property
+    def parameters(self):
+        return self._parameters
+
+    @property
+    def is_calibrated(self):
+        return True
+
+    @property
+    def num_replicas(self) -> int:
+        return len(self._inverse_temperatures)
+
+    def replicas_log_prob(self, *parts):
+        """The untempered log probability of replica states, with shape ``[R, C]``."""
+        log_prob = self._target_log_prob_fn(*[_merge_leading_axes(part) for part in parts])
+        return tf.reshape(log_prob, tf.shape(parts[0])[:2])
+
+    def inner_kernel(self, dtype: tf.DType) -> mcmc.TransitionKernel:
+        inverse_temperatures = tf.constant(self._inverse_temperatures, dtype)[:, None]
+        return self._make_kernel_fn(
+            lambda *parts: inverse_temperatures * self.replicas_log_prob(*parts)
+        )
+
+    def one_step(self, current_state, previous_kernel_results, seed=None):
+        inner_seed, swap_seed = tfp.random.split_seed(seed)
+        dtype = previous_kernel_results.log_prob.dtype
+        kernel = self.inner_kernel(dtype)
+        states, results = kernel.one_step(
+            previous_kernel_results.replica_states,
+            previous_kernel_results.replica_results,
+            seed=inner_seed,
+        )
+        inverse_temperatures = tf.constant(self._inverse_temperatures, dtype)
+        log_prob = self._log_prob_getter_fn(results) / inverse_temperatures[:, None]
+
+        # pair the replicas k and k + 1 for the even k at the even steps, the odd k otherwise
+        replicas = tf.range(self.num_replicas)
+        parity = previous_kernel_results.step_count % 2
+        lower = tf.equal(replicas % 2, parity) & (replicas + 1 < self.num_replicas)
+        upper = tf.equal((replicas + 1) % 2, parity) & (replicas > 0)
+        partners = tf.where(lower, replicas + 1, tf.where(upper, replicas - 1, replicas))
+        log_accept_ratio = (inverse_temperatures - tf.gather(inverse_temperatures, partners))[
+            :, None
+        ] * (tf.gather(log_prob, partners) - log_prob)
+        # both replicas of a pair use the same uniform draw
+        log_uniform = tf.math.log(
+            tf.random.stateless_uniform(tf.shape(log_prob), seed=swap_seed, dtype=dtype)
+        )
+        log_uniform = tf.gather(log_uniform, tf.minimum(replicas, partners))
+        is_swap_accepted = (log_uniform < log_accept_ratio) & tf.not_equal(replicas, partners)[
+            :, None
+        ]
+
+        def swap(value):
+            accepted = tf.reshape(
+                is_swap_accepted,
+                tf.concat(
+                    [tf.shape(is_swap_accepted), tf.ones([value.shape.rank - 2], tf.int32)], 0
+                ),
+            )
+            return tf.where(accepted, tf.gather(value, partners), value)
+
+        swapped_states = [swap(part) for part in states]
+        swapped_results = tf.cond(
+            tf.reduce_any(is_swap_accepted),
+            lambda: refresh_kernel_results(kernel, results, swapped_states),
+            lambda: results,
+        )
+        return (
+            [part[0] for part in swapped_states],
+            ReplicaExchangeResults(
+                replica_states=swapped_states,
+                replica_results=swapped_results,
+                pre_swap_results=results,
+                log_prob=swap(log_prob),
+                is_swap_accepted=is_swap_accepted,
+                step_count=previous_kernel_results.step_count + 1,
+            ),
+        )
+
+    def bootstrap_results(self, init_state):
+        replica_states = [
+            tf.repeat(part[None], self.num_replicas, axis=0)
+            for part in map(tf.convert_to_tensor, init_state)
+        ]
+        log_prob = self.replicas_log_prob(*replica_states)
+        results = self.inner_kernel(log_prob.dtype).bootstrap_results(replica_states)
+        return ReplicaExchangeResults(
+            replica_states=replica_states,
+            replica_results=results,
+            pre_swap_results=results,
+            log_prob=log_prob,
+            is_swap_accepted=tf.zeros_like(log_prob, dtype=tf.bool),
+            step_count=tf.constant(0),
+        )
+
+
+def _merge_leading_axes(part):
+    # merge the replicas and the chains axes into a single batch of chains
+    if part.shape[2:].is_fully_defined():
+        return tf.reshape(part, [-1] + part.shape[2:].as_list())
+    return tf.reshape(part, tf.concat([[-1], tf.shape(part)[2:]], axis=0))
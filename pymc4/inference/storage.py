@@ -0,0 +1,204 @@
+"""Stores that receive the draws of a segmented ``pm.sample`` run.
+
+When ``pm.sample`` runs the chains in segments, every segment is handed over to a
+:class:`TraceStore` as soon as it is drawn, so the draws never have to be held all at
+once by TensorFlow. The stores write the draws in the ``(chain, draw, *shape)`` layout
+used by ArviZ, which avoids the extra copy made by :func:`~.utils.trace_to_arviz`.
+"""
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import arviz as az
+
+
+__all__ = ["TraceStore", "MemoryTraceStore", "NpyTraceStore"]
+
+
+class TraceStore:
+    """Base class of the trace stores.
+
+    Subclasses only need to implement :meth:`allocate`, which creates the array that
+    will hold all the draws of a single variable.
+    """
+
+    def __init__(self):
+        self.num_chains: Optional[int] = None
+        self.num_samples: Optional[int] = None
+        self.num_draws = 0
+        self.posterior: Dict[str, Any] = dict()
+        self.sample_stats: Dict[str, Any] = dict()
+
+    def setup(self, num_chains: int, num_samples: int) -> None:
+        """Prepare the store to receive ``num_samples`` draws of ``num_chains`` chains."""
+        self.num_chains = num_chains
+        self.num_samples = num_samples
+        self.num_draws = 0
+        self.posterior = dict()
+        self.sample_stats = dict()
+
+    def allocate(self, group: str, name: str, shape: Tuple[int, ...], dtype: np.dtype) -> Any:
+        raise NotImplementedError
+
+    def restore(self, num_draws: int) -> None:
+        """Reopen the draws of a previous run, keeping the first ``num_draws`` of them."""
+        raise NotImplementedError(
+            "{} can not restore the draws of a previous run".format(self.__class__.__name__)
+        )
+
+    def write(
+        self, start: int, posterior: Dict[str, np.ndarray], sample_stats: Dict[str, np.ndarray]
+    ) -> None:
+        """Write a segment of draws starting at the ``start`` draw.
+
+        Parameters
+        ----------
+        start : int
+            The index of the first draw of the segment.
+        posterior : Dict[str, np.ndarray]
+            The draws of every variable with shape ``(num_chains, segment_size, *core_shape)``
+        sample_stats : Dict[str, np.ndarray]
+            The sampler statistics with shape ``(num_chains, segment_size, *stat_shape)``
+        """
+        if self.num_chains is None:
+            raise RuntimeError("The trace store must be set up before writing draws to it")
+        stop = start
+        for group, values in (("posterior", posterior), ("sample_stats", sample_stats)):
+            arrays = getattr(self, group)
+            for name, value in values.items():
+                if name not in arrays:
+                    shape = (self.num_chains, self.num_samples) + value.shape[2:]
+                    arrays[name] = self.allocate(group, name, shape, value.dtype)
+                stop = start + value.shape[1]
+                arrays[name][:, start:stop] = value
+        self.num_draws = max(self.num_draws, stop)
+        self.flush()
+
+    def flush(self) -> None:
+        """Make sure the written draws are persisted."""
+
+    def read(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Return the draws written so far for the posterior and sampler statistics."""
+        return (
+            {k: v[:, : self.num_draws] for k, v in self.posterior.items()},
+            {k: v[:, : self.num_draws] for k, v in self.sample_stats.items()},
+        )
+
+    def to_inference_data(self, observed_data: Optional[Dict[str, Any]] = None):
+        """Build an ArviZ's InferenceData object with the draws written so far."""
+        posterior, sample_stats = self.read()
+        return az.from_dict(
+            posterior={k: v for k, v in posterior.items() if "/" in k},
+            sample_stats=sample_stats,
+            observed_data=observed_data,
+        )
+
+
+class MemoryTraceStore(TraceStore):
+    """Keep the draws in preallocated in-memory numpy arrays."""
+
+    def allocate(self, group, name, shape, dtype):
+        return np.empty(shape, dtype=dtype)
+
+
+class NpyTraceStore(TraceStore):
+    """Stream the draws to memory-mapped ``.npy`` files in a directory.
+
+    Every variable is stored in its own ``.npy`` file, and an ``index.json`` file maps the
+    variable names to their files and keeps track of the number of draws that were
+    written. The resulting InferenceData object is backed by the memory-mapped files, so
+    the peak memory of sampling does not depend on ``num_samples``.
+
+    Parameters
+    ----------
+    directory : str
+        The directory where the files are written. It is created if it does not exist.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> store = NpyTraceStore(tempfile.mkdtemp())
+    >>> store.setup(num_chains=2, num_samples=4)
+    >>> store.write(0, {"model/x": np.zeros((2, 3))}, {"lp": np.ones((2, 3))})
+    >>> posterior, sample_stats = NpyTraceStore.load(store.directory)
+    >>> posterior["model/x"].shape
+    (2, 3)
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.files: Dict[str, Dict[str, str]] = {"posterior": {}, "sample_stats": {}}
+
+    def setup(self, num_chains, num_samples):
+        super().setup(num_chains, num_samples)
+        self.files = {"posterior": {}, "sample_stats": {}}
+
+    def allocate(self, group, name, shape, dtype):
+        filename = "{}.{}.npy".format(group, name.replace("/", "."))
+        self.files[group][name] = filename
+        return np.lib.format.open_memmap(
+            os.path.join(self.directory, filename), mode="w+", dtype=dtype, shape=shape
+        )
+
+    def flush(self):
+        for group in (self.posterior, self.sample_stats):
+            for array in group.values():
+                array.flush()
+        index = dict(
+            num_chains=self.num_chains,
+            num_samples=self.num_samples,
+            num_draws=self.num_draws,
+            files=self.files,
+        )
+        with open(os.path.join(self.directory, self.INDEX_FILE), "w") as buff:
+            json.dump(index, buff)
+
+    def restore(self, num_draws):
+        with open(os.path.join(self.directory, self.INDEX_FILE)) as buff:
+            index = json.load(buff)
+        self.num_chains = index["num_chains"]
+        self.num_samples = index["num_samples"]
+        self.files = index["files"]
+        for group in ("posterior", "sample_stats"):
+            setattr(
+                self,
+                group,
+                {
+                    name: np.load(os.path.join(self.directory, filename), mmap_mode="r+")
+                    for name, filename in self.files[group].items()
+                },
+            )
+        if num_draws > index["num_draws"]:
+            raise ValueError(
+                "Can not restore {} draws, only {} were written to {!r}".format(
+                    num_draws, index["num_draws"], self.directory
+                )
+            )
+        self.num_draws = num_draws
+
+    @classmethod
+    def load(cls, directory: str) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """Read the draws stored in ``directory`` as memory-mapped arrays.
+
+        Returns
+        -------
+        posterior : Dict[str, np.ndarray]
+        sample_stats : Dict[str, np.ndarray]
+        """
+        with open(os.path.join(directory, cls.INDEX_FILE)) as buff:
+            index = json.load(buff)
+        num_draws = index["num_draws"]
+        groups = []
+        for group in ("posterior", "sample_stats"):
+            groups.append(
+                {
+                    name: np.load(os.path.join(directory, filename), mmap_mode="r")[:, :num_draws]
+                    for name, filename in index["files"][group].items()
+                }
+            )
+        return groups[0], groups[1]
@@ -1,8 +1,10 @@
 from typing import Optional, Tuple, List
 import numpy as np
 import arviz as az
+import tensorflow as tf
 
 from pymc4 import Model, flow
+from pymc4.data import ShardedData
 
 
 def initialize_sampling_state(
@@ -23,11 +25,31 @@ def initialize_sampling_state(
         The model's sampling state
     deterministic_names: List[str]
         The list of names of the model's deterministics
+
+    Notes
+    -----
+    The observed values of the returned state are cast to the dtype of the distribution
+    they were observed for. This way they can be fed to compiled functions as inputs.
     """
     _, state = flow.evaluate_meta_model(model, observed=observed, state=state)
     deterministic_names = list(state.deterministics)
+    observed_dtypes = {
+        name: state.distributions[name].dtype
+        for name in state.observed_values
+        if name in state.distributions
+    }
 
     state, transformed_names = state.as_sampling_state()
+    for name, value in state.observed_values.items():
+        if isinstance(value, ShardedData):
+            # streamed and cast chunk by chunk
+            continue
+        if tf.is_tensor(value):
+            state.observed_values[name] = tf.cast(value, observed_dtypes[name])
+        else:
+            state.observed_values[name] = np.asarray(
+                value, dtype=observed_dtypes[name].as_numpy_dtype
+            )
     return state, deterministic_names + transformed_names
 
 
@@ -58,6 +80,9 @@ def trace_to_arviz(
     -------
     ArviZ's InferenceData object
     """
+    if observed_data is not None:
+        # out-of-core data is not copied into the InferenceData object
+        observed_data = {k: v for k, v in observed_data.items() if not isinstance(v, ShardedData)}
     if trace is not None and isinstance(trace, dict):
         trace = {k: np.swapaxes(v.numpy(), 1, 0) for k, v in trace.items() if "/" in k}
     if sample_stats is not None and isinstance(sample_stats, dict):
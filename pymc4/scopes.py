@@ -36,6 +36,9 @@ class Scope(object):
         type(self).get_contexts().pop()
 
     def __getattr__(self, item):
+        if item.startswith("__") and item.endswith("__"):
+            # keep the special method lookups (used by pickle and copy) working
+            raise AttributeError(item)
         return self.__dict__.get(item)
 
     @classmethod
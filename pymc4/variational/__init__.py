@@ -0,0 +1,3 @@
+"""Variational inference."""
+from .approximations import *
+from .laplace import *
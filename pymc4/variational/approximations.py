@@ -0,0 +1,276 @@
+"""Automatic differentiation variational inference (ADVI).
+
+ADVI fits a multivariate normal approximation to the posterior in the transformed (i.e.
+unconstrained) space of the free variables, by maximizing the evidence lower bound (ELBO)
+with stochastic gradients. The free variables are flattened into a single vector, so the
+full-rank approximation can capture the correlations between all of them. The ELBO is
+estimated with ``sample_size`` Monte Carlo draws per step, and the model's log probability
+is vectorized over those draws. Models observed on :class:`pymc4.Minibatch` data see a new
+batch at every step, drawn once for all the Monte Carlo draws.
+"""
+import collections
+import contextlib
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import arviz as az
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from pymc4.coroutine_model import Model
+from pymc4 import flow
+from pymc4.distributions.distribution import DiscreteDistribution
+from pymc4.inference.sampling import (
+    build_logp_and_deterministic_functions,
+    make_posthoc_deterministics,
+    stateless_seed,
+    vectorize_logp_function,
+)
+from pymc4.inference.utils import trace_to_arviz
+
+tfd = tfp.distributions
+tfb = tfp.bijectors
+
+
+__all__ = ["FlatModel", "Approximation", "MeanField", "FullRank", "ADVIFit", "fit"]
+
+
+ADVIFit = collections.namedtuple("ADVIFit", "approximation, losses")
+
+
+class FlatModel:
+    """The log probability of a model as a function of its flattened free variables.
+
+    The free variables are the ones sampled by ``pm.sample``, in the transformed space, and
+    are flattened and concatenated in the same order into a single vector. The log
+    probability is vectorized over a leading batch axis. If some variables are observed on
+    :class:`pymc4.Minibatch` data, each evaluation of the log probability draws new batches.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+    observed : Optional[Dict[str, Any]]
+        Override the observed values of the model.
+    state : Optional[pymc4.flow.SamplingState]
+        The initial state of the model, which defines ``flat_init``.
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        observed: Optional[Dict[str, Any]] = None,
+        state: Optional[flow.SamplingState] = None,
+    ):
+        self.model = model
+        (
+            logpfn,
+            init,
+            _,
+            self.deterministic_names,
+            self.state,
+        ) = build_logp_and_deterministic_functions(model, observed=observed, state=state)
+        self.unobserved_keys = list(init)
+        overrides = state.observed_values if state is not None else (observed or {})
+        # observed variables that were explicitly set to ``None`` are free variables
+        self.observed = dict(self.state.observed_values)
+        self.observed.update({name: None for name, value in overrides.items() if value is None})
+        self.observed.update(self.state.minibatches)
+        self.minibatches = list(
+            {
+                id(data.minibatch): data.minibatch for data in self.state.minibatches.values()
+            }.values()
+        )
+        _, meta_state = flow.evaluate_meta_model(model, observed=observed, state=state)
+        discrete = [
+            name
+            for name, dist in meta_state.distributions.items()
+            if isinstance(dist, DiscreteDistribution) and name not in self.state.observed_values
+        ]
+        if discrete:
+            raise ValueError(
+                "Only continuous free variables are supported, {} are discrete".format(discrete)
+            )
+        init_values = [tf.convert_to_tensor(value) for value in init.values()]
+        self.shapes = [value.shape for value in init_values]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.flat_init = tf.concat([tf.reshape(value, [-1]) for value in init_values], axis=0)
+        if self.minibatches:
+            self._logpfn = self._feed_minibatches(vectorize_logp_function(logpfn.python_function))
+        else:
+            self._logpfn = vectorize_logp_function(logpfn)
+        # built on the first call of `values`, so that it is traced once
+        self._postprocess: Optional[Callable[[Dict[str, Any]], Dict[str, np.ndarray]]] = None
+
+    def _feed_minibatches(self, logpfn):
+        @tf.function(autograph=False)
+        def fed_logpfn(batches, *values):
+            with contextlib.ExitStack() as stack:
+                for minibatch, batch in zip(self.minibatches, batches):
+                    stack.enter_context(minibatch.feed(batch))
+                return logpfn(*values)
+
+        def minibatch_logpfn(*values):
+            # draw the batches once per evaluation, outside of the vectorization over the draws
+            return fed_logpfn([minibatch.next_batch() for minibatch in self.minibatches], *values)
+
+        return minibatch_logpfn
+
+    def unflatten(self, flat: tf.Tensor) -> List[tf.Tensor]:
+        """Split a ``(num_draws, size)`` batch of flat draws into the free variables."""
+        return [
+            tf.reshape(part, tf.concat([tf.shape(flat)[:1], shape], axis=0))
+            for part, shape in zip(tf.split(flat, self.sizes, axis=-1), self.shapes)
+        ]
+
+    def target_log_prob(self, flat: tf.Tensor) -> tf.Tensor:
+        """The model's log probability of a ``(num_draws, size)`` batch of flat draws."""
+        return self._logpfn(*self.unflatten(flat))
+
+    def values(self, flat: tf.Tensor) -> Dict[str, np.ndarray]:
+        """Compute the free variables and the deterministics of a batch of flat draws."""
+        posterior = dict(zip(self.unobserved_keys, self.unflatten(flat)))
+        if self._postprocess is None:
+            self._postprocess = make_posthoc_deterministics(
+                self.model, self.unobserved_keys, self.observed, self.deterministic_names
+            )
+        # the draws are laid out as (draw, chain) in the traces of ``pm.sample``
+        values = self._postprocess({k: v.numpy()[:, None] for k, v in posterior.items()})
+        return {k: v[:, 0] for k, v in values.items()}
+
+    def to_inference_data(self, flat: tf.Tensor) -> az.InferenceData:
+        """Build a single chain trace, in the layout of ``pm.sample``, from flat draws."""
+        return trace_to_arviz(
+            {k: tf.convert_to_tensor(v[:, None]) for k, v in self.values(flat).items()},
+            observed_data=self.state.observed_values,
+        )
+
+
+class Approximation(FlatModel):
+    """Base class of the normal approximations of a model's posterior.
+
+    Subclasses implement :meth:`_build_posterior`, which builds the approximating
+    distribution over the flattened transformed free variables (see :class:`FlatModel`),
+    usually with trainable parameters initialized at ``flat_init``.
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        observed: Optional[Dict[str, Any]] = None,
+        state: Optional[flow.SamplingState] = None,
+    ):
+        super().__init__(model, observed=observed, state=state)
+        self.approx = self._build_posterior(self.flat_init)
+
+    def _build_posterior(self, loc: tf.Tensor) -> tfd.Distribution:
+        raise NotImplementedError
+
+    def sample(self, n: int = 1000, seed: Optional[int] = None) -> az.InferenceData:
+        """Draw ``n`` samples from the approximation.
+
+        The draws are returned as a single chain in the same ArviZ layout as the trace of
+        ``pm.sample``, including the deterministics (computed in vectorized batches) and
+        the observed data.
+        """
+        return self.to_inference_data(self.approx.sample(n, seed=stateless_seed(seed)))
+
+
+class MeanField(Approximation):
+    """A normal approximation with a diagonal covariance (mean-field ADVI)."""
+
+    def _build_posterior(self, loc):
+        return tfd.MultivariateNormalDiag(
+            loc=tf.Variable(loc, name="mu"),
+            scale_diag=tfp.util.TransformedVariable(
+                tf.ones_like(loc), bijector=tfb.Softplus(), name="sigma"
+            ),
+        )
+
+
+class FullRank(Approximation):
+    """A normal approximation with a dense covariance (full-rank ADVI)."""
+
+    def _build_posterior(self, loc):
+        return tfd.MultivariateNormalTriL(
+            loc=tf.Variable(loc, name="mu"),
+            scale_tril=tfp.util.TransformedVariable(
+                tf.eye(loc.shape[0], dtype=loc.dtype), bijector=tfb.FillScaleTriL(), name="L"
+            ),
+        )
+
+
+_select_method = {"advi": MeanField, "fullrank_advi": FullRank}
+
+
+def fit(
+    model: Model,
+    method: str = "advi",
+    num_steps: int = 10000,
+    sample_size: int = 1,
+    random_seed: Optional[int] = None,
+    optimizer: Optional[tf.optimizers.Optimizer] = None,
+    observed: Optional[Dict[str, Any]] = None,
+    state: Optional[flow.SamplingState] = None,
+    jit_compile: bool = False,
+    **kwargs,
+) -> ADVIFit:
+    """Fit a normal approximation to the posterior of a model with ADVI.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+        Model to fit the posterior of
+    method : str
+        ``"advi"`` for a mean-field approximation, ``"fullrank_advi"`` for a full-rank one.
+    num_steps : int
+        The number of optimization steps.
+    sample_size : int
+        The number of Monte Carlo draws used to estimate the ELBO and its gradients at each
+        step.
+    random_seed : Optional[int]
+        The seed of the Monte Carlo draws.
+    optimizer : Optional[tf.optimizers.Optimizer]
+        Defaults to Adam with a learning rate of 0.01.
+    observed : Optional[Dict[str, Any]]
+        Override the observed values of the model.
+    state : Optional[pymc4.flow.SamplingState]
+        The initial state of the model.
+    jit_compile : bool
+        Compile the optimization loop with XLA.
+    **kwargs
+        Other arguments of ``tfp.vi.fit_surrogate_posterior``, e.g. a
+        ``convergence_criterion``.
+
+    Returns
+    -------
+    ADVIFit : collections.namedtuple
+        The fitted ``approximation`` and the ``losses`` (the negative ELBO) of every step.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def model():
+    ...     mu = yield pm.Normal("mu", 0, 10)
+    ...     yield pm.Normal("y", mu, 1, observed=np.ones(20))
+    >>> approximation, losses = pm.fit(model(), num_steps=1000)
+    >>> trace = approximation.sample(500)
+    >>> trace.posterior["model/mu"].shape
+    (1, 500)
+    """
+    if method not in _select_method:
+        raise ValueError("Unknown method {!r}, use any of {}".format(method, list(_select_method)))
+    approximation = _select_method[method](model, observed=observed, state=state)
+    if optimizer is None:
+        optimizer = tf.optimizers.Adam(learning_rate=0.01)
+    losses = tfp.vi.fit_surrogate_posterior(
+        approximation.target_log_prob,
+        approximation.approx,
+        optimizer,
+        num_steps,
+        sample_size=sample_size,
+        seed=stateless_seed(random_seed),
+        jit_compile=jit_compile,
+        **kwargs,
+    )
+    return ADVIFit(approximation, losses)
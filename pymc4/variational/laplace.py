@@ -0,0 +1,215 @@
+"""Maximum a posteriori (MAP) estimates and Laplace approximations.
+
+:func:`find_MAP` maximizes the log probability of a model in the transformed space of its
+free variables, starting from the same initial values as ``pm.sample``. The free variables
+are flattened into a single vector and the whole quasi-Newton (L-BFGS or BFGS) loop runs
+inside a single compiled TensorFlow graph. As in ``pm.sample``, the log probability includes
+the log Jacobian determinants of the transformations, so the mode is the one of the
+posterior density in the transformed space. The Laplace approximation is the normal
+distribution centered on the mode, with the inverse of the Hessian of the negative log
+probability as its covariance.
+"""
+import collections
+from typing import Any, Dict, Optional
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from pymc4.coroutine_model import Model
+from pymc4 import flow
+from pymc4.variational.approximations import Approximation, FlatModel
+from pymc4.utils import NameParts
+
+tfd = tfp.distributions
+
+
+__all__ = ["Laplace", "MAPResult", "find_MAP"]
+
+
+MAPResult = collections.namedtuple(
+    "MAPResult", "transformed, untransformed, state, laplace, optimizer_results"
+)
+MAPResult.__doc__ = """The result of :func:`find_MAP`.
+
+Attributes
+----------
+transformed : Dict[str, np.ndarray]
+    The mode of the free variables, in the transformed space where they are sampled.
+untransformed : Dict[str, np.ndarray]
+    The mode of the free variables in their original space, and the values of the
+    deterministics at the mode.
+state : pymc4.flow.SamplingState
+    A state holding the mode, which can be passed to ``pm.sample`` to start the chains there.
+laplace : Optional[Laplace]
+    The Laplace approximation, if it was requested.
+optimizer_results : Any
+    The results of the optimizer, with its convergence status and number of iterations.
+"""
+
+
+class Laplace(Approximation):
+    """The Laplace approximation of a model's posterior.
+
+    A normal approximation in the transformed space, centered on the mode ``loc`` with the
+    covariance ``scale_tril @ scale_tril.T``. Use :func:`find_MAP` with ``laplace=True`` to
+    build it.
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        loc: tf.Tensor,
+        scale_tril: tf.Tensor,
+        observed: Optional[Dict[str, Any]] = None,
+        state: Optional[flow.SamplingState] = None,
+    ):
+        self.loc = loc
+        self.scale_tril = scale_tril
+        super().__init__(model, observed=observed, state=state)
+
+    def _build_posterior(self, loc):
+        return tfd.MultivariateNormalTriL(loc=self.loc, scale_tril=self.scale_tril)
+
+
+_optimizers = {"lbfgs": tfp.optimizer.lbfgs_minimize, "bfgs": tfp.optimizer.bfgs_minimize}
+
+
+def find_MAP(
+    model: Model,
+    observed: Optional[Dict[str, Any]] = None,
+    state: Optional[flow.SamplingState] = None,
+    method: str = "lbfgs",
+    max_iterations: int = 1000,
+    tolerance: float = 1e-8,
+    laplace: bool = False,
+    **kwargs,
+) -> MAPResult:
+    """Find the maximum a posteriori estimate of a model's free variables.
+
+    Parameters
+    ----------
+    model : pymc4.Model
+        The model to find the mode of
+    observed : Optional[Dict[str, Any]]
+        Override the observed values of the model.
+    state : Optional[pymc4.flow.SamplingState]
+        The initial state of the model.
+    method : str
+        ``"lbfgs"`` (the default) or ``"bfgs"``, see ``tfp.optimizer.lbfgs_minimize`` and
+        ``tfp.optimizer.bfgs_minimize``.
+    max_iterations : int
+        The largest number of iterations of the optimizer.
+    tolerance : float
+        The tolerance of the gradient's norm at the mode.
+    laplace : bool
+        If ``True``, also build the Laplace approximation of the posterior from the Hessian of
+        the log probability at the mode. Its draws are returned by ``laplace.sample(n)``.
+    **kwargs
+        Other arguments of the optimizer.
+
+    Returns
+    -------
+    MAPResult : collections.namedtuple
+        The ``transformed`` and ``untransformed`` values at the mode, the ``state`` at the
+        mode, the ``laplace`` approximation and the ``optimizer_results``.
+
+    Examples
+    --------
+    >>> import pymc4 as pm
+    >>> @pm.model
+    ... def model():
+    ...     sd = yield pm.HalfNormal("sd", 1)
+    ...     yield pm.Normal("y", 0, sd, observed=[-1.0, 1.0])
+    >>> result = pm.find_MAP(model())
+    >>> sorted(result.transformed), sorted(result.untransformed)
+    (['model/__log_sd'], ['model/sd'])
+    >>> float(result.untransformed["model/sd"].round(3))
+    1.0
+    """
+    if method not in _optimizers:
+        raise ValueError("Unknown method {!r}, use any of {}".format(method, list(_optimizers)))
+    # the log probability, free variables and initial values are the ones of ``pm.sample``
+    flat_model = FlatModel(model, observed=observed, state=state)
+    if flat_model.minibatches:
+        raise ValueError(
+            "The variables {} are observed on minibatches, the log probability to maximize "
+            "must be deterministic".format(sorted(flat_model.state.minibatches))
+        )
+
+    def negative_log_prob(flat):
+        return -flat_model.target_log_prob(flat[None])[0]
+
+    def value_and_gradient(flat):
+        value, gradient = tfp.math.value_and_gradient(negative_log_prob, flat)
+        # the first trial steps of the line search can overflow the transformations, report
+        # them as infinitely bad instead of NaN so that the line search shrinks them
+        return tf.where(tf.math.is_nan(value), tf.constant(np.inf, value.dtype), value), gradient
+
+    @tf.function(autograph=False)
+    def minimize(initial_position):
+        return _optimizers[method](
+            value_and_gradient,
+            initial_position=initial_position,
+            max_iterations=max_iterations,
+            tolerance=tolerance,
+            **kwargs,
+        )
+
+    results = minimize(flat_model.flat_init)
+    if results.failed:
+        raise ValueError(
+            "The optimizer failed to find the mode after {} iterations".format(
+                int(results.num_iterations)
+            )
+        )
+    mode = results.position
+    values = {name: value[0] for name, value in flat_model.values(mode[None]).items()}
+    transformed = {name: values[name] for name in flat_model.unobserved_keys}
+    untransformed = {
+        name: value
+        for name, value in values.items()
+        if not NameParts.from_name(name).is_transformed
+    }
+
+    laplace_approximation = None
+    if laplace:
+
+        @tf.function(autograph=False)
+        def hessian(flat):
+            with tf.GradientTape() as outer_tape:
+                outer_tape.watch(flat)
+                with tf.GradientTape() as inner_tape:
+                    inner_tape.watch(flat)
+                    value = negative_log_prob(flat)
+                gradient = inner_tape.gradient(value, flat)
+            return outer_tape.jacobian(gradient, flat)
+
+        precision = hessian(mode)
+        # symmetrize the numerical Hessian before inverting it
+        precision = (precision + tf.transpose(precision)) / 2
+        positive_definite = bool(tf.reduce_all(tf.linalg.eigvalsh(precision) > 0))
+        if positive_definite:
+            try:
+                scale_tril = tf.linalg.cholesky(tf.linalg.inv(precision))
+            except tf.errors.InvalidArgumentError:
+                # the precision is too ill-conditioned to be inverted
+                positive_definite = False
+        if not positive_definite:
+            raise ValueError(
+                "The Hessian of the log probability is not positive definite at the mode, "
+                "the Laplace approximation is not defined"
+            )
+        laplace_approximation = Laplace(
+            model, loc=mode, scale_tril=scale_tril, observed=observed, state=state
+        )
+
+    return MAPResult(
+        transformed=transformed,
+        untransformed=untransformed,
+        state=flow.SamplingState.from_values(
+            transformed, observed_values=dict(flat_model.state.observed_values)
+        ),
+        laplace=laplace_approximation,
+        optimizer_results=results,
+    )
@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import pymc4 as pm
+
+
+@pytest.fixture(scope="function")
+def regression_data():
+    x = np.linspace(-1, 1, 1000).astype("float32")
+    y = (2.0 * x + np.random.RandomState(42).normal(0, 0.5, size=1000)).astype("float32")
+    return x, y
+
+
+def test_minibatch_keeps_rows_together(regression_data):
+    x, y = regression_data
+    minibatch = pm.Minibatch(x, y, batch_size=50, seed=1)
+    assert minibatch.scale == 20
+    x_batch, y_batch = minibatch
+    for _ in range(3):
+        minibatch.advance()
+        assert x_batch.value.shape == y_batch.value.shape == (50,)
+        rows = np.searchsorted(x, x_batch.value.numpy())
+        np.testing.assert_array_equal(y[rows], y_batch.value)
+
+
+def test_minibatch_log_prob_is_rescaled(regression_data):
+    x, y = regression_data
+    x_batch, y_batch = pm.Minibatch(x, y, batch_size=250, shuffle=False)
+
+    @pm.model
+    def regression():
+        slope = yield pm.Normal("slope", 0, 10)
+        yield pm.Normal("y", slope * x_batch.value, 0.5, observed=y_batch)
+
+    _, state = pm.evaluate_model(regression(), values={"regression/slope": 2.0})
+    assert set(state.minibatches) == {"regression/y"}
+    np.testing.assert_array_equal(state.observed_values["regression/y"], y[:250])
+    expected = pm.Normal.dist(0, 10).log_prob(2.0) + 4 * tf.reduce_sum(
+        pm.Normal.dist(2.0 * x[:250], 0.5).log_prob(y[:250])
+    )
+    np.testing.assert_allclose(state.collect_log_prob(), expected, rtol=1e-5)
+
+
+def test_fit_minibatch(regression_data):
+    x, y = regression_data
+    x_batch, y_batch = pm.Minibatch(x, y, batch_size=100, seed=1)
+
+    @pm.model
+    def regression():
+        slope = yield pm.Normal("slope", 0, 10)
+        yield pm.Normal("y", slope * x_batch.value, 0.5, observed=y_batch)
+
+    approximation, losses = pm.fit(regression(), num_steps=2000, random_seed=1)
+    trace = approximation.sample(1000, seed=2)
+    np.testing.assert_allclose(trace.posterior["regression/slope"].mean(), 2.0, atol=0.1)
+
+
+def test_minibatch_errors(regression_data):
+    x, y = regression_data
+    with pytest.raises(ValueError, match="different numbers of rows"):
+        pm.Minibatch(x, y[:10])
+    with pytest.raises(ValueError, match="batch_size"):
+        pm.Minibatch(x, batch_size=2000)
+
+    (y_batch,) = pm.Minibatch(y, batch_size=100)
+
+    @pm.model
+    def model():
+        mu = yield pm.Normal("mu", 0, 10)
+        yield pm.Normal("y", mu, 1, observed=y_batch)
+
+    with pytest.raises(ValueError, match="observed on minibatches"):
+        pm.sample(model())
+    with pytest.raises(ValueError, match="observed on minibatches"):
+        pm.find_MAP(model())
+
+
+@pytest.fixture(scope="function")
+def sharded_data(tmp_path):
+    data = np.random.RandomState(0).normal(1.0, 2.0, size=(1000, 3)).astype("float32")
+    for i, shard in enumerate(np.array_split(data, 4)):
+        np.save(str(tmp_path / "shard{}.npy".format(i)), shard)
+    return pm.data.ShardedData(str(tmp_path / "shard*.npy"), chunk_size=64), data
+
+
+def test_sharded_data_log_prob(sharded_data):
+    sharded, data = sharded_data
+    assert sharded.shape == data.shape
+    np.testing.assert_array_equal(np.concatenate(list(sharded.chunks())), data)
+    loc = tf.constant([0.5, 1.0, 1.5])
+    scale = tf.constant(2.0)
+    with tf.GradientTape(persistent=True) as tape:
+        tape.watch([loc, scale])
+        streamed = sharded.reduce_log_prob(pm.Normal.dist(loc, scale))
+        expected = tf.reduce_sum(pm.Normal.dist(loc, scale).log_prob(data))
+    np.testing.assert_allclose(streamed, expected, rtol=1e-5)
+    for streamed_gradient, expected_gradient in zip(
+        tape.gradient(streamed, [loc, scale]), tape.gradient(expected, [loc, scale])
+    ):
+        np.testing.assert_allclose(streamed_gradient, expected_gradient, rtol=1e-4)
+
+
+def test_sharded_data_model(sharded_data):
+    sharded, data = sharded_data
+
+    @pm.model
+    def model(observed):
+        mu = yield pm.Normal("mu", 0.0, 10.0, batch_stack=3)
+        yield pm.Normal("y", mu, 2.0, observed=observed)
+
+    result = pm.find_MAP(model(sharded))
+    expected = pm.find_MAP(model(data))
+    np.testing.assert_allclose(
+        result.untransformed["model/mu"], expected.untransformed["model/mu"], rtol=1e-4
+    )
+    trace = pm.sample(model(sharded), num_samples=10, burn_in=10, num_chains=1)
+    assert trace.posterior["model/mu"].shape == (1, 10, 3)
+    # the sharded data is not copied to the trace
+    assert "model/y" not in getattr(trace, "observed_data", {})
+
+
+def test_sharded_data_errors(sharded_data, tmp_path):
+    sharded, data = sharded_data
+    with pytest.raises(ValueError, match="No shards"):
+        pm.data.ShardedData(str(tmp_path / "missing*.npy"))
+    np.save(str(tmp_path / "shard9.npy"), data[:, :2])
+    with pytest.raises(ValueError, match="same row shape"):
+        pm.data.ShardedData(str(tmp_path / "shard*.npy"))
+    with pytest.raises(ValueError, match="broadcast against a single row"):
+        sharded.reduce_log_prob(pm.Normal.dist(tf.zeros([1000, 3]), 1.0))
+
+    @pm.model
+    def model():
+        mu = yield pm.Normal("mu", 0.0, 10.0)
+        yield pm.Normal("y", mu, 2.0, observed=data)
+
+    with pytest.raises(ValueError, match="can not be overridden"):
+        pm.sample(model(), observed={"model/y": sharded})
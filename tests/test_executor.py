@@ -732,3 +732,162 @@ def test_meta_executor(deterministics_in_nested_models, fixture_batch_shapes):
         np.testing.assert_allclose(
             value.numpy(), dist.get_test_sample(sample_shape=sample_shape).numpy()
         )
+
+
+def test_evaluate_model_with_seed():
+    @pm.model
+    def model():
+        yield pm.Normal("x", 0, 1, batch_stack=3)
+        yield pm.Normal("z", 0, 1, batch_stack=3)
+
+    seed = tf.constant([1, 2])
+    _, first = pm.evaluate_model(model(), seed=seed)
+    _, second = pm.evaluate_model(model(), seed=seed)
+    _, third = pm.evaluate_model(model(), seed=tf.constant([1, 3]))
+    for name in ["model/x", "model/z"]:
+        np.testing.assert_array_equal(
+            first.untransformed_values[name], second.untransformed_values[name]
+        )
+        assert not np.allclose(first.untransformed_values[name], third.untransformed_values[name])
+    # every variable gets its own seed
+    assert not np.allclose(
+        first.untransformed_values["model/x"], first.untransformed_values["model/z"]
+    )
+
+
+def test_model_ir():
+    @pm.model
+    def model():
+        mu = yield pm.Normal("mu", 0, 1)
+        tau = yield pm.HalfNormal("tau", 1)
+        x = yield pm.Normal("x", mu, tau, batch_stack=3)
+        yield pm.Deterministic("double", 2 * x)
+        yield pm.Normal("y", x, 1, observed=np.zeros(3, "float32"))
+
+    values = {
+        "model/mu": tf.constant(0.5),
+        "model/__log_tau": tf.constant(0.3),
+        "model/x": tf.constant([0.1, -0.2, 0.4]),
+    }
+    observed = {"model/y": np.ones(3, "float32")}
+    ir = pm.flow.build_model_ir(model(), list(values), observed)
+    # only the log probability is traced up front
+    assert ir._variables is None and ir._deterministics is None
+    assert ir.variables["model/x"].parents == ("model/mu", "model/tau")
+    assert ir.variables["model/y"].parents == ("model/x",)
+    assert ir.variables["model/y"].observed
+    assert ir.variables["model/tau"].transformed_name == "model/__log_tau"
+    assert ir.variables["model/x"].shape == [3]
+
+    state = pm.flow.SamplingState.from_values(values, observed_values=observed)
+    _, state = pm.evaluate_model_transformed(model(), state=state)
+    np.testing.assert_allclose(
+        ir.log_prob(list(values.values()), observed), state.collect_log_prob(), rtol=1e-6
+    )
+    deterministics = dict(
+        zip(ir.deterministic_names, ir.deterministics(list(values.values()), observed))
+    )
+    np.testing.assert_allclose(deterministics["model/double"], 2 * values["model/x"])
+    np.testing.assert_allclose(deterministics["model/tau"], np.exp(0.3), rtol=1e-6)
+    with pytest.raises(ValueError, match="signature"):
+        ir.log_prob([tf.zeros(()), tf.zeros(()), tf.zeros(4)], observed)
+
+
+def test_model_ir_falls_back_on_value_dependent_control_flow():
+    @pm.model
+    def model():
+        x = yield pm.Normal("x", 0, 1)
+        if x > 0:
+            yield pm.Normal("y", 0, 1)
+
+    assert pm.flow.build_model_ir(model(), ["model/x"], {}) is None
+    logpfn, _ = pm.inference.sampling.make_logp_and_deterministic_functions(
+        model(), ["model/x"], {}
+    )
+    np.testing.assert_allclose(logpfn(tf.constant(-1.0)), -0.5 - 0.5 * math.log(2 * math.pi))
+
+
+def test_sampling_state_dependencies():
+    @pm.model
+    def model():
+        mu = yield pm.Normal("mu", 0, 1)
+        tau = yield pm.HalfNormal("tau", 1)
+        eta = yield pm.Normal("eta", 0, 1, batch_stack=3)
+        theta = yield pm.Deterministic("theta", mu + tau * eta)
+        yield pm.Normal("y", theta, 1, observed=np.zeros(3, "float32"))
+        yield pm.Normal("z", 0, 1)
+
+    state = pm.flow.SamplingState(record_dependencies=True)
+    _, state = pm.evaluate_model(model(), state=state)
+    # tensors have no provenance in eager mode
+    assert state.dependencies == {}
+
+    dependencies = {}
+
+    @tf.function(autograph=False)
+    def evaluate(tau, record_dependencies):
+        state = pm.flow.SamplingState.from_values(
+            {"model/__log_tau": tau}, record_dependencies=record_dependencies
+        )
+        _, state = pm.evaluate_model_transformed(model(), state=state)
+        dependencies.update(state.dependencies)
+        return state.collect_log_prob()
+
+    # the dependencies are only recorded on request
+    evaluate(tf.constant(0.0), False)
+    assert dependencies == {}
+    evaluate(tf.constant(0.0), True)
+    assert dependencies == {
+        "model/mu": (),
+        "model/tau": (),
+        "model/eta": (),
+        "model/y": ("model/eta", "model/mu", "model/tau"),
+        "model/z": (),
+    }
+    graph = pm.flow.DependencyGraph(dependencies)
+    assert graph.children["model/tau"] == ("model/y",)
+    assert graph.ancestors(["model/y"]) == ["model/mu", "model/tau", "model/eta"]
+    assert graph.descendants(["model/mu"]) == ["model/y"]
+    assert graph.markov_blanket("model/mu") == {"model/tau", "model/eta", "model/y"}
+    assert graph.log_prob_terms(["model/z"]) == ["model/z"]
+
+
+def test_fused_log_prob():
+    from pymc4.flow.fusion import fused_log_prob, fusion_key
+
+    items = [
+        ("a", pm.Normal("a", 0.0, 1.0), tf.constant(0.5)),
+        ("b", pm.Normal("b", [1.0, 2.0], 2.0), tf.constant([0.1, 0.2])),
+        ("c", pm.Normal("c", 0.0, [1.0, 3.0], batch_stack=2), tf.ones((2, 2))),
+        ("d", pm.HalfNormal("d", 1.0), tf.constant(0.3)),
+        ("e", pm.HalfNormal("e", [1.0, 2.0]), tf.constant([0.3, 0.4])),
+        ("f", pm.Flat("f"), tf.constant(0.3)),
+        ("g", pm.MvNormal("g", tf.zeros(2), tf.eye(2)), tf.ones(2)),
+        ("h", pm.Normal("h", 0.0, 1.0, event_stack=2), tf.ones(2)),
+    ]
+    keys = {name: fusion_key(dist, value) for name, dist, value in items}
+    assert keys["a"] == keys["b"] == keys["c"]
+    assert keys["d"] == keys["e"] != keys["a"]
+    assert keys["f"] is None and keys["g"] is None and keys["h"] is None
+    log_probs = fused_log_prob(items)
+    for name, dist, value in items:
+        expected = dist.log_prob(value)
+        assert log_probs[name].shape == expected.shape
+        np.testing.assert_allclose(log_probs[name], expected, rtol=1e-6)
+
+
+def test_state_layout(transformed_model):
+    _, state = pm.evaluate_model_transformed(transformed_model())
+    values = dict(state.all_unobserved_values)
+    layout = pm.flow.StateLayout(list(values))
+    assert [name for _, name in layout.transformed] == list(state.transformed_values)
+    observed = {}
+    new_state = layout.state(list(values.values()), observed)
+    expected = pm.flow.SamplingState.from_values(values)
+    assert new_state.transformed_values == expected.transformed_values
+    assert new_state.untransformed_values == expected.untransformed_values
+    _, new_state = pm.evaluate_model_transformed(transformed_model(), state=new_state)
+    assert observed == {}
+    assert layout.deterministics(new_state) == list(
+        pm.flow.collect_deterministics(new_state).values()
+    )
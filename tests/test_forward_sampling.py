@@ -491,3 +491,39 @@ def test_posterior_predictive_on_root_variable(use_auto_batching_fixture):
         assert state.untransformed_values["model/x"].numpy().shape == (n_chains, n_samples, n_obs)
     assert ppc["model/obs"].shape == (n_chains, n_samples, n_obs)
     assert ppc["model/x"].shape == (n_chains, n_samples, n_obs)
+
+
+def test_sample_prior_predictive_seed(model_fixture, use_auto_batching_fixture):
+    model, _ = model_fixture
+    kwargs = dict(use_auto_batching=use_auto_batching_fixture, seed=42)
+    first = forward_sampling.sample_prior_predictive(model(), sample_shape=10, **kwargs)
+    second = forward_sampling.sample_prior_predictive(model(), sample_shape=10, **kwargs)
+    other = forward_sampling.sample_prior_predictive(model(), sample_shape=10, seed=43)
+    for name in ["model/sd", "model/x", "model/y"]:
+        np.testing.assert_array_equal(first.prior_predictive[name], second.prior_predictive[name])
+        assert not np.allclose(first.prior_predictive[name], other.prior_predictive[name])
+    if use_auto_batching_fixture:
+        # the draws only depend on the seed and their index
+        more = forward_sampling.sample_prior_predictive(model(), sample_shape=20, **kwargs)
+        np.testing.assert_array_equal(
+            more.prior_predictive["model/sd"][:, :10], first.prior_predictive["model/sd"]
+        )
+
+
+def test_sample_posterior_predictive_seed(model_fixture):
+    model, observed = model_fixture
+    trace = pm.inference.utils.trace_to_arviz(
+        {"model/sd": tf.random.uniform((5, 2), 0.5, 2.0, seed=1)}
+    )
+    first = forward_sampling.sample_posterior_predictive(model(), trace, inplace=False, seed=42)
+    second = forward_sampling.sample_posterior_predictive(model(), trace, inplace=False, seed=42)
+    np.testing.assert_array_equal(
+        first.posterior_predictive["model/x"], second.posterior_predictive["model/x"]
+    )
+    # the draws of a posterior sample do not depend on the other samples of the trace
+    subset = forward_sampling.sample_posterior_predictive(
+        model(), trace.isel(draw=slice(0, 3)), inplace=False, seed=42
+    )
+    np.testing.assert_array_equal(
+        subset.posterior_predictive["model/x"], first.posterior_predictive["model/x"][:, :3]
+    )
@@ -123,3 +123,658 @@ def test_beta_sample():
 
     assert trace.posterior["model/beta"] is not None
     assert trace.posterior["model/__sigmoid_beta"] is not None
+
+
+def test_sample_reuses_compilation_cache(simple_model_with_deterministic):
+    cache = pm.inference.cache.compilation_cache
+    cache.clear()
+    kwargs = dict(num_samples=10, num_chains=2, burn_in=10)
+    pm.sample(simple_model_with_deterministic(), **kwargs)
+    assert cache.info().misses == 1
+    pm.sample(simple_model_with_deterministic(), **kwargs)
+    assert cache.info().hits == 1
+    assert len(cache) == 1
+    pm.sample(simple_model_with_deterministic(), use_compilation_cache=False, **kwargs)
+    assert cache.info().hits == 1
+
+
+def test_compilation_cache_is_reused_for_new_observed():
+    @pm.model
+    def model():
+        mu = yield pm.Normal("mu", 0, 1)
+        yield pm.Normal("obs", mu, 0.1, observed=np.zeros(5, dtype="float32"))
+
+    cache = pm.inference.cache.compilation_cache
+    cache.clear()
+    kwargs = dict(num_samples=100, num_chains=2, burn_in=100)
+    trace = pm.sample(model(), **kwargs)
+    np.testing.assert_allclose(trace.posterior["model/mu"].mean(), 0, atol=0.2)
+    new_observed = {"model/obs": np.full(5, 10, dtype="float32")}
+    trace = pm.sample(model(), observed=new_observed, **kwargs)
+    assert cache.info().hits == 1
+    np.testing.assert_allclose(trace.posterior["model/mu"].mean(), 10, atol=0.2)
+
+
+def test_compilation_cache_eviction():
+    cache = pm.inference.cache.CompilationCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache.info() == (1, 0, 2, 2)
+
+
+def test_sample_with_float64_observed():
+    @pm.model
+    def model():
+        sd = yield pm.HalfNormal("sd", 1.0)
+        yield pm.Normal("n", 0, sd, observed=np.random.randn(10))
+
+    trace = pm.sample(model(), num_samples=10, num_chains=2, burn_in=10)
+    assert trace.posterior["model/sd"].shape == (2, 10)
+    assert trace.observed_data["model/n"].dtype == np.float32
+
+
+def test_sample_with_data_as_inputs_reuses_compiled_sampler():
+    @pm.model
+    def regression(x, y):
+        b = yield pm.Normal("b", 0, 10)
+        yield pm.Normal("y", b * x, 0.1, observed=y)
+
+    cache = pm.inference.cache.compilation_cache
+    cache.clear()
+    kwargs = dict(num_samples=100, num_chains=2, burn_in=100, data_as_inputs=True)
+    for size, slope in [(10, 2.0), (25, -3.0)]:
+        x = np.linspace(-1, 1, size)
+        trace = pm.sample(regression(x, slope * x), **kwargs)
+        np.testing.assert_allclose(trace.posterior["regression/b"].mean(), slope, atol=0.1)
+        assert trace.observed_data["regression/y"].shape == (size,)
+    assert cache.info().hits == 1
+    assert cache.info().misses == 1
+
+
+@pytest.fixture(scope="function", params=["memory", "npy"], ids=str)
+def trace_store_fixture(request, tmpdir):
+    if request.param == "memory":
+        return pm.inference.storage.MemoryTraceStore()
+    return pm.inference.storage.NpyTraceStore(str(tmpdir))
+
+
+def test_sample_in_chunks(simple_model_with_deterministic, trace_store_fixture):
+    trace = pm.sample(
+        simple_model_with_deterministic(),
+        num_samples=25,
+        num_chains=3,
+        burn_in=10,
+        chunk_size=10,
+        trace_store=trace_store_fixture,
+    )
+    norm = "simple_model_with_deterministic/simple_model/norm"
+    determ = "simple_model_with_deterministic/determ"
+    assert trace.posterior[norm].shape == (3, 25)
+    assert trace.sample_stats["lp"].shape == (3, 25)
+    np.testing.assert_allclose(trace.posterior[determ], trace.posterior[norm] * 2)
+    if isinstance(trace_store_fixture, pm.inference.storage.NpyTraceStore):
+        posterior, _ = pm.inference.storage.NpyTraceStore.load(trace_store_fixture.directory)
+        np.testing.assert_allclose(posterior[norm], trace.posterior[norm])
+
+
+@pytest.mark.parametrize("thin", [1, 3])
+def test_sample_in_chunks_matches_single_run(simple_model_with_deterministic, thin):
+    kwargs = dict(num_samples=25, num_chains=3, burn_in=10, thin=thin, seed=42)
+    reference = pm.sample(simple_model_with_deterministic(), **kwargs)
+    trace = pm.sample(simple_model_with_deterministic(), chunk_size=10, **kwargs)
+    for name in reference.posterior.data_vars:
+        np.testing.assert_array_equal(trace.posterior[name], reference.posterior[name])
+    np.testing.assert_array_equal(trace.sample_stats["lp"], reference.sample_stats["lp"])
+
+
+def test_sample_resume_from_checkpoint(simple_model_with_deterministic, tmpdir):
+    class Interrupted(Exception):
+        pass
+
+    class InterruptedTraceStore(pm.inference.storage.NpyTraceStore):
+        def write(self, start, posterior, sample_stats):
+            if start >= 20:
+                raise Interrupted
+            super().write(start, posterior, sample_stats)
+
+    kwargs = dict(num_samples=35, num_chains=3, burn_in=10, chunk_size=10, seed=42)
+    reference = pm.sample(simple_model_with_deterministic(), **kwargs)
+    checkpoint_dir = str(tmpdir.join("checkpoint"))
+    with pytest.raises(Interrupted):
+        pm.sample(
+            simple_model_with_deterministic(),
+            checkpoint_dir=checkpoint_dir,
+            trace_store=InterruptedTraceStore(str(tmpdir.join("trace"))),
+            **kwargs,
+        )
+    assert pm.inference.checkpoint.load_checkpoint(checkpoint_dir)["next_draw"] == 20
+    trace = pm.sample(simple_model_with_deterministic(), resume=checkpoint_dir, **kwargs)
+    for name in reference.posterior.data_vars:
+        np.testing.assert_array_equal(trace.posterior[name], reference.posterior[name])
+    np.testing.assert_array_equal(trace.sample_stats["lp"], reference.sample_stats["lp"])
+
+
+def test_sample_resume_with_different_arguments(simple_model_with_deterministic, tmpdir):
+    checkpoint_dir = str(tmpdir)
+    kwargs = dict(num_samples=10, num_chains=2, burn_in=5, chunk_size=5)
+    pm.sample(simple_model_with_deterministic(), checkpoint_dir=checkpoint_dir, **kwargs)
+    kwargs["num_chains"] = 3
+    with pytest.raises(ValueError, match=r"num_chains"):
+        pm.sample(simple_model_with_deterministic(), resume=checkpoint_dir, **kwargs)
+
+
+@pytest.mark.parametrize("mass_matrix", ["diag", "dense"])
+def test_sample_with_mass_matrix_adaptation(mass_matrix):
+    @pm.model
+    def badly_scaled():
+        yield pm.Normal("wide", 0, 10.0)
+        yield pm.Normal("narrow", 0, 0.1, batch_stack=3)
+
+    trace = pm.sample(
+        badly_scaled(), num_samples=200, num_chains=4, burn_in=300, mass_matrix=mass_matrix, seed=1
+    )
+    assert trace.posterior["badly_scaled/narrow"].shape == (4, 200, 3)
+    # an adapted mass matrix makes both scales equally easy to explore
+    assert trace.sample_stats["tree_size"].mean() < 8
+    np.testing.assert_allclose(trace.posterior["badly_scaled/wide"].std(), 10.0, rtol=0.3)
+    np.testing.assert_allclose(trace.posterior["badly_scaled/narrow"].std(), 0.1, rtol=0.3)
+
+
+def test_adaptation_windows():
+    start, ends = pm.inference.adaptation.adaptation_windows(500)
+    assert start == 75
+    assert ends == [100, 150, 250, 450]
+    assert pm.inference.adaptation.adaptation_windows(0) == (0, [])
+
+
+@pytest.fixture(
+    scope="module",
+    params=[
+        pm.inference.step_methods.NUTS(),
+        pm.inference.step_methods.HMC(num_leapfrog_steps=5),
+        pm.inference.step_methods.RandomWalkMetropolis(scale=0.5),
+        pm.inference.step_methods.Slice(),
+        pm.inference.step_methods.ReplicaExchange(inverse_temperatures=[1.0, 0.5]),
+        [
+            pm.inference.step_methods.Slice(var_names=["simple_model/norm"]),
+            pm.inference.step_methods.NUTS(),
+        ],
+    ],
+    ids=repr,
+)
+def step_method_fixture(request):
+    return request.param
+
+
+def test_sample_with_step_methods(simple_model, step_method_fixture):
+    trace = pm.sample(
+        simple_model(), step=step_method_fixture, num_samples=200, num_chains=4, burn_in=100, seed=1
+    )
+    norm = trace.posterior["simple_model/norm"]
+    assert norm.shape == (4, 200)
+    assert "lp" in trace.sample_stats
+    np.testing.assert_allclose(norm.mean(), 0.0, atol=0.3)
+    np.testing.assert_allclose(norm.std(), 1.0, rtol=0.3)
+
+
+def test_compound_step_with_discrete_variable():
+    @pm.model
+    def mixed():
+        yield pm.Normal("mu", 0, 1)
+        yield pm.Poisson("k", 3.0)
+
+    step = pm.inference.step_methods.RandomWalkMetropolis(var_names=["mixed/k"], discrete=True)
+    trace = pm.sample(mixed(), step=step, num_samples=200, num_chains=4, burn_in=50, seed=1)
+    k = trace.posterior["mixed/k"].values
+    np.testing.assert_array_equal(k, np.round(k))
+    assert (k >= 0).all()
+    # the remaining variables are updated with NUTS
+    assert {"accepted_0", "tree_size_1"} <= set(trace.sample_stats)
+
+
+def test_step_method_errors(simple_model):
+    with pytest.raises(ValueError, match=r"Unknown variable"):
+        pm.sample(simple_model(), step=pm.inference.step_methods.Slice(var_names=["norm2"]))
+    with pytest.raises(ValueError, match=r"more than one step method"):
+        pm.sample(
+            simple_model(),
+            step=[
+                pm.inference.step_methods.Slice(var_names=["simple_model/norm"]),
+                pm.inference.step_methods.HMC(var_names=["simple_model/norm"]),
+            ],
+        )
+    with pytest.raises(ValueError, match=r"Can't use `step` together"):
+        pm.sample(
+            simple_model(), step=pm.inference.step_methods.HMC(), nuts_kwargs=dict(max_tree_depth=3)
+        )
+
+
+def test_replica_exchange_visits_both_modes():
+    @pm.model
+    def two_modes():
+        x = yield pm.Normal("x", 0, 5)
+        yield pm.Normal("y", x**2, 1, observed=9.0)
+
+    step = pm.inference.step_methods.ReplicaExchange(inverse_temperatures=[1.0, 0.3, 0.1, 0.03])
+    trace = pm.sample(two_modes(), step=step, num_samples=500, num_chains=4, burn_in=200, seed=1)
+    positive = (trace.posterior["two_modes/x"] > 0).mean("draw")
+    # plain NUTS chains stay in the mode they start in
+    assert ((positive > 0.2) & (positive < 0.8)).all()
+    np.testing.assert_allclose(abs(trace.posterior["two_modes/x"]).mean(), 3.0, atol=0.1)
+    assert trace.sample_stats["swap_accepted"].dtype == bool
+    assert trace.sample_stats["swap_accepted"].any()
+
+
+def test_replica_exchange_errors(simple_model):
+    ReplicaExchange = pm.inference.step_methods.ReplicaExchange
+    with pytest.raises(ValueError, match=r"inverse temperatures"):
+        ReplicaExchange(inverse_temperatures=[0.5, 1.0])
+    with pytest.raises(ValueError, match=r"inverse temperatures"):
+        ReplicaExchange(inverse_temperatures=[1.0, 0.0])
+    with pytest.raises(ValueError, match=r"update all the variables"):
+        ReplicaExchange(pm.inference.step_methods.HMC(var_names=["simple_model/norm"]))
+    with pytest.raises(ValueError, match=r"group of variables"):
+        pm.inference.step_methods.CompoundStep([ReplicaExchange()])
+    with pytest.raises(ValueError, match=r"use_auto_batching"):
+        pm.sample(simple_model(), step=ReplicaExchange(), use_auto_batching=False)
+
+
+def test_sample_chains_in_processes(simple_model_with_deterministic):
+    kwargs = dict(num_samples=50, num_chains=3, burn_in=50, seed=3, chain_method="processes")
+    trace = pm.sample(simple_model_with_deterministic(), num_workers=2, **kwargs)
+    norm = trace.posterior["simple_model_with_deterministic/simple_model/norm"]
+    determ = trace.posterior["simple_model_with_deterministic/determ"]
+    assert norm.shape == (3, 50)
+    np.testing.assert_allclose(determ, 2 * norm)
+    assert trace.sample_stats["tree_size"].shape == (3, 50)
+    # every chain gets its own seed
+    assert not np.allclose(norm[0], norm[1])
+    trace2 = pm.sample(simple_model_with_deterministic(), num_workers=3, **kwargs)
+    np.testing.assert_array_equal(
+        norm, trace2.posterior["simple_model_with_deterministic/simple_model/norm"]
+    )
+
+
+def test_sample_with_unknown_chain_method(simple_model):
+    with pytest.raises(ValueError, match=r"Unknown chain_method"):
+        pm.sample(simple_model(), chain_method="threads")
+    with pytest.raises(ValueError, match=r"not supported"):
+        pm.sample(simple_model(), chain_method="processes", checkpoint_dir="checkpoints")
+
+
+def test_convergence_monitor_matches_arviz():
+    import arviz as az
+
+    draws = np.random.RandomState(0).normal(size=(4, 2000, 2))
+    for t in range(1, draws.shape[1]):
+        draws[:, t] += 0.5 * draws[:, t - 1]
+    monitor = pm.inference.diagnostics.ConvergenceMonitor(var_names=["x"])
+    for start in range(0, 2000, 100):
+        monitor.update({"x": draws[:, start : start + 100]})
+    assert monitor.num_draws == 2000
+    # the batches are merged so that their number stays bounded
+    assert monitor.batch_size == 64
+    dataset = az.convert_to_dataset({"x": draws})
+    diagnostics = monitor.diagnostics["x"]
+    np.testing.assert_allclose(diagnostics["rhat"], az.rhat(dataset)["x"], atol=0.005)
+    np.testing.assert_allclose(diagnostics["ess_bulk"], az.ess(dataset)["x"], rtol=0.25)
+    np.testing.assert_allclose(
+        diagnostics["ess_tail"], az.ess(dataset, method="tail")["x"], rtol=0.25
+    )
+    # chains stuck in different places never converge
+    draws[0] += 3
+    monitor.reset()
+    assert not monitor.update({"x": draws})
+    assert (monitor.diagnostics["x"]["rhat"] > 1.1).all()
+
+
+def test_sample_until_convergence(simple_model_with_deterministic, tmpdir):
+    model = simple_model_with_deterministic()
+    monitor = pm.inference.diagnostics.ConvergenceMonitor(ess_bulk=400, ess_tail=200)
+    checkpoint_dir = str(tmpdir.join("checkpoint"))
+    trace = pm.sample(
+        model,
+        num_samples=5000,
+        num_chains=4,
+        burn_in=100,
+        chunk_size=50,
+        seed=1,
+        convergence=monitor,
+        checkpoint_dir=checkpoint_dir,
+    )
+    num_draws = trace.posterior.sizes["draw"]
+    assert monitor.converged
+    assert num_draws == monitor.num_draws < 5000
+    assert num_draws % 50 == 0
+    assert trace.sample_stats["lp"].shape == (4, num_draws)
+    # a converged run is not continued when it is resumed
+    resumed = pm.sample(
+        model,
+        num_samples=5000,
+        num_chains=4,
+        burn_in=100,
+        resume=checkpoint_dir,
+        convergence=monitor,
+    )
+    assert resumed.posterior.sizes["draw"] == num_draws
+    # the hard cap still applies
+    monitor = pm.inference.diagnostics.ConvergenceMonitor(ess_bulk=1e6)
+    trace = pm.sample(model, num_samples=100, num_chains=4, chunk_size=50, convergence=monitor)
+    assert trace.posterior.sizes["draw"] == 100
+    assert not monitor.converged
+    with pytest.raises(ValueError, match=r"Unknown variables"):
+        pm.sample(model, convergence=pm.inference.diagnostics.ConvergenceMonitor(var_names=["x"]))
+
+
+def test_sample_with_thinning_and_selection(simple_model_with_deterministic, xla_fixture):
+    model = simple_model_with_deterministic()
+    kwargs = dict(num_samples=20, num_chains=2, burn_in=10, seed=2, xla=xla_fixture)
+    full = pm.sample(model, num_samples=60, num_chains=2, burn_in=10, seed=2, xla=xla_fixture)
+    trace = pm.sample(
+        model,
+        var_names=["simple_model_with_deterministic/determ"],
+        stats=["lp", "diverging"],
+        thin=3,
+        **kwargs,
+    )
+    assert list(trace.posterior.data_vars) == ["simple_model_with_deterministic/determ"]
+    assert set(trace.sample_stats.data_vars) == {"lp", "diverging"}
+    # the thinned draws are every third draw of the full run
+    np.testing.assert_allclose(
+        trace.posterior["simple_model_with_deterministic/determ"],
+        full.posterior["simple_model_with_deterministic/determ"][:, ::3],
+        rtol=1e-5,
+    )
+    segmented = pm.sample(model, thin=3, chunk_size=7, stats=["lp"], **kwargs)
+    assert segmented.posterior["simple_model_with_deterministic/simple_model/norm"].shape == (2, 20)
+    assert list(segmented.sample_stats.data_vars) == ["lp"]
+
+
+@pytest.mark.parametrize("chunk_size", [None, 30])
+def test_sample_progress(simple_model, tmpdir, caplog, chunk_size):
+    reports = []
+    path = str(tmpdir.join("sampler.prom"))
+    monitor = pm.inference.progress.ProgressMonitor(
+        sinks=[
+            reports.append,
+            pm.inference.progress.LogSink(),
+            pm.inference.progress.PrometheusTextFileSink(path, labels={"model": "simple"}),
+        ],
+        every=25,
+        min_interval=0,
+    )
+    with caplog.at_level("INFO", logger="pymc4"):
+        pm.sample(
+            simple_model(),
+            num_samples=50,
+            num_chains=3,
+            burn_in=50,
+            chunk_size=chunk_size,
+            progress=monitor,
+        )
+    assert [report.step for report in reports] == [25, 50, 75, 100]
+    assert [report.tuning for report in reports] == [True, True, False, False]
+    last = reports[-1]
+    assert last.total_steps == 100
+    assert last.divergences.shape == last.step_size.shape == last.tree_depth.shape == (3,)
+    assert np.all(last.tree_depth >= 1) and np.all(last.gradients_per_second > 0)
+    assert last.draws_per_second > 0
+    assert "sampling 100/100 (100%)" in caplog.records[-1].getMessage()
+    with open(path) as file:
+        text = file.read()
+    assert 'pymc4_sampler_divergences{chain="2",model="simple"}' in text
+    assert 'pymc4_sampler_step{model="simple"} 100.0' in text
+
+
+def test_sample_progress_is_throttled(simple_model):
+    reports = []
+    monitor = pm.inference.progress.ProgressMonitor(
+        sinks=[reports.append], every=1, min_interval=1e6
+    )
+    pm.sample(simple_model(), num_samples=20, num_chains=2, burn_in=10, progress=monitor)
+    # only the last step is reported
+    assert [report.step for report in reports] == [30]
+
+
+def test_sample_progress_reused_for_other_lengths(simple_model):
+    reports = []
+    monitor = pm.inference.progress.ProgressMonitor(
+        sinks=[reports.append], every=20, min_interval=0
+    )
+    kwargs = dict(num_chains=2, burn_in=10, chunk_size=10, progress=monitor)
+    pm.sample(simple_model(), num_samples=20, **kwargs)
+    assert [(report.step, report.total_steps) for report in reports] == [(20, 30), (30, 30)]
+    del reports[:]
+    pm.sample(simple_model(), num_samples=40, **kwargs)
+    assert [(report.step, report.total_steps) for report in reports] == [
+        (20, 50),
+        (40, 50),
+        (50, 50),
+    ]
+
+
+def test_sample_progress_replica_exchange(simple_model):
+    reports = []
+    monitor = pm.inference.progress.ProgressMonitor(
+        sinks=[reports.append], every=10, min_interval=0
+    )
+    step = pm.inference.step_methods.ReplicaExchange(inverse_temperatures=[1.0, 0.5])
+    pm.sample(simple_model(), step=step, num_samples=20, num_chains=2, burn_in=10, progress=monitor)
+    assert [report.step for report in reports] == [10, 20, 30]
+    assert reports[-1].step_size.shape == (2,)
+
+
+def test_sample_progress_errors(simple_model):
+    monitor = pm.inference.progress.ProgressMonitor(sinks=[])
+    with pytest.raises(ValueError, match=r"XLA"):
+        pm.sample(simple_model(), xla=True, progress=monitor)
+    with pytest.raises(ValueError, match=r"`progress`"):
+        pm.sample(simple_model(), chain_method="processes", progress=monitor)
+    with pytest.raises(ValueError, match=r"every should be a positive integer"):
+        pm.inference.progress.ProgressMonitor(every=0)
+
+
+def test_sample_selection_errors(simple_model):
+    with pytest.raises(ValueError, match=r"Unknown variables"):
+        pm.sample(simple_model(), var_names=["norm"])
+    with pytest.raises(ValueError, match=r"Unknown sampler statistics"):
+        pm.sample(simple_model(), stats=["accepted"])
+    with pytest.raises(ValueError, match=r"thin should be a positive integer"):
+        pm.sample(simple_model(), thin=0)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 15])
+def test_sample_deterministics_posthoc(chunk_size):
+    @pm.model
+    def model():
+        scale = yield pm.HalfNormal("scale", 1)
+        x = yield pm.Normal("x", 0, scale)
+        yield pm.Deterministic("y", x * scale)
+
+    kwargs = dict(num_samples=30, num_chains=3, burn_in=20, seed=4, chunk_size=chunk_size)
+    traced = pm.sample(model(), **kwargs).posterior
+    posthoc = pm.sample(model(), deterministics="posthoc", **kwargs).posterior
+    assert set(posthoc.data_vars) == set(traced.data_vars)
+    for name in ("model/y", "model/scale", "model/x"):
+        np.testing.assert_allclose(posthoc[name], traced[name], rtol=1e-5)
+    # only the selected deterministics are computed and kept
+    selected = pm.sample(
+        model(), deterministics="posthoc", var_names=["model/x", "model/y"], **kwargs
+    ).posterior
+    assert set(selected.data_vars) == {"model/x", "model/y"}
+    np.testing.assert_allclose(selected["model/y"], traced["model/y"], rtol=1e-5)
+
+    skipped = pm.sample(model(), deterministics="skip", **kwargs)
+    assert set(skipped.posterior.data_vars) == {"model/x", "model/__log_scale"}
+    values = pm.inference.sampling.compute_deterministics(model(), skipped, batch_size=7)
+    assert set(values.data_vars) == {"model/y", "model/scale"}
+    np.testing.assert_allclose(values["model/y"], traced["model/y"], rtol=1e-5)
+
+
+def test_sample_deterministics_mode_errors(simple_model):
+    with pytest.raises(ValueError, match=r"Unknown deterministics mode"):
+        pm.sample(simple_model(), deterministics="lazy")
+    with pytest.raises(ValueError, match=r"Unknown deterministics"):
+        pm.inference.sampling.compute_deterministics(simple_model(), {}, var_names=["y"])
+
+
+@pytest.mark.parametrize("kernel", ["rwmh", "hmc"])
+def test_sample_smc_multimodal(kernel):
+    @pm.model
+    def two_modes():
+        x = yield pm.Normal("x", 0, 5)
+        yield pm.Normal("y", x**2, 1, observed=9.0)
+
+    trace = pm.sample_smc(two_modes(), num_particles=1000, num_chains=2, kernel=kernel, seed=1)
+    x = trace.posterior["two_modes/x"]
+    assert x.shape == (2, 1000)
+    np.testing.assert_allclose((x > 0).mean(), 0.5, atol=0.1)
+    np.testing.assert_allclose(abs(x).mean(), 3.0, atol=0.1)
+    np.testing.assert_array_equal(trace.sample_stats["inverse_temperature"], 1.0)
+
+
+def test_sample_smc_log_marginal_likelihood():
+    data = (np.random.RandomState(0).randn(20) + 1).astype("float32")
+
+    @pm.model
+    def conjugate():
+        mu = yield pm.Normal("mu", 0, 2)
+        yield pm.Normal("y", mu, 1, observed=data)
+        yield pm.Deterministic("double_mu", mu * 2)
+
+    trace = pm.sample_smc(conjugate(), num_particles=2000, seed=2)
+    covariance = np.eye(len(data)) + 4 * np.ones((len(data), len(data)))
+    expected = stats.multivariate_normal(np.zeros(len(data)), covariance).logpdf(data)
+    np.testing.assert_allclose(
+        trace.sample_stats.attrs["log_marginal_likelihood"], [expected], atol=0.2
+    )
+    mu = trace.posterior["conjugate/mu"]
+    np.testing.assert_allclose(mu.mean(), 4 * data.sum() / (1 + 4 * len(data)), atol=0.02)
+    np.testing.assert_allclose(trace.posterior["conjugate/double_mu"], 2 * mu)
+
+
+def test_sample_smc_errors(simple_model):
+    with pytest.raises(ValueError, match="Unknown kernel"):
+        pm.sample_smc(simple_model(), kernel="nuts")
+
+    @pm.model
+    def informative():
+        mu = yield pm.Normal("mu", 0, 10)
+        yield pm.Normal("y", mu, 1, observed=np.ones(100, "float32"))
+
+    # the likelihood is too sharp to be reached in a single stage
+    with pytest.raises(ValueError, match=r"increase `max_stage`"):
+        pm.sample_smc(informative(), num_particles=100, max_stage=1, seed=1)
+
+
+def test_sample_many():
+    @pm.model
+    def group():
+        mu = yield pm.Normal("mu", 0, 10)
+        sd = yield pm.HalfNormal("sd", 5)
+        yield pm.Normal("y", mu, sd, observed=np.zeros(20, "float32"))
+        yield pm.Deterministic("double_mu", 2 * mu)
+
+    rng = np.random.RandomState(0)
+    locs, scales = [-5.0, 0.0, 20.0], [0.1, 1.0, 5.0]
+    datasets = [
+        {"group/y": (loc + scale * rng.randn(20)).astype("float32")}
+        for loc, scale in zip(locs, scales)
+    ]
+    traces = pm.sample_many(group(), datasets, num_samples=300, burn_in=300, seed=1)
+    assert len(traces) == 3
+    for trace, dataset, scale in zip(traces, datasets, scales):
+        mu = trace.posterior["group/mu"]
+        assert mu.shape == (4, 300)
+        np.testing.assert_allclose(mu.mean(), dataset["group/y"].mean(), atol=scale / 2)
+        np.testing.assert_allclose(trace.posterior["group/double_mu"], 2 * mu, rtol=1e-5)
+        np.testing.assert_array_equal(trace.observed_data["group/y"], dataset["group/y"])
+
+    stacked = pm.sample_many(group(), datasets, num_samples=10, burn_in=10, stack=True)
+    assert stacked.posterior["group/mu"].dims == ("chain", "draw", "dataset")
+    assert stacked.posterior["group/mu"].shape == (4, 10, 3)
+    assert stacked.sample_stats["tree_size"].shape == (4, 10, 3)
+    assert stacked.observed_data["group/y"].shape == (3, 20)
+
+
+def test_sample_many_errors(simple_model):
+    @pm.model
+    def model():
+        mu = yield pm.Normal("mu", 0, 1)
+        yield pm.Normal("y", mu, 1, observed=np.zeros(3, "float32"))
+
+    with pytest.raises(ValueError, match="must set the observed values"):
+        pm.sample_many(model(), [{"model/y": np.zeros(3)}, {}])
+    with pytest.raises(ValueError, match="different shapes"):
+        pm.sample_many(model(), [{"model/y": np.zeros(3)}, {"model/y": np.zeros(4)}])
+    with pytest.raises(ValueError, match="not observed variables"):
+        pm.sample_many(model(), [{"model/z": np.zeros(3)}])
+    with pytest.raises(ValueError, match="single step method"):
+        pm.sample_many(
+            model(),
+            [{"model/y": np.zeros(3)}],
+            step=pm.inference.step_methods.HMC(var_names=["model/mu"]),
+        )
+
+
+def test_benchmark_model(simple_model):
+    timings = pm.benchmark_model(
+        simple_model(), num_chains=3, repeats=3, modes=["eager", "graph"], batching=["auto"]
+    )
+    assert list(timings) == [
+        "executor",
+        "logp/eager",
+        "logp/graph",
+        "logp_and_gradient/eager",
+        "logp_and_gradient/graph",
+        "chains/auto/graph",
+    ]
+    for name, timing in timings.items():
+        assert timing.repeats == 3
+        assert 0 < timing.p50 <= timing.p99
+        # the compiled functions are traced once
+        assert timing.traces == (None if name == "executor" or "eager" in name else 1)
+    with pytest.raises(ValueError, match=r"Unknown mode"):
+        pm.benchmark_model(simple_model(), modes=["jit"])
+    with pytest.raises(ValueError, match=r"Unknown batching"):
+        pm.benchmark_model(simple_model(), batching=["vectorized"])
+
+
+def test_incremental_log_prob():
+    scale = tf.constant([1.0, 2.0, 3.0])
+
+    @pm.model
+    def model():
+        mu = yield pm.Normal("mu", 0, 1)
+        tau = yield pm.HalfNormal("tau", 1)
+        eta = yield pm.Normal("eta", 0, 1, batch_stack=3)
+        yield pm.Normal("y", mu + tau * eta, scale, observed=np.ones(3, "float32"))
+        z = yield pm.Normal("z", 0, 1)
+        yield pm.Potential(-(z**2))
+
+    log_prob = pm.IncrementalLogProb(model(), values={"model/mu": 0.5})
+    assert log_prob.affected_terms("model/mu") == ["model/mu", "model/y"]
+    assert log_prob.affected_terms("model/__log_tau") == ["model/tau", "model/y"]
+    assert log_prob.affected_terms("model/z") == ["model/z", "potential:1"]
+    assert log_prob.graph.parents["model/y"] == ("model/eta", "model/mu", "model/tau")
+
+    logpfn, *_ = pm.inference.sampling.build_logp_and_deterministic_functions(model())
+    np.testing.assert_allclose(log_prob.log_prob(), logpfn(*log_prob.values.values()), rtol=1e-6)
+    for name, value in [
+        ("model/__log_tau", 0.3),
+        ("model/eta", [0.1, 0.2, -0.3]),
+        ("model/z", 2.0),
+    ]:
+        before = log_prob.log_prob()
+        difference, terms = log_prob.propose(name, value)
+        assert set(terms) == set(log_prob.affected_terms(name))
+        after = log_prob.update(name, value, terms)
+        np.testing.assert_allclose(after - before, difference, atol=1e-5)
+        np.testing.assert_allclose(after, logpfn(*log_prob.values.values()), rtol=1e-6)
+
+    with pytest.raises(ValueError, match="not a free variable"):
+        log_prob.propose("model/tau", 1.0)
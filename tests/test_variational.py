@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+import pymc4 as pm
+
+
+@pytest.fixture(scope="function")
+def conjugate_normal_model():
+    data = np.random.RandomState(42).normal(1.5, 2.0, size=50).astype("float32")
+
+    @pm.model
+    def conjugate_normal_model():
+        mu = yield pm.Normal("mu", 0.0, 10.0)
+        yield pm.Normal("y", mu, 2.0, observed=data)
+        yield pm.Deterministic("mu2", mu * 2)
+
+    # the exact posterior of ``mu``
+    precision = 1 / 10.0**2 + len(data) / 2.0**2
+    mean = data.sum() / 2.0**2 / precision
+    return conjugate_normal_model, mean, precision**-0.5
+
+
+@pytest.mark.parametrize("method", ["advi", "fullrank_advi"])
+def test_fit_conjugate_normal(conjugate_normal_model, method):
+    model, mean, std = conjugate_normal_model
+    approximation, losses = pm.fit(
+        model(), method=method, num_steps=2000, sample_size=10, random_seed=1
+    )
+    assert losses.shape == (2000,)
+    assert losses[-100:].numpy().mean() < losses[:100].numpy().mean()
+    trace = approximation.sample(5000, seed=2)
+    mu = trace.posterior["conjugate_normal_model/mu"]
+    assert mu.shape == (1, 5000)
+    np.testing.assert_allclose(mu.mean(), mean, atol=0.05)
+    np.testing.assert_allclose(mu.std(), std, rtol=0.1)
+    np.testing.assert_allclose(trace.posterior["conjugate_normal_model/mu2"], 2 * mu)
+    assert "conjugate_normal_model/y" in trace.observed_data
+    # the deterministics function is built once
+    postprocess = approximation._postprocess
+    approximation.sample(10, seed=3)
+    assert approximation._postprocess is postprocess
+
+
+def test_fullrank_captures_correlations():
+    @pm.model
+    def correlated():
+        covariance = np.array([[1.0, 0.9], [0.9, 1.0]], dtype="float32")
+        yield pm.MvNormal("x", loc=np.zeros(2, dtype="float32"), covariance_matrix=covariance)
+        yield pm.HalfNormal("scale", 1.0)
+
+    approximation, _ = pm.fit(
+        correlated(), method="fullrank_advi", num_steps=3000, sample_size=5, random_seed=1
+    )
+    trace = approximation.sample(5000, seed=3)
+    x = trace.posterior["correlated/x"].values[0]
+    np.testing.assert_allclose(np.corrcoef(x.T)[0, 1], 0.9, atol=0.05)
+    # the transformed variables are untransformed in the trace
+    assert (trace.posterior["correlated/scale"] > 0).all()
+    assert "correlated/__log_scale" in trace.posterior
+
+
+def test_fit_errors(conjugate_normal_model):
+    model, _, _ = conjugate_normal_model
+    with pytest.raises(ValueError, match=r"Unknown method"):
+        pm.fit(model(), method="nfvi")
+
+    @pm.model
+    def discrete():
+        yield pm.Poisson("k", 3.0)
+
+    with pytest.raises(ValueError, match=r"Only continuous free variables"):
+        pm.fit(discrete())
+
+
+@pytest.mark.parametrize("method", ["lbfgs", "bfgs"])
+def test_find_MAP_with_laplace(conjugate_normal_model, method):
+    model, mean, std = conjugate_normal_model
+    result = pm.find_MAP(model(), method=method, laplace=True)
+    assert result.optimizer_results.converged.numpy()
+    np.testing.assert_allclose(result.transformed["conjugate_normal_model/mu"], mean, rtol=1e-4)
+    np.testing.assert_allclose(
+        result.untransformed["conjugate_normal_model/mu2"], 2 * mean, rtol=1e-4
+    )
+    # the posterior is normal, so the Laplace approximation is exact
+    trace = result.laplace.sample(5000, seed=1)
+    mu = trace.posterior["conjugate_normal_model/mu"]
+    np.testing.assert_allclose(mu.mean(), mean, atol=0.02)
+    np.testing.assert_allclose(mu.std(), std, rtol=0.05)
+
+
+def test_find_MAP_laplace_not_positive_definite():
+    @pm.model
+    def flat_direction():
+        a = yield pm.Normal("a", 0.0, 1.0)
+        yield pm.Flat("b")
+        yield pm.Normal("y", a, 1.0, observed=0.0)
+
+    with pytest.raises(ValueError, match=r"not positive definite"):
+        pm.find_MAP(flat_direction(), laplace=True)
+
+
+def test_find_MAP_transformed_values():
+    @pm.model
+    def model():
+        sd = yield pm.HalfNormal("sd", 1.0)
+        yield pm.Normal("y", 0.0, sd, observed=np.array([-1.0, 1.0], dtype="float32"))
+
+    result = pm.find_MAP(model())
+    # the mode of the density of log(sd), including the log Jacobian, is at sd = 1
+    np.testing.assert_allclose(result.transformed["model/__log_sd"], 0.0, atol=1e-4)
+    np.testing.assert_allclose(result.untransformed["model/sd"], 1.0, rtol=1e-4)
+    # the chains can be started at the mode
+    trace = pm.sample(model(), state=result.state, num_samples=10, num_chains=2, burn_in=10)
+    assert trace.posterior["model/sd"].shape == (2, 10)
+    with pytest.raises(ValueError, match=r"Unknown method"):
+        pm.find_MAP(model(), method="newton")
+
+
+@pytest.mark.parametrize("method", ["lbfgs", "bfgs"])
+def test_find_MAP_overflowing_first_step(method):
+    # the gradient at the initial values is large, so that the first trial step overflows
+    data = np.random.RandomState(0).normal(1.0, 2.0, size=50).astype("float32")
+
+    @pm.model
+    def model():
+        mu = yield pm.Normal("mu", 0.0, 10.0)
+        sd = yield pm.HalfNormal("sd", 5.0)
+        yield pm.Normal("y", mu, sd, observed=data)
+
+    result = pm.find_MAP(model(), method=method)
+    assert result.optimizer_results.converged
+    np.testing.assert_allclose(result.untransformed["model/mu"], data.mean(), atol=0.01)
+    np.testing.assert_allclose(result.untransformed["model/sd"], data.std(), rtol=0.05)